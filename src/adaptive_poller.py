@@ -0,0 +1,51 @@
+import os
+import time
+
+
+class AdaptivePoller:
+    """
+    Picks the delay before the next Envio poll in follow mode from the observed swap
+    arrival rate. The rate is an exponentially weighted average of swaps per second
+    between polls, and the next poll is due when about one new swap is expected:
+    every empty poll halves the estimate, so the interval doubles while the chain is
+    idle, and a busy poll pulls it back down. A full page means the sync is behind,
+    so the next poll is immediate.
+    """
+
+    def __init__(self, min_interval=None, max_interval=None, smoothing=0.5):
+        """
+        :param min_interval: Shortest delay between polls in seconds. If not provided, uses FOLLOW_MIN_INTERVAL from .env
+        :param max_interval: Longest delay between polls in seconds. If not provided, uses FOLLOW_MAX_INTERVAL from .env
+        :param smoothing: Weight of the latest poll in the arrival rate average
+        """
+        self.min_interval = float(min_interval or os.getenv('FOLLOW_MIN_INTERVAL', 1.0))
+        self.max_interval = float(max_interval or os.getenv('FOLLOW_MAX_INTERVAL', 60.0))
+        self.smoothing = smoothing
+        self.rate = None  # Swaps per second, None until the second poll
+        self.interval = self.min_interval
+        self._polled_at = None
+
+    def observe(self, rows, page_full=False, now=None):
+        """
+        Record the result of a poll
+        :param rows: New swaps the poll returned
+        :param page_full: Whether the poll returned a full page, i.e. more swaps are waiting
+        :param now: Current monotonic time, defaults to time.monotonic()
+        :return: Seconds to wait before the next poll
+        """
+        now = time.monotonic() if now is None else now
+        if self._polled_at is not None:
+            elapsed = max(now - self._polled_at, 1e-3)
+            sample = rows / elapsed
+            self.rate = sample if self.rate is None else self.smoothing * sample + (1 - self.smoothing) * self.rate
+        self._polled_at = now
+
+        if page_full:
+            self.interval = self.min_interval
+            return 0.0
+        if self.rate:
+            self.interval = 1.0 / self.rate
+        elif rows == 0:
+            self.interval *= 2  # No swap seen yet in this process
+        self.interval = min(self.max_interval, max(self.min_interval, self.interval))
+        return self.interval
@@ -0,0 +1,358 @@
+import asyncio
+import json
+import os
+from functools import partial
+
+import config
+import log
+import metrics
+from dune_client import chunk_rows_query, insert_chunks, insert_retryable, latest_row_query, ledger_resolve, ledger_state
+from entities import SWAP
+from payload_encoder import get_payload_format
+from rate_limiter import AdaptiveRateLimiter
+
+
+def _aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ValueError("AsyncDuneClient requires aiohttp: pipenv install --categories \"packages async\"")
+    return aiohttp
+
+
+class AsyncDuneClient:
+    """
+    asyncio counterpart of DuneClient for the table, query and insert endpoints. Every
+    coroutine shares one aiohttp session, whose keep-alive pool is capped per host, and
+    one AdaptiveRateLimiter, so one event loop can keep as many chunk inserts in flight
+    as the limiter allows. Pass the rate limiter of a DuneClient to share its budget with
+    the threads using it. Use it as an async context manager, or await close() when done.
+    """
+
+    def __init__(self, rate_limiter=None, max_connections=None, ledger=None):
+        """
+        Nothing is opened until the first request, which must run inside the event loop
+        :param rate_limiter: AdaptiveRateLimiter to use. If not provided, creates one from .env
+        :param max_connections: Connections kept open to the API. If not provided, twice DUNE_MAX_CONCURRENCY, at least 10
+        :param ledger: Optional UploadLedger consulted before each insert, so chunks Dune already accepted are skipped
+        """
+        config.load()
+        self.api_key = os.getenv('DUNE_API_KEY')
+        self.base_url = os.getenv('DUNE_API_URL', "https://api.dune.com/api/v1").rstrip('/')
+        self.batch_size = int(os.getenv('BATCH_SIZE', 10000))
+        self.payload_format = os.getenv('DUNE_PAYLOAD_FORMAT', 'csv')
+        self.headers = {
+            "X-DUNE-API-KEY": self.api_key,
+            "Content-Type": "application/json"
+        }
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter()
+        self.max_connections = int(max_connections or max(10, self.rate_limiter.max_concurrency * 2))
+        self.ledger = ledger
+        self._session = None
+
+    @property
+    def session(self):
+        """aiohttp ClientSession, opened on first use in the running event loop"""
+        if self._session is None:
+            aiohttp = _aiohttp()
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections)
+            # Timeouts are set per request, as with DuneClient
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        """Close the connections kept open to the API"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _timeout(self, seconds):
+        return _aiohttp().ClientTimeout(total=seconds)
+
+    async def _request(self, method, endpoint, description, timeout, **kwargs):
+        """
+        Send one request with the JSON headers
+        :return: Decoded JSON response, or None if the request failed
+        """
+        aiohttp = _aiohttp()
+        try:
+            async with self.session.request(method, endpoint, headers=self.headers,
+                                            timeout=self._timeout(timeout), **kwargs) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error {description}: {e}")
+            return None
+
+    async def create_table(self, namespace, table_name, description, schema, is_private=False):
+        """
+        Create a new table in Dune Analytics
+        :param namespace: Your Dune username
+        :param table_name: Name of the table
+        :param description: Description of the table
+        :param schema: List of column definitions
+        :param is_private: Whether the table is private
+        :return: Response from Dune API
+        """
+        payload = {
+            "namespace": namespace,
+            "table_name": table_name,
+            "description": description,
+            "schema": schema,
+            "is_private": is_private
+        }
+        return await self._request("POST", f"{self.base_url}/table/create", "creating table in Dune", 30, json=payload)
+
+    async def delete_table(self, namespace, table_name):
+        """
+        Delete a table from Dune Analytics
+        :param namespace: Your Dune username
+        :param table_name: Name of the table to delete
+        :return: Response from Dune API
+        """
+        return await self._request("DELETE", f"{self.base_url}/table/{namespace}/{table_name}",
+                                   "deleting table in Dune", 30)
+
+    async def table_exists(self, namespace, table_name):
+        """
+        Check if a table exists in Dune Analytics
+        :param namespace: Your Dune username
+        :param table_name: Name of the table
+        :return: True if table exists, False otherwise
+        """
+        aiohttp = _aiohttp()
+        try:
+            async with self.session.get(f"{self.base_url}/table/{namespace}/{table_name}", headers=self.headers,
+                                        timeout=self._timeout(30)) as response:
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def run_sql(self, query, description="query"):
+        """
+        Run a SQL query on Dune and return its result rows
+        :param query: DuneSQL text
+        :param description: What the query does, for the error message
+        :return: List of row dictionaries, or None if the query failed
+        """
+        result = await self._request("POST", f"{self.base_url}/query/execute", f"running {description} on Dune", 300,
+                                     json={"query": query, "parameters": {}})
+        if result is None:
+            return None
+        return (result.get('result') or {}).get('rows') or []
+
+    async def get_latest_id(self, namespace, table_name, entity=None):
+        """
+        Get the latest transaction hash and timestamp from a Dune table
+        :param namespace: Your Dune username
+        :param table_name: Name of the table
+        :param entity: Optional EntitySpec naming the id and timestamp columns. If not provided, uses Swap
+        :return: Tuple of (latest transaction hash, latest timestamp) or (None, None) if table is empty
+        """
+        rows = await self.run_sql(latest_row_query(namespace, table_name, entity), "latest transaction query")
+        if rows:
+            return rows[0].get('latest_id'), rows[0].get('latest_timestamp')
+        return None, None
+
+    async def upload_data(self, namespace, table_name, data, batch_size=None, payload_format=None, entity=None,
+                          skip_uploaded=True):
+        """
+        Upload data to Dune Analytics, all chunks at once within the limits of the rate limiter
+        :param namespace: Your Dune username
+        :param table_name: Name of the table
+        :param data: RowBatch, or list of dictionaries containing the data to upload
+        :param batch_size: Optional batch size for chunking. If not provided, uses the value from .env
+        :param payload_format: Optional payload format name. If not provided, uses DUNE_PAYLOAD_FORMAT from .env
+        :param entity: Optional EntitySpec whose columns the data must have. If not provided, uses Swap
+        :param skip_uploaded: Skip chunks the upload ledger records as accepted; they are recorded either way
+        :return: List of responses from Dune API, or None if any chunk failed
+        """
+        endpoint = f"{self.base_url}/table/{namespace}/{table_name}/insert"
+        encoding = get_payload_format(payload_format or self.payload_format)
+        chunk_size = batch_size if batch_size is not None else self.batch_size
+        chunked = insert_chunks(data, entity, chunk_size, with_keys=self.ledger is not None)
+        if chunked is None:
+            return None
+        data, chunks = chunked
+        headers = encoding.headers(self.api_key)
+        id_column = (entity or SWAP).id_column
+
+        async def blocks(start, stop):
+            # The chunk is encoded block by block while it is being sent
+            for block in encoding.iter_encode(data, start, stop):
+                metrics.DUNE_BYTES_SENT.inc(len(block))
+                yield block
+
+        def upload(start, stop, label):
+            return self._upload_chunk(
+                endpoint,
+                headers,
+                lambda: blocks(start, stop),
+                lambda: metrics.count_bytes(encoding.encode(data, start, stop)),
+                label,
+                rows=stop - start
+            )
+
+        responses = await asyncio.gather(*(
+            self._upload_once(f"{namespace}.{table_name}", key, skip_uploaded, label, stop - start,
+                              partial(upload, start, stop, label), partial(self.chunk_applied, namespace, table_name, id_column, key))
+            for start, stop, label, key in chunks
+        ))
+
+        results = [response for response in responses if response is not None]
+        log.info("Uploaded %d of %d chunks, rate limiter: %s", len(results), len(responses), self.rate_limiter.snapshot())
+        if len(results) < len(responses):
+            # Never report a partial upload as a success, the caller has to retry or keep the rows
+            log.error("Error: %d chunks could not be uploaded", len(responses) - len(results))
+            return None
+        return results
+
+    async def upload_payload(self, namespace, table_name, path, payload_format, label=None, max_retries=5, rows=None,
+                             key=None, id_column=None):
+        """
+        Upload one already encoded chunk, e.g. from the spill queue
+        :param namespace: Your Dune username
+        :param table_name: Name of the table
+        :param path: File holding the encoded chunk
+        :param payload_format: Payload format name the chunk was encoded with
+        :param label: Optional name of the chunk for logging
+        :param max_retries: Maximum number of attempts
+        :param rows: Optional number of rows in the chunk, for the metrics
+        :param key: Optional (content hash, first id, last id) of the chunk for the upload ledger, see chunk_key
+        :param id_column: Optional column holding the ids of the key, see DuneClient.upload_payload
+        :return: Response JSON from Dune, or None if the chunk could not be uploaded
+        """
+        endpoint = f"{self.base_url}/table/{namespace}/{table_name}/insert"
+        headers = get_payload_format(payload_format).headers(self.api_key)
+
+        def body():
+            # aiohttp reads an open file block by block in its executor, off the event loop, and
+            # sends its size as Content-Length; _post closes it
+            return metrics.count_bytes(open(path, 'rb'))
+
+        label = label or path
+        verify = partial(self.chunk_applied, namespace, table_name, id_column, key) if id_column else None
+        return await self._upload_once(f"{namespace}.{table_name}", key, True, label, rows,
+                                       lambda: self._upload_chunk(endpoint, headers, body, None, label, max_retries, rows),
+                                       verify)
+
+    async def _upload_once(self, stream, key, skip_uploaded, label, rows, upload, verify=None):
+        """
+        Run an upload unless the ledger records the chunk as accepted, and record it once it is,
+        see DuneClient._upload_once
+        :param upload: Function returning a coroutine that sends the chunk
+        :param verify: Optional function returning a coroutine of whether Dune holds rows of the chunk
+        :return: Response JSON from Dune, {"duplicate": True} for a skipped chunk, or None on failure
+        """
+        if self.ledger is None or key is None:
+            return await upload()
+        state = ledger_state(self.ledger, stream, key, skip_uploaded, label)
+        if state == "in_flight":
+            # A chunk spooled without its id column cannot be looked up, it is sent again
+            applied = await verify() if verify is not None else False
+            state = ledger_resolve(self.ledger, stream, key, rows, label, applied)
+        if state == "accepted":
+            return {"duplicate": True}
+        if state == "failed":
+            return None
+        self.ledger.begin(stream, key, rows or 0)
+        result = await upload()
+        if result is not None:
+            self.ledger.record(stream, key, rows or 0)
+        return result
+
+    async def chunk_applied(self, namespace, table_name, id_column, key):
+        """
+        Check whether Dune holds the rows of a chunk, see DuneClient.chunk_applied
+        :return: True if Dune holds its first or last row, False if neither, None if the query failed
+        """
+        rows = await self.run_sql(chunk_rows_query(namespace, table_name, id_column, key), "in flight chunk query")
+        if rows is None:
+            return None
+        return bool(rows) and int(rows[0]['found']) > 0
+
+    async def _upload_chunk(self, endpoint, headers, body, fallback_body, label, max_retries=5, rows=None):
+        """
+        Send one insert request, retrying throttled requests and connections that could not be opened, see DuneClient._upload_chunk
+        :param endpoint: Insert endpoint
+        :param headers: Request headers for the payload format
+        :param body: Function returning a fresh request body (bytes or async iterable) for each attempt
+        :param fallback_body: Optional function returning a bytes body, used if the server refuses a streamed body
+        :param label: Name of the chunk for logging
+        :param max_retries: Maximum number of attempts
+        :param rows: Optional number of rows in the chunk, for the metrics
+        :return: Response JSON from Dune, or None if the chunk could not be uploaded
+        """
+        aiohttp = _aiohttp()
+        base_delay = 5  # Base delay in seconds for connection errors
+        timeout = self._timeout(120)  # For larger chunks
+
+        latency = metrics.DUNE_REQUEST_SECONDS.labels("insert")
+        for attempt in range(1, max_retries + 1):
+            try:
+                async with self.rate_limiter.async_slot():
+                    with latency.time():
+                        status, response_headers, content = await self._post(endpoint, headers, body(), timeout)
+                        if status == 411 and fallback_body is not None:
+                            # The server refused a chunked body: send the chunk with a Content-Length instead
+                            status, response_headers, content = await self._post(endpoint, headers, fallback_body(), timeout)
+            except aiohttp.ClientConnectionError as e:
+                metrics.DUNE_REQUESTS.labels("insert", "connection_error").inc()
+                if not isinstance(e, aiohttp.ClientConnectorError):
+                    # The connection broke after the insert was sent, it may have been applied
+                    log.error("Error uploading %s: %s", label, e)
+                    return None
+                metrics.DUNE_RETRIES.labels("connection_error").inc()
+                delay = base_delay * (2 ** (attempt - 1))
+                log.warning("Connection error on %s: %s. Retrying in %d seconds... (Attempt %d/%d)", label, e, delay, attempt + 1, max_retries)
+                await asyncio.sleep(delay)
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.DUNE_REQUESTS.labels("insert", "error").inc()
+                # A timed out insert may still have been applied, so it is not replayed blindly
+                log.error("Error uploading %s: %s", label, e or type(e).__name__)
+                return None
+
+            metrics.DUNE_REQUESTS.labels("insert", status).inc()
+            if status == 200:
+                self.rate_limiter.on_success(response_headers)
+                self._record_limiter()
+                if rows:
+                    metrics.DUNE_ROWS_UPLOADED.inc(rows)
+                log.debug("Successfully uploaded %s", label)
+                return json.loads(content) if content else {}
+            if insert_retryable(status, response_headers):
+                metrics.DUNE_THROTTLED.inc()
+                metrics.DUNE_RETRIES.labels("throttled").inc()
+                delay = self.rate_limiter.on_throttled(response_headers)
+                self._record_limiter()
+                log.warning("Rate limit hit on %s. All uploads paused for %.1f seconds... (Attempt %d/%d)", label, delay, attempt + 1, max_retries)
+                continue
+            log.error("Error uploading %s: %d %s", label, status, content.decode("utf-8", "replace"))
+            return None
+
+        log.error("Max retries reached for %s", label)
+        return None
+
+    async def _post(self, endpoint, headers, data, timeout):
+        """
+        :param data: Request body; an open file is closed once sent
+        :return: (status, headers, body bytes) of the response
+        """
+        try:
+            async with self.session.post(endpoint, headers=headers, data=data, timeout=timeout) as response:
+                return response.status, response.headers, await response.read()
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+
+    def _record_limiter(self):
+        snapshot = self.rate_limiter.snapshot()
+        metrics.DUNE_RATE.set(min(snapshot["rate"], snapshot["quota_rate"] or snapshot["rate"]))
+        metrics.DUNE_CONCURRENCY.set(snapshot["concurrency"])
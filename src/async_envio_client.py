@@ -0,0 +1,197 @@
+import asyncio
+import os
+
+import config
+import graphql_stream
+import log
+import metrics
+from envio_client import COUNT_BUCKETS_PER_QUERY
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+def _aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ValueError("AsyncEnvioClient requires aiohttp: pipenv install --categories \"packages async\"")
+    return aiohttp
+
+
+class AsyncEnvioClient:
+    """
+    asyncio counterpart of EnvioClient over the raw fetch path: precompiled query bodies
+    are posted on one aiohttp session, whose keep-alive pool is shared by every coroutine
+    and capped at max_connections to the indexer, so one event loop can keep many page
+    and count queries in flight. Queries are not validated against the schema.
+    Use it as an async context manager, or await close() when done.
+    """
+
+    def __init__(self, graphql_url=None, max_connections=None, timeout=120, retries=3):
+        """
+        Nothing is sent or opened until the first query, which must run inside the event loop
+        param graphql_url: GraphQL endpoint. If not provided, uses ENVIO_GRAPHQL_URL from .env
+        param max_connections: Connections kept open to the indexer. If not provided, uses ENVIO_MAX_CONNECTIONS from .env
+        param timeout: Seconds a query may take, response included
+        param retries: Retries of server errors and dropped connections, as the sync session
+        """
+        config.load()
+        graphql_url = graphql_url or os.getenv('ENVIO_GRAPHQL_URL')
+        if not graphql_url:
+            raise ValueError("ENVIO_GRAPHQL_URL not set in environment variables")
+        # Same rule as EnvioClient, plain http is only accepted for a local indexer
+        if not graphql_url.startswith(('https://', 'http://localhost', 'http://127.0.0.1')):
+            raise ValueError(f"Invalid GraphQL URL format: {graphql_url}")
+
+        self.graphql_url = graphql_url
+        self.batch_size = int(os.getenv('BATCH_SIZE', 10000))
+        self.max_connections = int(max_connections or os.getenv('ENVIO_MAX_CONNECTIONS', 8))
+        self.timeout = timeout
+        self.retries = retries
+        self._session = None
+
+    @property
+    def session(self):
+        """aiohttp ClientSession, opened on first use in the running event loop"""
+        if self._session is None:
+            aiohttp = _aiohttp()
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Content-Type": "application/json", "Accept-Encoding": "gzip"}
+            )
+        return self._session
+
+    async def close(self):
+        """Close the connections kept open to the indexer"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _post(self, operation, body):
+        """
+        Post a precompiled query, recording its latency and outcome
+        param operation: Name of the query in the metrics
+        param body: JSON request body, see graphql_stream.compile_request
+        return: Response body bytes, exceptions are re-raised
+        """
+        aiohttp = _aiohttp()
+        with metrics.ENVIO_REQUEST_SECONDS.labels(operation).time():
+            try:
+                for attempt in range(self.retries + 1):
+                    last = attempt == self.retries
+                    try:
+                        async with self.session.post(self.graphql_url, data=body) as response:
+                            if response.status in RETRY_STATUSES and not last:
+                                await asyncio.sleep(0.1 * 2 ** attempt)
+                                continue
+                            response.raise_for_status()
+                            content = await response.read()
+                            break
+                    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                        if last:
+                            raise
+                        await asyncio.sleep(0.1 * 2 ** attempt)
+            except Exception:
+                metrics.ENVIO_REQUESTS.labels(operation, "error").inc()
+                raise
+        metrics.ENVIO_REQUESTS.labels(operation, "ok").inc()
+        return content
+
+    async def get_entities_after(self, entity, cursor=None, limit=None, until=None):
+        """
+        Get rows of an entity ordered by (cursor field, id field), starting strictly after a cursor
+        param entity: EntitySpec of the rows
+        param cursor: (timestamp, id) of the last row already processed, or None to start from the beginning
+        param limit: Number of rows to fetch. If None, uses BATCH_SIZE from .env
+        param until: Optional exclusive upper bound on the cursor field
+        return: List of rows or None if error
+        """
+        if limit is None:
+            limit = self.batch_size
+        body = graphql_stream.request_body(entity.page_query)({"limit": limit, "where": entity.where(cursor, until)})
+        try:
+            content = await self._post(f"get_{entity.entity.lower()}s_after", body)
+            rows = list(graphql_stream.iter_items([content], entity.entity))
+            metrics.ENVIO_ROWS.inc(len(rows))
+            log.debug("Successfully fetched %d %s rows after %s", len(rows), entity.entity, cursor)
+            return rows
+        except Exception as e:
+            log.error("Error fetching %s from Envio: %s", entity.entity, e)
+            return None
+
+    async def iter_pages(self, entity, cursor=None, until=None, limit=None):
+        """
+        Page through the rows of an entity after a cursor, one query at a time; iterate
+        several ranges concurrently to keep more queries in flight
+        param entity: EntitySpec of the rows
+        param cursor: (timestamp, id) of the last row already processed, or None to start from the beginning
+        param until: Optional exclusive upper bound on the cursor field
+        param limit: Rows per page. If None, uses BATCH_SIZE from .env
+        return: Async generator of non-empty lists of rows, raises RuntimeError if a page cannot be fetched
+        """
+        limit = limit or self.batch_size
+        while True:
+            rows = await self.get_entities_after(entity, cursor, limit, until)
+            if rows is None:
+                raise RuntimeError(f"could not fetch {entity.entity} rows after {cursor} from Envio")
+            if not rows:
+                return
+            yield rows
+            if len(rows) < limit:
+                return
+            cursor = entity.cursor(rows[-1])
+
+    async def get_entity_stats(self, entity, cursor=None, until=None):
+        """
+        Get the number of rows of an entity and their cursor field range with one aggregate query
+        param entity: EntitySpec of the rows
+        param cursor: Only count rows strictly after this (timestamp, id) cursor
+        param until: Optional exclusive upper bound on the cursor field
+        return: Dictionary with count, min_timestamp and max_timestamp, or None if error
+        """
+        body = graphql_stream.request_body(entity.stats_query)({"where": entity.where(cursor, until)})
+        try:
+            data = graphql_stream.decode_data(await self._post(f"get_{entity.entity.lower()}_stats", body))
+            aggregate = data[f"{entity.entity}_aggregate"]['aggregate']
+            min_timestamp = (aggregate.get('min') or {}).get(entity.cursor_field)
+            max_timestamp = (aggregate.get('max') or {}).get(entity.cursor_field)
+            return {
+                "count": int(aggregate['count']),
+                "min_timestamp": int(min_timestamp) if min_timestamp is not None else None,
+                "max_timestamp": int(max_timestamp) if max_timestamp is not None else None
+            }
+        except Exception as e:
+            log.error("Error fetching %s stats from Envio: %s", entity.entity, e)
+            return None
+
+    async def get_entity_counts(self, entity, bounds):
+        """
+        Count the rows of an entity in consecutive cursor field ranges, see EnvioClient.get_entity_counts;
+        the requests of COUNT_BUCKETS_PER_QUERY ranges each are sent concurrently
+        param entity: EntitySpec of the rows
+        param bounds: Ascending boundaries b0 < b1 < ... < bn, range i is [b_i, b_i+1)
+        return: List of the n counts, or None if error
+        """
+        async def count(part):
+            variables = {f"w{i}": {entity.cursor_field: {"_gte": part[i], "_lt": part[i + 1]}}
+                         for i in range(len(part) - 1)}
+            body = graphql_stream.request_body(entity.count_query(len(part) - 1))(variables)
+            data = graphql_stream.decode_data(await self._post(f"count_{entity.entity.lower()}_buckets", body))
+            return [int(data[f"b{i}"]['aggregate']['count']) for i in range(len(part) - 1)]
+
+        parts = [bounds[first:first + COUNT_BUCKETS_PER_QUERY + 1]
+                 for first in range(0, len(bounds) - 1, COUNT_BUCKETS_PER_QUERY)]
+        try:
+            results = await asyncio.gather(*(count(part) for part in parts))
+            return [value for counts in results for value in counts]
+        except Exception as e:
+            log.error("Error counting %s buckets in Envio: %s", entity.entity, e)
+            return None
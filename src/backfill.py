@@ -0,0 +1,211 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from entities import SWAP
+from envio_client import EnvioClient
+from pipeline import SyncPipeline
+from spill_queue import SpillQueue
+
+
+class Backfill:
+    """
+    Parallel historical load. The timestamp range still missing from Dune is split
+    into partitions holding roughly the same number of swaps (sized with Envio
+    aggregate counts), and every partition is synced by its own pipeline and Envio
+    client in a worker thread. Each partition checkpoints under its own stream, so a failed
+    partition is retried on its own and resumes where it stopped.
+    """
+
+    def __init__(self, envio_client, dune_client, transformer, checkpoints, namespace, table_name,
+                 batch_size, partitions=None, max_attempts=2, max_retries=3, retry_delay=5, spool=None, entity=None,
+                 rollups=None):
+        """
+        :param envio_client: EnvioClient sizing the partitions; each partition fetches with its own
+                             client to the same endpoint, as a gql client is not safe to share between threads
+        :param dune_client: DuneClient to upload to
+        :param transformer: DataTransformer converting Envio swaps to Dune rows
+        :param checkpoints: CheckpointStore recording the plan and each partition's progress
+        :param namespace: Your Dune username
+        :param table_name: Name of the Dune table
+        :param batch_size: Number of swaps per Envio page
+        :param partitions: Number of partitions and worker threads. If not provided, uses BACKFILL_PARTITIONS from .env
+        :param max_attempts: Times a failed partition is retried within one run
+        :param max_retries: Attempts per Envio fetch and per Dune upload
+        :param retry_delay: Seconds to wait between attempts
+        :param spool: SpillQueue shared by every partition. If not provided, opens SPOOL_PATH from .env
+        :param entity: EntitySpec of the synced rows. If not provided, backfills Swap
+        :param rollups: Optional RollupStore shared by every partition, see SyncPipeline
+        """
+        self.entity = entity or SWAP
+        self.envio_client = envio_client
+        self.dune_client = dune_client
+        self.transformer = transformer
+        self.checkpoints = checkpoints
+        self.namespace = namespace
+        self.table_name = table_name
+        self.stream = f"{namespace}.{table_name}"
+        self.batch_size = batch_size
+        self.partitions = partitions or int(os.getenv('BACKFILL_PARTITIONS', 8))
+        self.max_attempts = max_attempts
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.spool = spool if spool is not None else SpillQueue()
+        self.rollups = rollups
+
+    def plan(self, cursor):
+        """
+        Split everything after the cursor into partitions of roughly equal row counts
+        :param cursor: (timestamp, id) already synced to Dune, or None for an empty table
+        :return: List of (start_timestamp, end_timestamp) ranges, end exclusive, or None if error
+        """
+        stats = self.envio_client.get_entity_stats(self.entity, cursor=cursor)
+        if stats is None:
+            return None
+        if stats["count"] == 0:
+            return []
+
+        low, high, total = stats["min_timestamp"], stats["max_timestamp"] + 1, stats["count"]
+        print(f"Backfill range: {low} -> {high} ({total} {self.entity.entity} rows), {self.partitions} partitions")
+
+        boundaries = [low]
+        for k in range(1, self.partitions):
+            boundary = self._quantile(cursor, boundaries[-1], high, total * k // self.partitions)
+            if boundary is None:
+                return None
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+        boundaries.append(high)
+        return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+    def _quantile(self, cursor, low, high, target):
+        """Smallest timestamp t in [low, high] with at least `target` swaps before t"""
+        while low < high:
+            middle = (low + high) // 2
+            stats = self.envio_client.get_entity_stats(self.entity, cursor=cursor, until=middle)
+            if stats is None:
+                return None
+            if stats["count"] >= target:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def partition_stream(self, start, end):
+        """Checkpoint stream name of one partition"""
+        return f"{self.stream}#backfill/{start}-{end}"
+
+    def run(self, cursor):
+        """
+        Backfill everything after the cursor. A plan left over from an interrupted run
+        is reused, and partitions that already finished are skipped.
+        :param cursor: (timestamp, id) already synced to Dune, or None for an empty table
+        :return: True if every partition finished, False otherwise
+        """
+        partitions = self.checkpoints.load_partitions(self.stream)
+        if partitions:
+            print(f"Resuming backfill plan with {len(partitions)} partitions")
+        else:
+            bounds = self.plan(cursor)
+            if bounds is None:
+                print("Error sizing backfill partitions from Envio")
+                return False
+            if not bounds:
+                print("Nothing to backfill")
+                return True
+            self.checkpoints.save_partitions(self.stream, bounds)
+            partitions = self.checkpoints.load_partitions(self.stream)
+
+        for partition in partitions:
+            print(f"Partition {partition['start']}-{partition['end']}: {partition['status']}")
+
+        pending = [p for p in partitions if p["status"] != "done"]
+        if self.rollups is not None:
+            # Partitions that have not fetched anything yet still hold back the pruning of their hours
+            for partition in pending:
+                self.rollups.start(self.partition_stream(partition["start"], partition["end"]), (partition["start"], ""))
+        for attempt in range(1, self.max_attempts + 1):
+            if not pending:
+                break
+            print(f"\nBackfill attempt {attempt}/{self.max_attempts}: {len(pending)} partitions to sync")
+            with ThreadPoolExecutor(max_workers=self.partitions, thread_name_prefix="backfill") as executor:
+                # Only the first partition continues from the main cursor, the others start at their bound
+                futures = {
+                    executor.submit(self._run_partition, partition, cursor if partition is partitions[0] else None): partition
+                    for partition in pending
+                }
+                failed = []
+                for future in as_completed(futures):
+                    partition = futures[future]
+                    try:
+                        ok = future.result()
+                    except Exception as e:
+                        print(f"Partition {partition['start']}-{partition['end']} crashed: {e}")
+                        ok = False
+                    if not ok:
+                        failed.append(partition)
+            pending = sorted(failed, key=lambda p: p["start"])
+
+        if pending:
+            print(f"Backfill incomplete: {len(pending)} partitions failed, rerun to retry only those")
+            return False
+
+        self._finish(partitions)
+        return True
+
+    def _run_partition(self, partition, cursor):
+        start, end = partition["start"], partition["end"]
+        stream = self.partition_stream(start, end)
+        resume = self.checkpoints.load(stream)
+        if resume is None:
+            # Nothing committed yet: start at the partition's lower bound (ids are never empty)
+            resume = cursor or (start, "")
+
+        self.checkpoints.set_partition_status(self.stream, start, "running")
+        envio_client = EnvioClient(self.envio_client.graphql_url, self.envio_client.schema_cache)
+        pipeline = SyncPipeline(
+            envio_client=envio_client,
+            dune_client=self.dune_client,
+            transformer=self.transformer,
+            checkpoints=self.checkpoints,
+            namespace=self.namespace,
+            table_name=self.table_name,
+            batch_size=self.batch_size,
+            upload_workers=1,
+            max_retries=self.max_retries,
+            retry_delay=self.retry_delay,
+            max_empty_responses=1,  # A bounded range is exhausted after its first empty page
+            stream=stream,
+            until=end,
+            spool=self.spool,
+            entity=self.entity,
+            rollups=self.rollups
+        )
+        try:
+            ok = pipeline.run(resume)
+        finally:
+            envio_client.close()
+        self.checkpoints.set_partition_status(self.stream, start, "done" if ok else "failed")
+        return ok
+
+    def _finish(self, partitions):
+        """Fold the partition checkpoints into the main stream and drop the plan"""
+        rows_total = 0
+        first_cursor = None
+        last_cursor = None
+        for partition in partitions:
+            stream = self.partition_stream(partition["start"], partition["end"])
+            stats = self.checkpoints.stats(stream)
+            if stats is None:
+                continue
+            rows_total += stats["rows_total"]
+            if stats["cursor"] and stats["rows_total"]:
+                first_cursor = first_cursor or (partition["start"], "")
+                last_cursor = stats["cursor"]
+        for partition in partitions:
+            self.checkpoints.reset(self.partition_stream(partition["start"], partition["end"]))
+            if self.rollups is not None:
+                self.rollups.forget(self.partition_stream(partition["start"], partition["end"]))
+        self.checkpoints.save_partitions(self.stream, [])
+        if last_cursor:
+            self.checkpoints.commit(self.stream, first_cursor, last_cursor, rows_total)
+        print(f"Backfill complete: {rows_total} rows, main checkpoint moved to {last_cursor}")
@@ -0,0 +1,76 @@
+# Benchmark of the CSV encoding done by DuneClient.upload_data
+# Compares the previous csv.DictWriter path (full-batch preview, per-chunk string, then an
+# encoded copy) with the streamed single-pass encoder, per MB of CSV uploaded.
+#
+#   python3 src/bench_csv_encoding.py [rows] [chunk_size]
+
+import csv
+import io
+import sys
+import time
+import tracemalloc
+
+from data_transformer import DataTransformer
+from payload_encoder import iter_csv
+from synthetic_data import generate_swaps
+
+
+def dictwriter_upload(rows, chunk_size):
+    """The encoding work upload_data used to do, minus the network"""
+    sent = 0
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=rows[0].keys())
+    writer.writeheader()
+    writer.writerows(rows)
+    preview = output.getvalue()[:500]
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        chunk_output = io.StringIO()
+        writer = csv.DictWriter(chunk_output, fieldnames=chunk[0].keys())
+        writer.writeheader()
+        writer.writerows(chunk)
+        sent += len(chunk_output.getvalue().encode('utf-8'))
+    return sent, preview
+
+
+def streamed_upload(batch, chunk_size):
+    """The encoding work upload_data does now: every block is consumed as the body is sent"""
+    sent = 0
+    for i in range(0, len(batch), chunk_size):
+        for block in iter_csv(batch, i, i + chunk_size):
+            sent += len(block)
+    return sent
+
+
+def measure(label, func, *args):
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    cpu = time.process_time()
+    result = func(*args)
+    cpu = time.process_time() - cpu
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    sent = result[0] if isinstance(result, tuple) else result
+    megabytes = sent / 1e6
+    print(f"{label:<12} {megabytes:8.1f} MB   cpu {cpu / megabytes * 1000:7.1f} ms/MB   "
+          f"peak {peak / 1e6 / megabytes:6.2f} MB/MB ({peak / 1e6:.1f} MB)")
+    return cpu / megabytes, peak / megabytes
+
+
+def main(rows=100000, chunk_size=10000):
+    swaps = generate_swaps(rows)
+    transformer = DataTransformer()
+    batch = transformer.transform_swaps_batch(swaps)
+    dicts = list(batch.dicts())
+    del swaps
+
+    print(f"CSV encoding for {rows} rows, chunk_size {chunk_size}")
+    old_cpu, old_peak = measure("dictwriter", dictwriter_upload, dicts, chunk_size)
+    del dicts
+    new_cpu, new_peak = measure("streamed", streamed_upload, batch, chunk_size)
+    print(f"\nCPU per MB: {old_cpu / new_cpu:.1f}x less, peak memory per MB: {old_peak / new_peak:.1f}x less")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    main(*args)
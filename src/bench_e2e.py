@@ -0,0 +1,268 @@
+# End-to-end throughput benchmark of the sync
+# Starts local stand-ins for Envio (GraphQL over synthetic Swap pages) and the Dune API in
+# separate processes, runs the real main() against them and reports rows/s, batch latency
+# percentiles and peak RSS. Latency, 429s and failures can be injected on either side.
+# With --follow-seconds the sync runs in follow mode while the Envio stand-in keeps indexing
+# new swaps, and the delivery lag (newest swap of a chunk to Dune accepting it) is reported.
+# With --transfers the stand-in also serves Transfer entities and the sync runs with
+# entities.example.json, syncing swaps and transfers side by side.
+# With --dune-drop-rate the Dune stand-in acknowledges some inserts without storing them;
+# --reconcile then runs the sync with --reconcile afterwards, which must restore every row;
+# the repairs go through the same lossy stand-in, so it runs up to RECONCILE_PASSES times.
+# With --dune-lost-rate it stores some inserts but answers 504, as if the answer was lost: the
+# upload ledger must look those chunks up in Dune instead of inserting them twice.
+# With --rollups the sync also maintains the hourly swaps rollup, whose swap counts must add
+# up to the swaps uploaded, and whose unique senders must add up to the distinct senders of
+# each hour and token pair.
+#
+#   python3 src/bench_e2e.py --rows 100000 --batch-size 10000 --dune-latency 0.05 --dune-throttle-rate 0.05
+#   python3 src/bench_e2e.py --rows 10000 --follow-seconds 60 --live-rate 5
+#   python3 src/bench_e2e.py --rows 50000 --transfers 50000
+#   python3 src/bench_e2e.py --rows 100000 --dune-drop-rate 0.05 --reconcile
+#   python3 src/bench_e2e.py --rows 100000 --dune-lost-rate 0.05
+#   python3 src/bench_e2e.py --rows 100000 --rollups
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import fake_servers
+
+RECONCILE_PASSES = 5
+EXAMPLE_ENTITIES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "entities.example.json")
+
+
+def _serve(kind, options, ports):
+    make = fake_servers.make_envio_server if kind == "envio" else fake_servers.make_dune_server
+    server = make(**options)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(kind, options):
+    """Run a stand-in in its own process, so it does not compete with the sync for the GIL"""
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(kind, options, ports), daemon=True)
+    process.start()
+    return process, ports.get(timeout=120)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end sync benchmark against local Envio and Dune stand-ins")
+    parser.add_argument("--rows", type=int, default=100000, help="Synthetic swaps served by the Envio stand-in")
+    parser.add_argument("--batch-size", type=int, default=10000, help="BATCH_SIZE of the sync")
+    parser.add_argument("--payload-format", default="csv", help="DUNE_PAYLOAD_FORMAT of the sync")
+    parser.add_argument("--envio-fetch-mode", default="gql", choices=["gql", "raw"], help="ENVIO_FETCH_MODE of the sync")
+    parser.add_argument("--upload-workers", type=int, default=2, help="UPLOAD_WORKERS of the sync")
+    parser.add_argument("--envio-latency", type=float, default=0.0, help="Seconds added to every Envio request")
+    parser.add_argument("--envio-throttle-rate", type=float, default=0.0, help="Share of Envio requests answered with 429")
+    parser.add_argument("--envio-failure-rate", type=float, default=0.0, help="Share of Envio requests answered with 500")
+    parser.add_argument("--dune-latency", type=float, default=0.0, help="Seconds added to every Dune insert")
+    parser.add_argument("--dune-throttle-rate", type=float, default=0.0, help="Share of Dune inserts answered with 429")
+    parser.add_argument("--dune-failure-rate", type=float, default=0.0, help="Share of Dune inserts answered with 500")
+    parser.add_argument("--dune-drop-rate", type=float, default=0.0,
+                        help="Share of Dune inserts acknowledged but silently not stored")
+    parser.add_argument("--dune-lost-rate", type=float, default=0.0,
+                        help="Share of Dune inserts stored but answered with 504, as if the answer was lost")
+    parser.add_argument("--dune-rate-limit", type=float, default=None,
+                        help="Start the Dune rate limiter at this many requests/s (default: DUNE_RATE_LIMIT of the sync)")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--follow-seconds", type=float, default=None,
+                        help="Run the sync with --follow for this many seconds, then stop it with SIGTERM")
+    parser.add_argument("--live-rate", type=float, default=0.0,
+                        help="Swaps per second the Envio stand-in indexes after it starts, for --follow-seconds")
+    parser.add_argument("--transfers", type=int, default=0,
+                        help="Synthetic transfers served next to the swaps, synced with entities.example.json")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="After the sync, run it again with --reconcile to repair the dropped inserts")
+    parser.add_argument("--rollups", action="store_true",
+                        help="Run the sync with --rollups and check the swap counts of the hourly rollup")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic swaps and injected faults")
+    parser.add_argument("--output", default=None, help="Also write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="envio2dune-bench-")
+    envio, envio_port = start_server("envio", {
+        "rows": args.rows, "seed": args.seed, "latency": args.envio_latency,
+        "throttle_rate": args.envio_throttle_rate, "failure_rate": args.envio_failure_rate,
+        "retry_after": args.retry_after, "live_rate": args.live_rate, "transfers": args.transfers,
+    })
+    dune, dune_port = start_server("dune", {
+        "seed": args.seed, "latency": args.dune_latency, "throttle_rate": args.dune_throttle_rate,
+        "failure_rate": args.dune_failure_rate, "retry_after": args.retry_after, "drop_rate": args.dune_drop_rate,
+        "lost_rate": args.dune_lost_rate,
+    })
+    environment = {
+        "ENVIO_GRAPHQL_URL": f"http://127.0.0.1:{envio_port}/v1/graphql",
+        "DUNE_API_URL": f"http://127.0.0.1:{dune_port}/api/v1",
+        "DUNE_API_KEY": "bench",
+        "DUNE_NAMESPACE": "bench",
+        "DUNE_TABLE_NAME": "swaps",
+        "BATCH_SIZE": str(args.batch_size),
+        "DUNE_PAYLOAD_FORMAT": args.payload_format,
+        "UPLOAD_WORKERS": str(args.upload_workers),
+        "ENVIO_FETCH_MODE": args.envio_fetch_mode,
+        "CHECKPOINT_PATH": os.path.join(workdir, "checkpoints.db"),
+        "SPOOL_PATH": os.path.join(workdir, "spool"),
+        "ENVIO_SCHEMA_CACHE": os.path.join(workdir, "schema.json"),
+        "LOG_LEVEL": "warning",
+    }
+    if args.transfers:
+        environment["ENTITIES_PATH"] = EXAMPLE_ENTITIES
+    if args.dune_rate_limit:
+        environment["DUNE_RATE_LIMIT"] = str(args.dune_rate_limit)
+        environment["DUNE_MAX_RATE_LIMIT"] = str(max(args.dune_rate_limit, float(os.getenv("DUNE_MAX_RATE_LIMIT", 10))))
+    try:
+        # Variables set in the environment win over a real .env
+        os.environ.update(environment)
+        import main as sync_main
+        import metrics
+
+        argv = ["--rollups"] if args.rollups else []
+        if args.follow_seconds:
+            argv.append("--follow")
+            timer = threading.Timer(args.follow_seconds, os.kill, (os.getpid(), signal.SIGTERM))
+            timer.daemon = True
+            timer.start()
+        started = time.time()
+        sync_main.main(argv)
+        wall = time.time() - started
+        dune_stats = _stats(dune_port)
+        reconcile_seconds, reconcile_passes = None, 0
+        if args.reconcile:
+            reconcile_started = time.time()
+            while reconcile_passes < RECONCILE_PASSES and _incomplete(dune_stats, args):
+                sync_main.main(["--reconcile"])
+                reconcile_passes += 1
+                dune_stats = _stats(dune_port)
+            reconcile_seconds = time.time() - reconcile_started
+    finally:
+        envio.terminate()
+        dune.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    empty = {"rows": 0, "unique_ids": 0}
+    table = dune_stats["tables"].get("bench.swaps", empty)
+    # The sync waits for a few empty pages before it stops: measure throughput up to the last insert
+    active = (dune_stats["last_insert_at"] or time.time()) - started
+    results = {
+        "rows": args.rows,
+        "rows_uploaded": table["rows"],
+        "unique_ids": table["unique_ids"],
+        "wall_seconds": wall,
+        "active_seconds": active,
+        "rows_per_second": table["rows"] / active if active > 0 else 0.0,
+        "batch_seconds_p50": metrics.BATCH_SECONDS.quantile(0.5),
+        "batch_seconds_p99": metrics.BATCH_SECONDS.quantile(0.99),
+        "chunk_upload_seconds_p50": metrics.SPOOL_CHUNK_SECONDS.quantile(0.5),
+        "chunk_upload_seconds_p99": metrics.SPOOL_CHUNK_SECONDS.quantile(0.99),
+        "delivery_lag_seconds_p50": metrics.DELIVERY_LAG_SECONDS.quantile(0.5),
+        "delivery_lag_seconds_p99": metrics.DELIVERY_LAG_SECONDS.quantile(0.99),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # KB on Linux
+        "dune_requests": dune_stats["requests"],
+        "dune_throttled": dune_stats["throttled"],
+        "dune_failed": dune_stats["failed"],
+        "dune_bytes_received": dune_stats["bytes_received"],
+        "dune_rows_dropped": dune_stats["dropped"],
+        "dune_answers_lost": dune_stats["lost"],
+        "reconcile_seconds": reconcile_seconds,
+        "reconcile_passes": reconcile_passes,
+        "transfers_uploaded": dune_stats["tables"].get("bench.transfers", empty)["rows"],
+        "transfer_unique_ids": dune_stats["tables"].get("bench.transfers", empty)["unique_ids"],
+        "rollup_rows": dune_stats["tables"].get("bench.swaps_hourly", empty)["rows"],
+        "rollup_swaps": int(dune_stats["tables"].get("bench.swaps_hourly", {}).get("totals", {}).get("swaps", 0)),
+        "rollup_unique_senders": int(
+            dune_stats["tables"].get("bench.swaps_hourly", {}).get("totals", {}).get("unique_senders", 0)),
+        "rollup_expected_unique_senders": _unique_senders(args) if args.rollups and not args.follow_seconds else None,
+        "options": vars(args),
+    }
+    return results
+
+
+def _unique_senders(args):
+    """Distinct senders per hour and token pair of the synthetic swaps, summed: what the rollup must count"""
+    from data_transformer import DataTransformer
+    from entities import SWAP
+    from synthetic_data import generate_swaps
+
+    rows = DataTransformer().transform_batch(generate_swaps(args.rows, seed=args.seed), SWAP)
+    hours = rows.column("timestamp").astype("datetime64[h]").tolist()
+    return len(set(zip(hours, *(rows.column(name).tolist() for name in ("token_in", "token_out", "from")))))
+
+
+def _stats(dune_port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{dune_port}/_stats") as response:
+        return json.load(response)
+
+
+def _incomplete(dune_stats, args):
+    """Whether rows are still missing from a table after dropped inserts"""
+    expected = {"bench.swaps": args.rows, "bench.transfers": args.transfers}
+    return any(dune_stats["tables"].get(name, {"unique_ids": 0})["unique_ids"] < rows for name, rows in expected.items())
+
+
+def delivered_exactly_once(results):
+    """Every swap (and transfer) reached Dune once; in follow mode swaps indexed while it ran count too"""
+    transfers = results["options"]["transfers"]
+    if results["transfer_unique_ids"] != transfers or results["transfers_uploaded"] != transfers:
+        return False
+    # Rollup deltas lost by a lossy Dune are not reconciled, so their counts only add up without drops
+    if results["options"]["rollups"] and results["rollup_swaps"] != results["rows_uploaded"]:
+        return False
+    expected = results["rollup_expected_unique_senders"]
+    if expected is not None and results["rollup_unique_senders"] != expected:
+        return False
+    if results["options"]["follow_seconds"]:
+        return results["unique_ids"] == results["rows_uploaded"] >= results["rows"]
+    return results["unique_ids"] == results["rows"] == results["rows_uploaded"]
+
+
+def print_results(results):
+    print("\nEnd-to-end benchmark")
+    print(f"  rows uploaded     {results['rows_uploaded']} of {results['rows']} ({results['unique_ids']} unique ids)")
+    if results["options"]["transfers"]:
+        print(f"  transfers         {results['transfers_uploaded']} of {results['options']['transfers']} "
+              f"({results['transfer_unique_ids']} unique ids)")
+    print(f"  throughput        {results['rows_per_second']:.0f} rows/s over {results['active_seconds']:.1f}s "
+          f"({results['wall_seconds']:.1f}s wall, including the end-of-data wait)")
+    names = ["batch_seconds", "chunk_upload_seconds"]
+    if results["options"]["follow_seconds"]:
+        names.append("delivery_lag_seconds")
+    for name in names:
+        p50, p99 = results[f"{name}_p50"], results[f"{name}_p99"]
+        if p50 is not None:
+            print(f"  {name:<17} p50 {p50:.3f}s  p99 {p99:.3f}s")
+    print(f"  peak RSS          {results['peak_rss_mb']:.0f} MB")
+    print(f"  Dune requests     {results['dune_requests']} ({results['dune_throttled']} throttled, {results['dune_failed']} failed)")
+    if results["dune_rows_dropped"]:
+        print(f"  rows dropped      {results['dune_rows_dropped']} by the Dune stand-in")
+    if results["dune_answers_lost"]:
+        print(f"  answers lost      {results['dune_answers_lost']} inserts stored but answered with 504")
+    if results["options"]["rollups"]:
+        print(f"  rollup            {results['rollup_rows']} hourly rows counting {results['rollup_swaps']} swaps "
+              f"and {results['rollup_unique_senders']} unique senders")
+    if results["reconcile_seconds"] is not None:
+        print(f"  reconcile         {results['reconcile_seconds']:.1f}s in {results['reconcile_passes']} passes")
+    if not delivered_exactly_once(results):
+        print("  WARNING: Dune did not receive every row exactly once")
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    results = run(arguments)
+    print_results(results)
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if delivered_exactly_once(results) else 1)
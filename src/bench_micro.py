@@ -0,0 +1,257 @@
+# Microbenchmarks of the per-row hot paths, with stored baselines and a regression threshold
+# Every benchmark runs on deterministic synthetic swaps at 1k/10k/100k rows and keeps the best
+# of a few repeats (with the garbage collector off, as timeit does). Times are also stored relative
+# to a fixed pure-Python calibration loop, so baselines recorded on one machine stay meaningful on
+# a faster or slower one. Regressions are measured again before the run fails.
+#
+#   python3 src/bench_micro.py                 # compare with src/bench_baselines.json, exit 1 on regression
+#   python3 src/bench_micro.py --update        # record new baselines
+#   python3 src/bench_micro.py --sizes 1000 10000 --only transform_swaps
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+
+import graphql_stream
+from data_transformer import DataTransformer
+from payload_encoder import iter_csv
+from dedup import DedupWindow
+from entities import SWAP, EntitySpec, TokenColumns
+from synthetic_data import generate_swaps
+from token_metadata import TokenCache
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baselines.json")
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+
+def _calibration_workload():
+    table = {}
+    for i in range(100000):
+        table[str(i)] = int(str(i)) * 2
+    return len(table)
+
+
+def calibrate(repeats=10):
+    """Seconds taken by a fixed mix of string, int and dict work, the unit of relative times"""
+    return best_time(_calibration_workload, repeats, min_total=2.0)
+
+
+def best_time(function, repeats, min_total=0.5):
+    """
+    Best time of a function over at least `repeats` runs, and more runs for fast
+    functions until min_total seconds were spent, so short measurements are not just noise
+    """
+    best = None
+    total = 0.0
+    runs = 0
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        while runs < repeats or total < min_total:
+            started = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+            total += elapsed
+            runs += 1
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+
+def graphql_response(swaps):
+    """The body Envio returns for a page of swaps"""
+    return json.dumps({"data": {"Swap": swaps}}).encode("utf-8")
+
+
+def _transform_swaps(swaps):
+    transformer = DataTransformer()
+    return lambda: transformer.transform_swaps(swaps)
+
+
+def _transform_swaps_batch(swaps):
+    transformer = DataTransformer()
+    return lambda: transformer.transform_swaps_batch(swaps)
+
+
+def _token_enrich(swaps):
+    # Swaps with both token columns enriched from a warm cache, the steady state of a sync
+    spec = EntitySpec("Swap", "swaps", SWAP.columns, tokens=[TokenColumns("token_in", "amount_in"),
+                                                             TokenColumns("token_out", "amount_out")])
+    path = os.path.join(tempfile.mkdtemp(), "tokens.db")
+    cache = TokenCache(path, resolver=lambda addresses: {address: ("TKN", 18) for address in addresses})
+    transformer = DataTransformer(cache)
+    transformer.transform_batch(swaps, spec)
+    return lambda: transformer.transform_batch(swaps, spec)
+
+
+def _csv_chunks(swaps, chunk_size=10000):
+    batch = DataTransformer().transform_swaps_batch(swaps)
+
+    def encode():
+        # What upload_data streams to Dune, chunk by chunk
+        for start in range(0, len(batch), chunk_size):
+            for _ in iter_csv(batch, start, start + chunk_size):
+                pass
+    return encode
+
+
+def _dedup(swaps):
+    # Second half of the page replays the first half, as an indexer re-scan would
+    half = swaps[:len(swaps) // 2]
+    page = half + half
+    return lambda: DedupWindow().filter(page)
+
+
+def _dedup_evict(swaps, page_size=1000):
+    # A one-second window fed page by page: every page but the last moves to the Bloom
+    # filter, the steady state of a long sync
+    pages = [swaps[start:start + page_size] for start in range(0, len(swaps), page_size)]
+
+    def run():
+        seen = DedupWindow(window_seconds=1)
+        for page in pages:
+            seen.filter(page)
+    return run
+
+
+def _graphql_decode(swaps):
+    body = graphql_response(swaps)
+    return lambda: json.loads(body)["data"]["Swap"]
+
+
+def _graphql_stream(swaps, chunk_size=64 * 1024):
+    # The raw fetch path, fed the body in the pieces a streamed response arrives in
+    body = graphql_response(swaps)
+    chunks = [body[start:start + chunk_size] for start in range(0, len(body), chunk_size)]
+    return lambda: list(graphql_stream.iter_items(chunks, "Swap"))
+
+
+# Name -> function(swaps) returning the callable to time
+BENCHMARKS = {
+    "transform_swaps": _transform_swaps,
+    "transform_swaps_batch": _transform_swaps_batch,
+    "token_enrich": _token_enrich,
+    "csv_chunks": _csv_chunks,
+    "dedup_filter": _dedup,
+    "dedup_evict": _dedup_evict,
+    "graphql_decode": _graphql_decode,
+    "graphql_stream": _graphql_stream,
+}
+
+
+def measure(name, swaps, calibration, repeats=5):
+    """
+    Time one benchmark on a page of swaps
+    :param calibration: Result of calibrate()
+    :return: Dictionary with seconds, ns_per_row, relative and calibration_seconds
+    """
+    function = BENCHMARKS[name](swaps)
+    seconds = best_time(function, repeats)
+    return {
+        "seconds": seconds,
+        "ns_per_row": seconds / len(swaps) * 1e9,
+        "relative": seconds / calibration,
+        "calibration_seconds": calibration,
+    }
+
+
+def run(sizes=DEFAULT_SIZES, only=None, repeats=5):
+    """
+    Run the benchmarks
+    :param sizes: Row counts to run every benchmark at
+    :param only: Optional list of benchmark names
+    :param repeats: Repeats per measurement, the best one is kept
+    :return: Dictionary with the calibration time and "name/size" -> measure() result
+    """
+    calibration = calibrate()
+    results = {"calibration_seconds": calibration, "benchmarks": {}}
+    for size in sizes:
+        swaps = generate_swaps(size, seed=1)
+        for name in BENCHMARKS:
+            if not only or name in only:
+                results["benchmarks"][f"{name}/{size}"] = measure(name, swaps, calibration, repeats)
+    return results
+
+
+def confirm_regressions(results, baselines, threshold, repeats=5, attempts=2):
+    """
+    Measure regressed benchmarks again and keep their best result, so a noisy
+    neighbour on a shared machine does not fail the run on its own
+    """
+    for _ in range(attempts):
+        regressed = [name for name, _, _, _, bad in compare(results, baselines, threshold) if bad]
+        if not regressed:
+            return
+        for key in regressed:
+            name, size = key.split("/")
+            again = measure(name, generate_swaps(int(size), seed=1), results["calibration_seconds"], repeats)
+            if again["relative"] < results["benchmarks"][key]["relative"]:
+                results["benchmarks"][key] = again
+
+
+def compare(results, baselines, threshold):
+    """
+    Compare results with baselines on calibration-relative times
+    :param threshold: Allowed slowdown, e.g. 0.25 for 25%
+    :return: List of (name, baseline ns/row, current ns/row, change, regressed)
+    """
+    rows = []
+    for name, current in results["benchmarks"].items():
+        baseline = baselines["benchmarks"].get(name)
+        if baseline is None:
+            continue
+        change = current["relative"] / baseline["relative"] - 1
+        rows.append((name, baseline["ns_per_row"], current["ns_per_row"], change, change > threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the per-row hot paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="Row counts")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--repeats", type=int, default=5, help="Repeats per measurement, the best one is kept")
+    parser.add_argument("--baselines", default=BASELINES_PATH, help="Baselines file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed slowdown against the baseline (default: 0.25)")
+    parser.add_argument("--update", action="store_true", help="Record the results as the new baselines")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.only, args.repeats)
+    if args.update:
+        baselines = {"benchmarks": {}}
+        if os.path.exists(args.baselines):
+            with open(args.baselines) as f:
+                baselines = json.load(f)
+        baselines["benchmarks"].update(results["benchmarks"])
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        for name, result in results["benchmarks"].items():
+            print(f"{name:<30} {result['ns_per_row']:>10.0f} ns/row")
+        print(f"Baselines written to {args.baselines}")
+        return 0
+
+    if not os.path.exists(args.baselines):
+        print(f"No baselines at {args.baselines}, record them with --update")
+        return 1
+    with open(args.baselines) as f:
+        baselines = json.load(f)
+    confirm_regressions(results, baselines, args.threshold, args.repeats)
+    print(f"{'benchmark':<30} {'baseline ns/row':>16} {'current ns/row':>15} {'change':>8}")
+    failed = False
+    for name, baseline, current, change, regressed in compare(results, baselines, args.threshold):
+        failed |= regressed
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:<30} {baseline:>16.0f} {current:>15.0f} {change:>+8.1%}{flag}")
+    if failed:
+        print(f"\nAt least one benchmark is more than {args.threshold:.0%} slower than its baseline")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+# Cold-start benchmark with a budget
+# Measures, in fresh interpreter processes, the time to import main and the time from process
+# start to the first Envio page against the local Envio stand-in, with and without a cached
+# GraphQL schema. Exits with status 1 when the warm start (cached schema) exceeds the budget.
+#
+#   python3 src/bench_startup.py [--runs 5] [--budget 1.0] [--envio-latency 0.1]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_e2e import start_server
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+
+FIRST_PAGE = """
+from entities import SWAP
+from envio_client import EnvioClient
+swaps = EnvioClient().get_entities_after(SWAP, cursor=None, limit=100)
+assert swaps, "no swaps fetched"
+"""
+
+
+def timed_run(code, environment):
+    """Wall time of a fresh interpreter running code, interpreter startup included"""
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=SRC, env=environment, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def run(runs=5, envio_latency=0.0):
+    """
+    :param runs: Processes started per measurement, the median is reported
+    :param envio_latency: Seconds added to every Envio request, to model a remote indexer
+    :return: Dictionary of median seconds for import_main, first_page_cold and first_page_warm
+    """
+    envio, port = start_server("envio", {"rows": 1000, "latency": envio_latency})
+    workdir = tempfile.mkdtemp(prefix="envio2dune-startup-")
+    cache = os.path.join(workdir, "schema.json")
+    environment = dict(os.environ, ENVIO_GRAPHQL_URL=f"http://127.0.0.1:{port}/v1/graphql",
+                       ENVIO_SCHEMA_CACHE=cache, DUNE_API_KEY="bench", DUNE_NAMESPACE="bench",
+                       LOG_LEVEL="warning")
+    try:
+        results = {"import_main": [], "first_page_cold": [], "first_page_warm": []}
+        for _ in range(runs):
+            results["import_main"].append(timed_run("import main", environment))
+            if os.path.exists(cache):
+                os.remove(cache)
+            results["first_page_cold"].append(timed_run(FIRST_PAGE, environment))
+            results["first_page_warm"].append(timed_run(FIRST_PAGE, environment))
+    finally:
+        envio.terminate()
+    return {name: statistics.median(values) for name, values in results.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold-start benchmark with a budget")
+    parser.add_argument("--runs", type=int, default=5, help="Processes started per measurement")
+    parser.add_argument("--budget", type=float, default=float(os.getenv("STARTUP_BUDGET_SECONDS", 1.0)),
+                        help="Seconds allowed from process start to the first Envio page with a cached schema "
+                             "(default: STARTUP_BUDGET_SECONDS or 1.0)")
+    parser.add_argument("--envio-latency", type=float, default=0.0, help="Seconds added to every Envio request")
+    parser.add_argument("--output", default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args.runs, args.envio_latency)
+    print(f"import main                      {results['import_main']:.3f}s")
+    print(f"first Envio page, schema fetched {results['first_page_cold']:.3f}s")
+    print(f"first Envio page, schema cached  {results['first_page_warm']:.3f}s (budget {args.budget:.3f}s)")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(results, budget=args.budget), f, indent=2)
+    if results["first_page_warm"] > args.budget:
+        print("Cold start is over budget")
+        sys.exit(1)
@@ -0,0 +1,190 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class CheckpointStore:
+    """
+    Durable local record of how far each stream has been synced to Dune.
+    A stream is one Dune table, e.g. "namespace.swaps". Every successful upload
+    is committed as a batch boundary, and the stream cursor moves in the same
+    transaction, so a restart resumes exactly after the last committed batch.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: SQLite file to use. If not provided, uses CHECKPOINT_PATH from .env
+        """
+        self.path = path or os.getenv('CHECKPOINT_PATH', 'checkpoints.db')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    stream TEXT PRIMARY KEY,
+                    cursor_timestamp INTEGER,
+                    cursor_id TEXT,
+                    rows_total INTEGER NOT NULL DEFAULT 0,
+                    batches_total INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS batches (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    stream TEXT NOT NULL,
+                    first_timestamp INTEGER,
+                    first_id TEXT,
+                    last_timestamp INTEGER NOT NULL,
+                    last_id TEXT NOT NULL,
+                    rows INTEGER NOT NULL,
+                    committed_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS partitions (
+                    stream TEXT NOT NULL,
+                    start_timestamp INTEGER NOT NULL,
+                    end_timestamp INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (stream, start_timestamp)
+                )
+            """)
+
+    def load(self, stream):
+        """
+        Get the last committed cursor of a stream
+        :param stream: Stream name
+        :return: (timestamp, id) tuple, or None if the stream has no checkpoint yet
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT cursor_timestamp, cursor_id FROM checkpoints WHERE stream = ?",
+                (stream,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return row[0], row[1]
+
+    def stats(self, stream):
+        """
+        Get the counters of a stream
+        :param stream: Stream name
+        :return: Dictionary with cursor, rows_total, batches_total and updated_at, or None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT cursor_timestamp, cursor_id, rows_total, batches_total, updated_at "
+                "FROM checkpoints WHERE stream = ?",
+                (stream,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "cursor": (row[0], row[1]) if row[0] is not None else None,
+            "rows_total": row[2],
+            "batches_total": row[3],
+            "updated_at": row[4]
+        }
+
+    def seed(self, stream, cursor):
+        """
+        Set the cursor of a stream that has no checkpoint yet, e.g. when bootstrapping from Dune
+        :param stream: Stream name
+        :param cursor: (timestamp, id) tuple
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO checkpoints (stream, cursor_timestamp, cursor_id, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (stream, cursor[0], cursor[1], time.time())
+            )
+
+    def commit(self, stream, first_cursor, last_cursor, rows):
+        """
+        Record a batch that Dune has accepted and move the stream cursor past it
+        :param stream: Stream name
+        :param first_cursor: (timestamp, id) of the first row in the batch
+        :param last_cursor: (timestamp, id) of the last row in the batch
+        :param rows: Number of rows uploaded
+        """
+        now = time.time()
+        first_timestamp, first_id = first_cursor if first_cursor else (None, None)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO batches (stream, first_timestamp, first_id, last_timestamp, last_id, rows, committed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (stream, first_timestamp, first_id, last_cursor[0], last_cursor[1], rows, now)
+            )
+            self._conn.execute(
+                """
+                INSERT INTO checkpoints (stream, cursor_timestamp, cursor_id, rows_total, batches_total, updated_at)
+                VALUES (?, ?, ?, ?, 1, ?)
+                ON CONFLICT(stream) DO UPDATE SET
+                    cursor_timestamp = excluded.cursor_timestamp,
+                    cursor_id = excluded.cursor_id,
+                    rows_total = rows_total + excluded.rows_total,
+                    batches_total = batches_total + 1,
+                    updated_at = excluded.updated_at
+                """,
+                (stream, last_cursor[0], last_cursor[1], rows, now)
+            )
+
+    def save_partitions(self, stream, bounds):
+        """
+        Record the backfill plan of a stream, replacing any previous plan
+        :param stream: Stream name
+        :param bounds: List of (start_timestamp, end_timestamp) ranges, end exclusive
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM partitions WHERE stream = ?", (stream,))
+            self._conn.executemany(
+                "INSERT INTO partitions (stream, start_timestamp, end_timestamp) VALUES (?, ?, ?)",
+                [(stream, start, end) for start, end in bounds]
+            )
+
+    def load_partitions(self, stream):
+        """
+        Get the backfill plan of a stream
+        :param stream: Stream name
+        :return: List of dictionaries with start, end, status and attempts, ordered by start
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT start_timestamp, end_timestamp, status, attempts FROM partitions "
+                "WHERE stream = ? ORDER BY start_timestamp",
+                (stream,)
+            ).fetchall()
+        return [{"start": r[0], "end": r[1], "status": r[2], "attempts": r[3]} for r in rows]
+
+    def set_partition_status(self, stream, start, status):
+        """
+        Update the status of one backfill partition
+        :param stream: Stream name
+        :param start: Start timestamp identifying the partition
+        :param status: 'pending', 'running', 'done' or 'failed'
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE partitions SET status = ?, attempts = attempts + (? = 'running') "
+                "WHERE stream = ? AND start_timestamp = ?",
+                (status, status, stream, start)
+            )
+
+    def reset(self, stream):
+        """
+        Forget everything recorded for a stream, e.g. after the Dune table was deleted
+        :param stream: Stream name
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM checkpoints WHERE stream = ?", (stream,))
+            self._conn.execute("DELETE FROM batches WHERE stream = ?", (stream,))
+            self._conn.execute("DELETE FROM partitions WHERE stream = ?", (stream,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,78 @@
+import os
+import time
+
+
+class Coalescer:
+    """
+    Buffers transformed batches in front of the spill queue so that small pages
+    (the tail of a sync, or the few new swaps of a quiet poll in follow mode) are
+    uploaded together instead of as one insert request each. The buffer is flushed
+    once it holds max_rows rows or max_bytes bytes, or once its oldest batch has
+    waited max_delay seconds, whichever comes first, so the freshness lag it adds
+    is bounded by max_delay.
+    """
+
+    def __init__(self, max_rows=None, max_bytes=None, max_delay=None):
+        """
+        :param max_rows: Buffered rows that trigger a flush. If not provided, uses COALESCE_MAX_ROWS from .env, or BATCH_SIZE
+        :param max_bytes: Buffered column bytes that trigger a flush. If not provided, uses COALESCE_MAX_BYTES from .env
+        :param max_delay: Seconds the oldest buffered batch may wait. If not provided, uses COALESCE_MAX_DELAY from .env
+        """
+        self.max_rows = int(max_rows or os.getenv('COALESCE_MAX_ROWS') or os.getenv('BATCH_SIZE', 10000))
+        self.max_bytes = int(max_bytes or os.getenv('COALESCE_MAX_BYTES', 16 * 1024 * 1024))
+        self.max_delay = float(max_delay or os.getenv('COALESCE_MAX_DELAY', 5.0))
+        self.batches = []
+        self.rows = 0
+        self.bytes = 0
+        self._since = None
+
+    def __len__(self):
+        """Batches buffered"""
+        return len(self.batches)
+
+    def add(self, batch, now=None):
+        """
+        Buffer one transformed batch
+        :param batch: Batch whose rows are a RowBatch
+        :param now: Current monotonic time, defaults to time.monotonic()
+        :return: True if the buffer should be flushed now
+        """
+        if not self.batches:
+            self._since = time.monotonic() if now is None else now
+        self.batches.append(batch)
+        self.rows += len(batch.rows)
+        self.bytes += batch.rows.nbytes
+        return self.due(now) is not None
+
+    def due(self, now=None):
+        """
+        :return: Why the buffer should be flushed now: "rows", "bytes" or "deadline", or None if it should not
+        """
+        if not self.batches:
+            return None
+        if self.rows >= self.max_rows:
+            return "rows"
+        if self.bytes >= self.max_bytes:
+            return "bytes"
+        if self.timeout(now) == 0.0:
+            return "deadline"
+        return None
+
+    def timeout(self, now=None):
+        """Seconds until the deadline of the oldest buffered batch, or None if the buffer is empty"""
+        if not self.batches:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._since + self.max_delay - now)
+
+    def flush(self):
+        """
+        Empty the buffer
+        :return: List of the buffered batches, in the order they were added
+        """
+        batches = self.batches
+        self.batches = []
+        self.rows = 0
+        self.bytes = 0
+        self._since = None
+        return batches
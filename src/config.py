@@ -0,0 +1,50 @@
+import os
+import threading
+
+import log
+
+REQUIRED_VARS = ['ENVIO_GRAPHQL_URL', 'DUNE_API_KEY', 'DUNE_NAMESPACE']
+
+_loaded = False
+_lock = threading.Lock()
+
+
+def load():
+    """
+    Load .env into the environment, once per process. Variables already set in the
+    environment win over .env, so a scheduler or a benchmark can override any of them.
+    Modules call this when they are used rather than when they are imported.
+    """
+    global _loaded
+    if _loaded:
+        return
+    with _lock:
+        if _loaded:
+            return
+        from dotenv import load_dotenv
+        load_dotenv()
+        level = os.getenv('LOG_LEVEL')
+        if level:
+            log.set_level(level)
+        _loaded = True
+
+
+def missing(names=REQUIRED_VARS):
+    """
+    :param names: Environment variable names
+    :return: The names that are not set
+    """
+    load()
+    return [name for name in names if not os.getenv(name)]
+
+
+def summary():
+    """Configuration worth printing at startup"""
+    load()
+    return {
+        "ENVIO_GRAPHQL_URL": os.getenv('ENVIO_GRAPHQL_URL'),
+        "DUNE_NAMESPACE": os.getenv('DUNE_NAMESPACE'),
+        "DUNE_TABLE_NAME": os.getenv('DUNE_TABLE_NAME', 'swaps'),
+        "ENTITIES_PATH": os.getenv('ENTITIES_PATH'),
+        "BATCH_SIZE": os.getenv('BATCH_SIZE'),
+    }
@@ -1,52 +1,253 @@
 from datetime import datetime
+import calendar
+import threading
+import time
+from operator import itemgetter
+
+import numpy as np
+
+import log
+import metrics
+from entities import COLUMN_TRANSFORMS, SWAP
+from row_batch import RowBatch
+from token_metadata import TokenCache
+
+# Local UTC offsets only change on quarter-hour boundaries, so one lookup per quarter is exact
+_OFFSET_RESOLUTION = 900
+_MAX_TIMESTAMP = 253402300799  # 9999-12-31T23:59:59, the last value datetime can represent
+_MISSING = object()  # Stands in for a field absent from a row, unlike a field that is null
+
+
+def to_unix_timestamp(value):
+    """
+    Convert a timestamp read back from Dune into the Unix timestamp it was written from.
+    transform_swaps writes naive local-time ISO strings, so they are read back as local time.
+    value: Unix timestamp (int or digit string) or a Dune timestamp string
+    return: Unix timestamp as int, or None if value is empty
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return int(value)
+    text = str(value).replace(" UTC", "").replace("T", " ")
+    return int(datetime.fromisoformat(text).timestamp())
+
+
+def local_datetime64(timestamps):
+    """
+    Vectorized equivalent of datetime.fromtimestamp(ts) for whole-second timestamps
+    timestamps: int64 array of Unix timestamps
+    return: datetime64[s] array of naive local times
+    """
+    quarters, inverse = np.unique(timestamps // _OFFSET_RESOLUTION, return_inverse=True)
+    offsets = np.fromiter(
+        (calendar.timegm(time.localtime(int(q) * _OFFSET_RESOLUTION)) - int(q) * _OFFSET_RESOLUTION for q in quarters),
+        dtype=np.int64,
+        count=len(quarters)
+    )
+    return (timestamps + offsets[inverse.reshape(-1)]).astype("datetime64[s]")
+
+
+def local_isoformat(timestamps):
+    """
+    Vectorized equivalent of datetime.fromtimestamp(ts).isoformat() for whole-second timestamps
+    timestamps: int64 array of Unix timestamps
+    return: Array of naive local-time ISO strings
+    """
+    return np.datetime_as_string(local_datetime64(timestamps), unit="s")
+
+
+def _parse_column(values, parse, dtype):
+    """
+    Parse a column with the same builtin the row-by-row path used (int/float), so results
+    are bit-identical. Returns (array, invalid mask); the slow coercing path only runs
+    when the page contains a malformed value.
+    """
+    count = len(values)
+    try:
+        return np.fromiter(map(parse, values), dtype=dtype, count=count), np.zeros(count, dtype=bool)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    parsed = np.zeros(count, dtype=dtype)
+    invalid = np.zeros(count, dtype=bool)
+    for i, value in enumerate(values):
+        try:
+            parsed[i] = parse(value)
+        except (TypeError, ValueError, OverflowError):
+            invalid[i] = True
+    return parsed, invalid
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    if value in ("true", "false"):
+        return value == "true"
+    raise ValueError(f"Not a boolean: {value}")
+
+
+# Column type -> (parser, dtype) of the typed columns
+_PARSERS = {
+    "double": (float, np.float64),
+    "bigint": (int, np.int64),
+    "boolean": (_parse_bool, np.bool_),
+    "timestamp": (int, np.int64),
+}
+
 
 class DataTransformer:
+    def __init__(self, token_cache=None):
+        """
+        param token_cache: TokenCache enriching the token columns of entities that declare them.
+                           If not provided, one is opened on the first such page
+        """
+        self.token_cache = token_cache
+        self._token_cache_lock = threading.Lock()
+
     def transform_swaps(self, swaps):
         """
         Transform swap data from Envio format to Dune format
         swaps: List of swap dictionaries from Envio
         return: List of transformed swap dictionaries
         """
-        print("\nDebug: Data Transformer")
-        print(f"Number of swaps received: {len(swaps) if swaps else 0}")
-        
+        log.debug("Debug: Data Transformer, %d swaps received", len(swaps) if swaps else 0)
+
         if not swaps:
-            print("No swaps to transform")
+            log.debug("No swaps to transform")
             return []
-            
-        print("\nFirst swap from Envio:")
-        print(f"Keys: {swaps[0].keys()}")
-        print(f"Values: {swaps[0]}")
-        
-        transformed_swaps = []
-        for swap in swaps:
-            try:
-                # Convert Unix timestamp to ISO format
-                timestamp = int(swap["timeStamp"])
-                iso_timestamp = datetime.fromtimestamp(timestamp).isoformat()
-                
-                transformed_swap = {
-                    "id": swap["id"],
-                    "from": swap["from"],
-                    "token_in": swap["_tokenIn"],
-                    "token_out": swap["_tokenOut"],
-                    "amount_in": float(swap["_amountIn"]),
-                    "amount_out": float(swap["_amountOut"]),
-                    "timestamp": iso_timestamp
-                }
-                transformed_swaps.append(transformed_swap)
-            except KeyError as e:
-                print(f"Error transforming swap: Missing key {e}")
-                print(f"Swap data: {swap}")
-                continue
-            except ValueError as e:
-                print(f"Error converting values: {e}")
-                print(f"Swap data: {swap}")
-                continue
-        
-        print(f"\nTransformed {len(transformed_swaps)} swaps")
+
+        log.debug("First swap from Envio: %s", swaps[0])
+
+        transformed_swaps = list(self.transform_swaps_batch(swaps).dicts())
+
+        log.debug("Transformed %d swaps", len(transformed_swaps))
         if transformed_swaps:
-            print("\nFirst transformed swap:")
-            print(transformed_swaps[0])
-            
-        return transformed_swaps 
\ No newline at end of file
+            log.debug("First transformed swap: %s", transformed_swaps[0])
+
+        return transformed_swaps
+
+    def transform_swaps_batch(self, swaps):
+        """
+        Transform swap data from Envio format into a compact RowBatch
+        swaps: List of swap dictionaries from Envio
+        return: RowBatch with the Dune swaps columns
+        """
+        return self.transform_batch(swaps, SWAP)
+
+    def transform_swaps_columnar(self, swaps):
+        """
+        Transform a page of swaps into typed column arrays, see transform_columnar
+        swaps: List of swap dictionaries from Envio
+        return: Dictionary of Dune column name -> numpy array
+        """
+        return self.transform_columnar(swaps, SWAP)
+
+    def transform_batch(self, rows, entity):
+        """
+        Transform a page of any entity from Envio format into a compact RowBatch
+        rows: List of entity dictionaries from Envio
+        entity: EntitySpec describing the columns
+        return: RowBatch with the entity's Dune columns
+        """
+        with metrics.TRANSFORM_SECONDS.time():
+            columns = self.transform_columnar(rows, entity) if rows else {name: [] for name in entity.fieldnames}
+            batch = RowBatch.from_columns(columns, entity.fieldnames)
+        metrics.TRANSFORM_ROWS.inc(len(batch))
+        return batch
+
+    def transform_columnar(self, rows, entity):
+        """
+        Transform a page into typed column arrays in one pass.
+        Rows with a missing field or a value that does not parse are dropped
+        through a mask instead of per-row exception handling. A null value is
+        kept in a varchar column and does not parse in a typed column, whatever
+        else is in the page.
+        rows: List of entity dictionaries from Envio
+        entity: EntitySpec describing the columns
+        return: Dictionary of Dune column name -> numpy array (double as float64, bigint as int64,
+                boolean as bool, timestamp as local datetime64[s], varchar as str)
+        """
+        count = len(rows)
+        fields = entity.fields
+        try:
+            raw = [list(map(itemgetter(field), rows)) for field in fields]
+            invalid = np.zeros(count, dtype=bool)
+        except KeyError:
+            # At least one row misses a field: extract with a placeholder and mask those rows
+            raw = [[row.get(field, _MISSING) for row in rows] for field in fields]
+            invalid = np.zeros(count, dtype=bool)
+            for column in raw:
+                invalid |= np.fromiter((value is _MISSING for value in column), dtype=bool, count=count)
+        raw = dict(zip(fields, raw))
+
+        parsed = {}
+        for column in entity.columns:
+            if column.type in _PARSERS:
+                parse, dtype = _PARSERS[column.type]
+                values, bad = _parse_column(raw[column.field], parse, dtype)
+                if column.type == "timestamp":
+                    bad |= values > _MAX_TIMESTAMP
+                invalid |= bad
+                parsed[column.name] = values
+
+        if invalid.any():
+            dropped = int(invalid.sum())
+            metrics.TRANSFORM_DROPPED_ROWS.inc(dropped)
+            log.warning("Dropped %d %s rows with missing or malformed fields, first one: %s",
+                        dropped, entity.entity, rows[int(np.argmax(invalid))])
+
+        valid = ~invalid
+        columns = {}
+        for column in entity.columns:
+            if column.name in parsed:
+                values = parsed[column.name][valid]
+                columns[column.name] = local_datetime64(values) if column.type == "timestamp" else values
+                continue
+            values = np.array(raw[column.field], dtype=object)[valid]
+            if column.transform:
+                transform = COLUMN_TRANSFORMS[column.transform]
+                values = np.array([None if value is None else transform(str(value)) for value in values], dtype=object)
+            columns[column.name] = values
+        if entity.tokens:
+            self._enrich_tokens(columns, entity)
+        return columns
+
+    def _enrich_tokens(self, columns, entity):
+        """
+        Add the token columns of an entity: the metadata of each distinct address of the page
+        is looked up once, then spread to the rows by index. Rows of unknown tokens, or without
+        a token address, get NULLs.
+        columns: Dictionary of Dune column name -> numpy array, updated in place
+        entity: EntitySpec with tokens
+        """
+        with self._token_cache_lock:
+            if self.token_cache is None:
+                self.token_cache = TokenCache()
+        codes = {}  # Distinct address -> index, shared by the token columns of the page
+        indexes = {}
+        for token in entity.tokens:
+            values = columns[token.address]
+            indexes[token.address] = np.fromiter((codes.setdefault(value, len(codes)) for value in values.tolist()),
+                                                 dtype=np.int64, count=len(values))
+        metadata = self.token_cache.lookup([address for address in codes if address])
+        unknown = (None, None)
+        symbols = [metadata.get(address, unknown)[0] for address in codes]
+        decimals = [metadata.get(address, unknown)[1] for address in codes]
+        try:
+            # Fixed-width bytes when every symbol is known and ASCII, as RowBatch would store them
+            symbols = np.array(symbols, dtype="S" if None not in symbols else object)
+        except UnicodeEncodeError:
+            symbols = np.array(symbols, dtype=object)
+        known = np.array([value is not None for value in decimals], dtype=bool)
+        scale = np.power(10.0, np.array([value or 0 for value in decimals], dtype=np.int64))
+        decimals = np.array(decimals, dtype=np.int64 if known.all() else object)
+
+        for token in entity.tokens:
+            index = indexes[token.address]
+            columns[token.symbol] = symbols[index]
+            columns[token.decimals] = decimals[index]
+            if token.amount:
+                normalized = columns[token.amount] / scale[index]
+                if not known.all():
+                    normalized = np.where(known[index], normalized.astype(object), None)
+                columns[token.normalized] = normalized
@@ -0,0 +1,192 @@
+import math
+import os
+from collections import deque
+
+import numpy as np
+
+import log
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(values):
+    """splitmix64 finalizer, derives a second independent hash from the first"""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter of strings, backed by a numpy bit array and fed in batches.
+    Positions come from Python's string hash by double hashing, so a filter is only
+    meaningful within the process that built it.
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+        :param capacity: Number of keys the filter holds at the given error rate
+        :param error_rate: False positive rate once capacity keys were added
+        """
+        self.capacity = capacity
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = 1 << max(6, int(math.ceil(math.log2(bits))))  # A power of two, so positions are masked
+        self.hashes = max(1, int(round(bits / capacity * math.log(2))))
+        self.count = 0
+        self._bits = np.zeros(self.size // 8, dtype=np.uint8)
+        self._steps = np.arange(self.hashes, dtype=np.uint64)
+        self._mask = np.uint64(self.size - 1)
+
+    @property
+    def nbytes(self):
+        return self._bits.nbytes
+
+    def _positions(self, keys):
+        """(byte index, bit mask) arrays of shape (len(keys), hashes)"""
+        first = np.fromiter(map(hash, keys), dtype=np.int64, count=len(keys)).view(np.uint64)
+        second = _mix(first + _GOLDEN) | np.uint64(1)
+        positions = (first[:, None] + second[:, None] * self._steps) & self._mask
+        return positions >> np.uint64(3), np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+
+    def add(self, keys):
+        """Add a list of keys"""
+        if not keys:
+            return
+        indexes, masks = self._positions(keys)
+        indexes, masks = indexes.ravel(), masks.ravel()
+        # A plain scatter keeps one of several writes to the same byte, so set again the few
+        # bits that were lost; much cheaper than np.bitwise_or.at
+        while len(indexes):
+            self._bits[indexes] |= masks
+            lost = (self._bits[indexes] & masks) == 0
+            indexes, masks = indexes[lost], masks[lost]
+        self.count += len(keys)
+
+    def contains(self, keys):
+        """
+        :param keys: List of keys
+        :return: numpy bool array, True where the key was probably added, False where it certainly was not
+        """
+        if not keys:
+            return np.zeros(0, dtype=bool)
+        indexes, masks = self._positions(keys)
+        return (self._bits[indexes] & masks).all(axis=1)
+
+
+class DedupWindow:
+    """
+    Remembers the ids a sync has seen with a fixed memory budget, to drop rows the
+    indexer replays. Pages are read in (timestamp, id) order, so replays can only
+    come from around the cursor: ids whose timestamp is within window_seconds of the
+    newest one seen (the watermark) are kept in an exact set, one block per page.
+    Blocks entirely below the window, or the oldest ones once more than max_ids are
+    tracked, move to a Bloom filter; it has two generations of bloom_capacity ids
+    each and the older generation is dropped when the newer one fills, so memory
+    stays flat whatever the length of the history.
+
+    A row is a replay if its id is in the exact set, or if its timestamp is not newer
+    than the ids already moved out and the Bloom filter probably holds its id. Only
+    that last case can be wrong, dropping a new row with probability error_rate.
+    """
+
+    def __init__(self, window_seconds=None, max_ids=None, bloom_capacity=None, error_rate=None,
+                 cursor_field="timeStamp", id_field="id"):
+        """
+        :param window_seconds: Seconds below the watermark tracked exactly. If not provided, uses DEDUP_WINDOW_SECONDS from .env
+        :param max_ids: Most ids tracked exactly, give or take one page. If not provided, uses DEDUP_MAX_IDS from .env
+        :param bloom_capacity: Ids per Bloom filter generation. If not provided, uses DEDUP_BLOOM_CAPACITY from .env
+        :param error_rate: False positive rate of a full generation. If not provided, uses DEDUP_ERROR_RATE from .env
+        :param cursor_field: Field holding the Unix timestamp of a row
+        :param id_field: Field holding the unique id of a row
+        """
+        self.window_seconds = int(window_seconds or os.getenv('DEDUP_WINDOW_SECONDS', 3600))
+        self.max_ids = int(max_ids or os.getenv('DEDUP_MAX_IDS', 1000000))
+        self.bloom_capacity = int(bloom_capacity or os.getenv('DEDUP_BLOOM_CAPACITY', 1000000))
+        self.error_rate = float(error_rate or os.getenv('DEDUP_ERROR_RATE', 1e-6))
+        self.cursor_field = cursor_field
+        self.id_field = id_field
+        self.watermark = None
+        self._ids = set()
+        self._blocks = deque()  # (newest timestamp, ids) of each filtered page, oldest first
+        self._evicted_upto = None  # Newest timestamp moved to the Bloom filter
+        self._bloom = None  # Allocated on the first eviction
+        self._previous_bloom = None
+
+    def __len__(self):
+        """Ids tracked exactly"""
+        return len(self._ids)
+
+    @property
+    def nbytes(self):
+        """Bytes held by the Bloom filter generations"""
+        return sum(bloom.nbytes for bloom in (self._bloom, self._previous_bloom) if bloom is not None)
+
+    def filter(self, rows):
+        """
+        Drop rows whose id was already seen and remember the new ones
+        :param rows: List of rows from Envio, in cursor order
+        :return: List of the rows not seen before, in their original order
+        """
+        ids, cursor_field, id_field = self._ids, self.cursor_field, self.id_field
+        evicted_upto = self._evicted_upto
+        new_rows = []
+        block = []
+        older = []  # Rows not newer than the evicted ids, checked against the Bloom filter at once
+        for row in rows:
+            row_id = row[id_field]
+            if row_id in ids:
+                log.sampled("skip-processed", 1000, "Skipping already processed transaction: %s", row_id)
+                continue
+            if evicted_upto is not None and int(row[cursor_field]) <= evicted_upto:
+                older.append(row)
+                continue
+            ids.add(row_id)
+            block.append(row_id)
+            new_rows.append(row)
+
+        if older:
+            replayed = self._bloom_contains([row[id_field] for row in older])
+            kept = []
+            for row, seen in zip(older, replayed):
+                row_id = row[id_field]
+                if seen or row_id in ids:
+                    log.sampled("skip-processed", 1000, "Skipping already processed transaction: %s", row_id)
+                    continue
+                ids.add(row_id)
+                block.append(row_id)
+                kept.append(row)
+            # In a page in cursor order the older rows all come first
+            new_rows = kept + new_rows
+
+        if block:
+            newest = max(int(row[cursor_field]) for row in (new_rows[0], new_rows[-1]))
+            self._blocks.append((newest, block))
+            if self.watermark is None or newest > self.watermark:
+                self.watermark = newest
+            self._evict()
+        return new_rows
+
+    def _bloom_contains(self, keys):
+        seen = self._bloom.contains(keys)
+        if self._previous_bloom is not None:
+            seen |= self._previous_bloom.contains(keys)
+        return seen
+
+    def _evict(self):
+        blocks, floor = self._blocks, self.watermark - self.window_seconds
+        while blocks and (blocks[0][0] < floor or len(self._ids) - len(blocks[0][1]) >= self.max_ids):
+            newest, block = blocks.popleft()
+            self._ids.difference_update(block)
+            if self._evicted_upto is None or newest > self._evicted_upto:
+                self._evicted_upto = newest
+            if self._bloom is None:
+                self._bloom = BloomFilter(self.bloom_capacity, self.error_rate)
+            while block:
+                # Fill the current generation up to its capacity, then start a new one
+                room = self._bloom.capacity - self._bloom.count
+                self._bloom.add(block[:room])
+                block = block[room:]
+                if self._bloom.count >= self._bloom.capacity:
+                    self._previous_bloom, self._bloom = self._bloom, BloomFilter(self.bloom_capacity, self.error_rate)
@@ -1,11 +1,13 @@
 from dune_client import DuneClient
+from checkpoint_store import CheckpointStore
+from spill_queue import SpillQueue
+from upload_ledger import UploadLedger
 import os
-from dotenv import load_dotenv
 
-# Force reload of .env file
-load_dotenv(override=True)
+import config
 
 def delete_dune_table():
+    config.load()
     client = DuneClient()
     
     # Get configuration from environment variables
@@ -29,6 +31,10 @@ def delete_dune_table():
     
     if result:
         print(f"Successfully deleted table {namespace}.{table_name}")
+        # The local checkpoint points into the deleted table, drop it too
+        CheckpointStore().reset(f"{namespace}.{table_name}")
+        SpillQueue().discard(namespace, table_name)
+        UploadLedger().reset(f"{namespace}.{table_name}")
     else:
         print(f"Failed to delete table {namespace}.{table_name}")
 
@@ -1,32 +1,165 @@
 import requests
 import os
-from dotenv import load_dotenv
 import time
-import csv
-import io
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import urllib3
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
-load_dotenv()
+import config
+import log
+import metrics
+from data_transformer import local_datetime64
+from entities import SWAP
+from row_batch import RowBatch
+from payload_encoder import get_payload_format
+from rate_limiter import AdaptiveRateLimiter
+from upload_ledger import chunk_key
+
+
+def latest_row_query(namespace, table_name, entity=None):
+    """
+    DuneSQL selecting the id and timestamp of the newest row of a table
+    :param entity: Optional EntitySpec naming the id and timestamp columns. If not provided, uses Swap
+    :return: Query text returning latest_id and latest_timestamp
+    """
+    entity = entity or SWAP
+    return f"""
+        SELECT {entity.id_column} as latest_id, {entity.cursor_column} as latest_timestamp
+        FROM {namespace}.{table_name}
+        ORDER BY {entity.cursor_column} DESC, {entity.id_column} DESC
+        LIMIT 1
+        """
+
+
+def insert_chunks(data, entity=None, chunk_size=10000, with_keys=False):
+    """
+    Check that rows have the columns of an entity and cut them into insert chunks
+    :param data: RowBatch, or list of dictionaries
+    :param entity: Optional EntitySpec whose columns the data must have. If not provided, uses Swap
+    :param chunk_size: Rows per chunk
+    :param with_keys: Compute the upload ledger key of each chunk, see chunk_key
+    :return: (RowBatch, list of (start, stop, label, key) tuples), or None if required fields are missing
+    """
+    entity = entity or SWAP
+    if not isinstance(data, RowBatch):
+        data = RowBatch.from_dicts(data)
+    required_fields = entity.fieldnames
+    if len(data) and not all(field in data.fieldnames for field in required_fields):
+        missing_fields = [field for field in required_fields if field not in data.fieldnames]
+        log.error("Error: Missing required fields in data: %s", missing_fields)
+        return None
+    chunks = []
+    for i in range(0, len(data), chunk_size):
+        start, stop = i, min(i + chunk_size, len(data))
+        key = chunk_key(data, start, stop, entity.id_column) if with_keys else None
+        chunks.append((start, stop, f"chunk {i // chunk_size + 1}", key))
+    return data, chunks
+
+
+def insert_retryable(status, headers):
+    """
+    Whether a failed insert can be sent again: only these answers guarantee it was not applied,
+    any other error (a 500, or a gateway timeout) may come after the rows were stored
+    :param status: HTTP status code of the response
+    :param headers: Response headers
+    """
+    return status == 429 or (status == 503 and 'Retry-After' in headers)
+
+
+def connection_not_made(error):
+    """
+    Whether a requests ConnectionError was raised before the request could be sent: no connection
+    was opened. Any other one, e.g. a connection reset while waiting for the answer, may come
+    after Dune received and applied the insert
+    """
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectTimeout) or isinstance(
+        reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+
+def ledger_state(ledger, stream, key, skip_uploaded, label):
+    """
+    Look a chunk up in the upload ledger before it is sent, see DuneClient._upload_once
+    :return: "accepted" if the ledger records it as accepted (counted and logged), "in_flight" if an
+             earlier insert of it got no answer and may have been applied, or None to send it
+    """
+    if ledger is None or key is None or not skip_uploaded:
+        return None
+    if ledger.contains(stream, key):
+        metrics.DUNE_DUPLICATES_SKIPPED.inc()
+        log.info("Skipping %s: the upload ledger records it as already accepted by Dune", label)
+        return "accepted"
+    if ledger.in_flight(stream, key):
+        return "in_flight"
+    return None
+
+
+def ledger_resolve(ledger, stream, key, rows, label, applied):
+    """
+    Settle a chunk found in flight from what Dune holds
+    :param applied: True if Dune holds rows of the chunk, False if it holds none, None if that could not be checked
+    :return: "accepted" if it must not be sent again, "failed" if it cannot be sent yet, or None to send it
+    """
+    if applied is None:
+        log.warning("Could not check whether Dune applied an earlier insert of %s, it is not sent again yet", label)
+        return "failed"
+    if applied:
+        ledger.record(stream, key, rows or 0)
+        metrics.DUNE_DUPLICATES_SKIPPED.inc()
+        log.info("Skipping %s: Dune applied an earlier insert of it whose answer was lost", label)
+        return "accepted"
+    log.info("Sending %s again: Dune holds none of the rows of its earlier insert", label)
+    return None
+
+
+def chunk_rows_query(namespace, table_name, id_column, key):
+    """
+    DuneSQL counting the rows of a table holding the first or last id of a chunk. An insert
+    is applied as a whole, so any of them means an earlier insert of the chunk went through
+    :param key: (content hash, first id, last id) of the chunk, see chunk_key
+    :return: Query text returning found
+    """
+    ids = ", ".join("'" + str(row_id).replace("'", "''") + "'" for row_id in sorted(set(key[1:])))
+    return f"""
+        SELECT count(*) AS found
+        FROM {namespace}.{table_name}
+        WHERE CAST({id_column} AS varchar) IN ({ids})
+        """
+
 
 class DuneClient:
-    def __init__(self):
+    def __init__(self, ledger=None):
+        """
+        :param ledger: Optional UploadLedger consulted before each insert, so chunks Dune already accepted are skipped
+        """
+        config.load()
         self.api_key = os.getenv('DUNE_API_KEY')
-        self.base_url = "https://api.dune.com/api/v1"
+        self.base_url = os.getenv('DUNE_API_URL', "https://api.dune.com/api/v1").rstrip('/')
         self.batch_size = int(os.getenv('BATCH_SIZE', 10000))  # Default to 10000 if not set
-        print(f"DuneClient initialized with batch_size: {self.batch_size}")
+        self.payload_format = os.getenv('DUNE_PAYLOAD_FORMAT', 'csv')
+        log.debug("DuneClient initialized with batch_size: %d, payload_format: %s", self.batch_size, self.payload_format)
         self.headers = {
             "X-DUNE-API-KEY": self.api_key,
             "Content-Type": "application/json"
         }
-        # Configure retry strategy
+        # Requests per second and uploads in flight adapt to Dune's rate-limit responses
+        self.rate_limiter = AdaptiveRateLimiter()
+        # Configure retry strategy for idempotent requests; 429s are handled by the rate limiter
         self.session = requests.Session()
         retries = Retry(
             total=5,  # number of retries
             backoff_factor=1,  # wait 1, 2, 4, 8, 16 seconds between retries
-            status_forcelist=[500, 502, 503, 504, 404, 429]  # HTTP status codes to retry on
+            status_forcelist=[500, 502, 503, 504]  # HTTP status codes to retry on
         )
-        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+        pool_size = max(10, self.rate_limiter.max_concurrency * 2)
+        adapter = HTTPAdapter(max_retries=retries, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)  # DUNE_API_URL may point at a local stand-in
+        self.ledger = ledger
 
     def create_table(self, namespace, table_name, description, schema, is_private=False):
         """
@@ -61,25 +194,33 @@ class DuneClient:
             print(f"Error creating table in Dune: {e}")
             return None
 
-    def create_insert_query(self, namespace, table_name, data):
+    def create_insert_query(self, namespace, table_name, data, entity=None):
         """
         Create a query to insert data into a table
         :param namespace: Your Dune username
         :param table_name: Name of the table
         :param data: List of dictionaries containing the data to insert
+        :param entity: Optional EntitySpec giving the columns and their types. If not provided, uses Swap
         :return: Query ID if successful, None otherwise
         """
         endpoint = f"{self.base_url}/query/create"
+        entity = entity or SWAP
         
-        # Create SQL INSERT statement
+        # Create SQL INSERT statement; numbers and booleans are written bare, everything else quoted
         values = []
         for row in data:
-            value_str = f"('{row['id']}', '{row['from']}', '{row['token_in']}', '{row['token_out']}', {row['amount_in']}, {row['amount_out']}, '{row['timestamp']}')"
-            values.append(value_str)
+            value_str = ", ".join(
+                "NULL" if row[column.name] is None
+                else str(row[column.name]).lower() if column.type == "boolean"
+                else str(row[column.name]) if column.type in ("double", "bigint")
+                else f"'{row[column.name]}'"
+                for column in entity.dune_columns
+            )
+            values.append(f"({value_str})")
         
         insert_query = f"""
         INSERT INTO {namespace}.{table_name} 
-        (id, from, token_in, token_out, amount_in, amount_out, timestamp)
+        ({', '.join(entity.fieldnames)})
         VALUES {','.join(values)}
         """
         
@@ -90,10 +231,11 @@ class DuneClient:
         }
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 endpoint,
                 headers=self.headers,
-                json=payload
+                json=payload,
+                timeout=30
             )
             response.raise_for_status()
             return response.json().get('query_id')
@@ -110,9 +252,10 @@ class DuneClient:
         endpoint = f"{self.base_url}/query/{query_id}/execute"
         
         try:
-            response = requests.post(
+            response = self.session.post(
                 endpoint,
-                headers=self.headers
+                headers=self.headers,
+                timeout=30
             )
             response.raise_for_status()
             return response.json()
@@ -120,122 +263,224 @@ class DuneClient:
             print(f"Error executing query: {e}")
             return None
 
-    def upload_data(self, namespace, table_name, data, batch_size=None):
+    def upload_data(self, namespace, table_name, data, batch_size=None, payload_format=None, entity=None,
+                    skip_uploaded=True):
         """
-        Upload data to Dune Analytics using CSV format with retry logic for rate limits
+        Upload data to Dune Analytics with retry logic for rate limits
         :param namespace: Your Dune username
         :param table_name: Name of the table
-        :param data: List of dictionaries containing the data to upload
+        :param data: RowBatch, or list of dictionaries containing the data to upload
         :param batch_size: Optional batch size for chunking. If not provided, uses the value from .env
+        :param payload_format: Optional payload format name (csv, csv_gzip, ndjson, ndjson_gzip, parquet).
+                               If not provided, uses DUNE_PAYLOAD_FORMAT from .env
+        :param entity: Optional EntitySpec whose columns the data must have. If not provided, uses Swap
+        :param skip_uploaded: Skip chunks the upload ledger records as accepted; they are recorded either way
         :return: Response from Dune API
         """
         endpoint = f"{self.base_url}/table/{namespace}/{table_name}/insert"
-        
+        encoding = get_payload_format(payload_format or self.payload_format)
+        # Use provided batch_size or fall back to the one from .env
+        chunk_size = batch_size if batch_size is not None else self.batch_size
+        chunked = insert_chunks(data, entity, chunk_size, with_keys=self.ledger is not None)
+        if chunked is None:
+            return None
+        data, chunks = chunked
+        total_chunks = len(chunks)
+        id_column = (entity or SWAP).id_column
+
         # Debug logging for input data
-        print("\nDebug: Data being uploaded to Dune")
-        print(f"Number of records: {len(data)}")
-        if data:
-            print("\nFirst record structure:")
-            print(f"Keys: {data[0].keys()}")
-            print(f"Values: {data[0]}")
-            print("\nSample of first record values:")
-            for key, value in data[0].items():
-                print(f"{key}: {value} (type: {type(value)})")
-        
-        # Validate data structure
-        required_fields = ['id', 'from', 'token_in', 'token_out', 'amount_in', 'amount_out', 'timestamp']
-        if data and not all(field in data[0] for field in required_fields):
-            missing_fields = [field for field in required_fields if field not in data[0]]
-            print(f"Error: Missing required fields in data: {missing_fields}")
+        log.debug("Debug: Data being uploaded to Dune, %d records", len(data))
+        if len(data) and log.enabled(log.DEBUG):
+            log.debug("Columns: %s", data.fieldnames)
+            log.debug("First record: %s", data.row(0))
+        log.debug("Dune upload using chunk_size: %d, payload_format: %s", chunk_size, encoding.name)
+
+        # Update headers for the payload format
+        headers = encoding.headers(self.api_key)
+
+        def upload(start, stop, label):
+            return self._upload_chunk(
+                endpoint,
+                headers,
+                # The chunk is encoded block by block while it is being sent
+                lambda: encoding.iter_encode(data, start, stop),
+                lambda: encoding.encode(data, start, stop),
+                label,
+                rows=stop - start
+            )
+
+        # Chunks are uploaded concurrently; the rate limiter decides how many are actually in flight
+        with ThreadPoolExecutor(max_workers=self.rate_limiter.max_concurrency) as executor:
+            futures = []
+            for number, (start, stop, label, key) in enumerate(chunks, start=1):
+                log.debug("Uploading chunk %d of %d (%d records)...", number, total_chunks, stop - start)
+                futures.append(executor.submit(
+                    self._upload_once, f"{namespace}.{table_name}", key, skip_uploaded, label, stop - start,
+                    partial(upload, start, stop, label), partial(self.chunk_applied, namespace, table_name, id_column, key)
+                ))
+            responses = [future.result() for future in futures]
+
+        results = [response for response in responses if response is not None]
+        log.info("Uploaded %d of %d chunks, rate limiter: %s", len(results), total_chunks, self.rate_limiter.snapshot())
+        if len(results) < total_chunks:
+            # Never report a partial upload as a success, the caller has to retry or keep the rows
+            log.error("Error: %d chunks could not be uploaded", total_chunks - len(results))
             return None
-        
-        # Create CSV in memory
-        output = io.StringIO()
-        if data:
-            writer = csv.DictWriter(output, fieldnames=data[0].keys())
-            writer.writeheader()
-            writer.writerows(data)
-        
-        # Debug logging for CSV data
-        csv_data = output.getvalue()
-        print("\nDebug: First 500 characters of CSV data:")
-        print(csv_data[:500])
-        
-        # Update headers for CSV upload
-        headers = {
-            "X-DUNE-API-KEY": self.api_key,
-            "Content-Type": "text/csv"
-        }
-        
-        try:
-            # Use provided batch_size or fall back to the one from .env
-            chunk_size = batch_size if batch_size is not None else self.batch_size
-            print(f"\nDune upload using chunk_size: {chunk_size}")
-            total_records = len(data)
-            results = []
-            
-            for i in range(0, total_records, chunk_size):
-                chunk = data[i:i + chunk_size]
-                print(f"\nUploading chunk {i//chunk_size + 1} of {(total_records-1)//chunk_size + 1} ({len(chunk)} records)...")
-                
-                # Create CSV for this chunk
-                chunk_output = io.StringIO()
-                writer = csv.DictWriter(chunk_output, fieldnames=chunk[0].keys())
-                writer.writeheader()
-                writer.writerows(chunk)
-                
-                chunk_csv = chunk_output.getvalue()
-                print(f"Chunk CSV preview (first 200 chars):\n{chunk_csv[:200]}")
-                
-                # Retry logic for rate limits
-                max_retries = 5  # Maximum number of retries
-                base_delay = 5  # Base delay in seconds
-                retry_count = 0
-                success = False
-                
-                while not success and retry_count < max_retries:
+        return results
+
+    def upload_payload(self, namespace, table_name, path, payload_format, label=None, max_retries=5, rows=None,
+                       key=None, id_column=None):
+        """
+        Upload one already encoded chunk, e.g. from the spill queue
+        :param namespace: Your Dune username
+        :param table_name: Name of the table
+        :param path: File holding the encoded chunk
+        :param payload_format: Payload format name the chunk was encoded with
+        :param label: Optional name of the chunk for logging
+        :param max_retries: Maximum number of attempts
+        :param rows: Optional number of rows in the chunk, for the metrics
+        :param key: Optional (content hash, first id, last id) of the chunk for the upload ledger, see chunk_key
+        :param id_column: Optional column holding the ids of the key, to look the chunk up in Dune if an earlier
+                          insert of it may have been applied; without it such a chunk is sent again
+        :return: Response JSON from Dune, or None if the chunk could not be uploaded
+        """
+        endpoint = f"{self.base_url}/table/{namespace}/{table_name}/insert"
+        headers = get_payload_format(payload_format).headers(self.api_key)
+
+        def body():
+            # requests streams the open file and sends its size as Content-Length
+            return open(path, 'rb')
+
+        label = label or path
+        verify = partial(self.chunk_applied, namespace, table_name, id_column, key) if id_column else None
+        return self._upload_once(f"{namespace}.{table_name}", key, True, label, rows,
+                                 lambda: self._upload_chunk(endpoint, headers, body, None, label, max_retries, rows),
+                                 verify)
+
+    def _upload_once(self, stream, key, skip_uploaded, label, rows, upload, verify=None):
+        """
+        Run an upload unless the ledger records the chunk as accepted, and record it once it is.
+        The chunk is marked in flight before it is sent; a chunk found in flight, whose earlier
+        insert timed out or failed without a clear answer, is looked up in Dune first and only
+        sent again if Dune holds none of its rows
+        :param stream: "namespace.table_name" the chunk goes to
+        :param key: (content hash, first id, last id) of the chunk, or None to upload without the ledger
+        :param skip_uploaded: Whether a chunk found in the ledger is skipped or looked up
+        :param label: Name of the chunk for logging
+        :param rows: Number of rows in the chunk
+        :param upload: Function sending the chunk and returning the response JSON, or None on failure
+        :param verify: Optional function returning whether Dune holds rows of the chunk, see chunk_applied
+        :return: Response JSON from Dune, {"duplicate": True} for a skipped chunk, or None on failure
+        """
+        if self.ledger is None or key is None:
+            return upload()
+        state = ledger_state(self.ledger, stream, key, skip_uploaded, label)
+        if state == "in_flight":
+            # A chunk spooled without its id column cannot be looked up, it is sent again
+            applied = verify() if verify is not None else False
+            state = ledger_resolve(self.ledger, stream, key, rows, label, applied)
+        if state == "accepted":
+            return {"duplicate": True}
+        if state == "failed":
+            return None
+        self.ledger.begin(stream, key, rows or 0)
+        result = upload()
+        if result is not None:
+            self.ledger.record(stream, key, rows or 0)
+        return result
+
+    def chunk_applied(self, namespace, table_name, id_column, key):
+        """
+        Check whether Dune holds the rows of a chunk, after an insert of it got no clear answer
+        :param id_column: Column holding the ids of the key
+        :param key: (content hash, first id, last id) of the chunk, see chunk_key
+        :return: True if Dune holds its first or last row, False if neither, None if the query failed
+        """
+        rows = self.run_sql(chunk_rows_query(namespace, table_name, id_column, key), "in flight chunk query")
+        if rows is None:
+            return None
+        return bool(rows) and int(rows[0]['found']) > 0
+
+    def _upload_chunk(self, endpoint, headers, body, fallback_body, label, max_retries=5, rows=None):
+        """
+        Send one insert request, retrying throttled requests and connections that could not be opened
+        :param endpoint: Insert endpoint
+        :param headers: Request headers for the payload format
+        :param body: Function returning a fresh request body for each attempt
+        :param fallback_body: Optional function returning a bytes body, used if the server refuses a streamed body
+        :param label: Name of the chunk for logging
+        :param max_retries: Maximum number of attempts
+        :param rows: Optional number of rows in the chunk, for the metrics
+        :return: Response JSON from Dune, or None if the chunk could not be uploaded
+        """
+        base_delay = 5  # Base delay in seconds for connection errors
+
+        latency = metrics.DUNE_REQUEST_SECONDS.labels("insert")
+        for attempt in range(1, max_retries + 1):
+            try:
+                with self.rate_limiter.slot(), latency.time():
+                    data = body()
                     try:
                         response = self.session.post(
                             endpoint,
                             headers=headers,
-                            data=chunk_csv.encode('utf-8'),
+                            data=metrics.count_bytes(data),
                             timeout=120  # 120 second timeout for larger chunks
                         )
-                        
-                        if response.status_code == 200:
-                            success = True
-                            results.append(response.json())
-                            print(f"Successfully uploaded chunk {i//chunk_size + 1}")
-                        else:
-                            response.raise_for_status()
-                            
-                    except requests.exceptions.RequestException as e:
-                        error_message = str(e)
-                        if "too many requests" in error_message.lower():
-                            retry_count += 1
-                            if retry_count < max_retries:
-                                # Calculate exponential backoff delay
-                                delay = base_delay * (2 ** (retry_count - 1))
-                                print(f"Rate limit hit. Retrying in {delay} seconds... (Attempt {retry_count + 1}/{max_retries})")
-                                time.sleep(delay)
-                            else:
-                                print(f"Max retries reached for chunk {i//chunk_size + 1}. Moving to next chunk.")
-                                break
-                        else:
-                            print(f"Error uploading chunk {i//chunk_size + 1}: {e}")
-                            break
-                
-                # Add a small delay between chunks to avoid rate limiting
-                if i + chunk_size < total_records:
-                    time.sleep(2)
-            
-            return results
-        except requests.exceptions.RequestException as e:
-            print(f"\nError uploading data to Dune: {e}")
-            if hasattr(e.response, 'text'):
-                print(f"Error response: {e.response.text}")
+                    finally:
+                        if hasattr(data, 'close'):
+                            data.close()
+                    if response.status_code == 411 and fallback_body is not None:
+                        # The server refused a chunked body: send the chunk with a Content-Length instead
+                        response = self.session.post(
+                            endpoint,
+                            headers=headers,
+                            data=metrics.count_bytes(fallback_body()),
+                            timeout=120
+                        )
+            except requests.exceptions.ConnectionError as e:
+                metrics.DUNE_REQUESTS.labels("insert", "connection_error").inc()
+                if not connection_not_made(e):
+                    # The connection broke after the insert was sent, it may have been applied
+                    log.error("Error uploading %s: %s", label, e)
+                    return None
+                metrics.DUNE_RETRIES.labels("connection_error").inc()
+                delay = base_delay * (2 ** (attempt - 1))
+                log.warning("Connection error on %s: %s. Retrying in %d seconds... (Attempt %d/%d)", label, e, delay, attempt + 1, max_retries)
+                time.sleep(delay)
+                continue
+            except requests.exceptions.RequestException as e:
+                metrics.DUNE_REQUESTS.labels("insert", "error").inc()
+                # A timed out insert may still have been applied, so it is not replayed blindly
+                log.error("Error uploading %s: %s", label, e)
+                return None
+
+            metrics.DUNE_REQUESTS.labels("insert", response.status_code).inc()
+            if response.status_code == 200:
+                self.rate_limiter.on_success(response.headers)
+                self._record_limiter()
+                if rows:
+                    metrics.DUNE_ROWS_UPLOADED.inc(rows)
+                log.debug("Successfully uploaded %s", label)
+                return response.json()
+            if insert_retryable(response.status_code, response.headers):
+                metrics.DUNE_THROTTLED.inc()
+                metrics.DUNE_RETRIES.labels("throttled").inc()
+                delay = self.rate_limiter.on_throttled(response.headers)
+                self._record_limiter()
+                log.warning("Rate limit hit on %s. All uploads paused for %.1f seconds... (Attempt %d/%d)", label, delay, attempt + 1, max_retries)
+                continue
+            log.error("Error uploading %s: %d %s", label, response.status_code, response.text)
             return None
 
+        log.error("Max retries reached for %s", label)
+        return None
+
+    def _record_limiter(self):
+        snapshot = self.rate_limiter.snapshot()
+        metrics.DUNE_RATE.set(min(snapshot["rate"], snapshot["quota_rate"] or snapshot["rate"]))
+        metrics.DUNE_CONCURRENCY.set(snapshot["concurrency"])
+
     def delete_table(self, namespace, table_name):
         """
         Delete a table from Dune Analytics
@@ -276,43 +521,95 @@ class DuneClient:
         except requests.exceptions.RequestException:
             return False
 
-    def get_latest_id(self, namespace, table_name):
-        """
-        Get the latest transaction hash and timestamp from a Dune table
-        :param namespace: Your Dune username
-        :param table_name: Name of the table
-        :return: Tuple of (latest transaction hash, latest timestamp) or (None, None) if table is empty
+    def run_sql(self, query, description="query"):
         """
-        query = f"""
-        SELECT id as latest_id, timestamp as latest_timestamp
-        FROM {namespace}.{table_name}
-        ORDER BY timestamp DESC
-        LIMIT 1
+        Run a SQL query on Dune and return its result rows
+        :param query: DuneSQL text
+        :param description: What the query does, for the error message
+        :return: List of row dictionaries, or None if the query failed
         """
-        
         endpoint = f"{self.base_url}/query/execute"
         payload = {
             "query": query,
             "parameters": {}
         }
-        
+
         try:
             response = self.session.post(
                 endpoint,
                 headers=self.headers,
                 json=payload,
-                timeout=30
+                timeout=300
             )
             response.raise_for_status()
-            result = response.json()
-            
-            # Extract results from the response
-            if 'result' in result and 'rows' in result['result'] and result['result']['rows']:
-                row = result['result']['rows'][0]
-                latest_id = row.get('latest_id')
-                latest_timestamp = row.get('latest_timestamp')
-                return latest_id, latest_timestamp
-            return None, None
+            return (response.json().get('result') or {}).get('rows') or []
         except requests.exceptions.RequestException as e:
-            print(f"Error getting latest transaction data from Dune: {e}")
-            return None, None 
\ No newline at end of file
+            print(f"Error running {description} on Dune: {e}")
+            return None
+
+    def get_latest_id(self, namespace, table_name, entity=None):
+        """
+        Get the latest transaction hash and timestamp from a Dune table
+        :param namespace: Your Dune username
+        :param table_name: Name of the table
+        :param entity: Optional EntitySpec naming the id and timestamp columns. If not provided, uses Swap
+        :return: Tuple of (latest transaction hash, latest timestamp) or (None, None) if table is empty
+        """
+        rows = self.run_sql(latest_row_query(namespace, table_name, entity), "latest transaction query")
+        if rows:
+            return rows[0].get('latest_id'), rows[0].get('latest_timestamp')
+        return None, None
+
+    def get_bucket_digests(self, namespace, table_name, bounds, entity=None):
+        """
+        Count the rows of consecutive time ranges of a table and digest their ids with one grouped query.
+        The digest is the sum of the CRC32 of every id, so it does not depend on row order and
+        counts duplicates; see reconcile.id_digest for the same digest on the Envio side.
+        :param namespace: Your Dune username
+        :param table_name: Name of the table
+        :param bounds: Ascending Unix timestamps b0 < b1 < ... < bn, range i is [b_i, b_i+1)
+        :param entity: Optional EntitySpec naming the id and timestamp columns. If not provided, uses Swap
+        :return: List of n (count, digest) tuples, or None if the query failed
+        """
+        entity = entity or SWAP
+        # Timestamps are stored as naive local times, which Dune reads as UTC: shift the bounds the same way
+        edges = [int(edge) for edge in local_datetime64(np.array(bounds, dtype=np.int64)).astype(np.int64)]
+        query = f"""
+        SELECT width_bucket(to_unixtime({entity.cursor_column}), CAST(ARRAY[{', '.join(map(str, edges))}] AS ARRAY(DOUBLE))) AS bucket,
+               count(*) AS row_count,
+               sum(crc32(to_utf8({entity.id_column}))) AS id_digest
+        FROM {namespace}.{table_name}
+        WHERE {entity.cursor_column} >= from_unixtime({edges[0]}) AND {entity.cursor_column} < from_unixtime({edges[-1]})
+        GROUP BY 1
+        """
+        rows = self.run_sql(query, "bucket digest query")
+        if rows is None:
+            return None
+        buckets = [(0, 0)] * (len(bounds) - 1)
+        for row in rows:
+            index = int(row['bucket']) - 1
+            if 0 <= index < len(buckets):
+                buckets[index] = (int(row['row_count']), int(row['id_digest'] or 0))
+        return buckets
+
+    def get_ids(self, namespace, table_name, start, end, entity=None):
+        """
+        List the ids of a table in a time range, duplicates included
+        :param namespace: Your Dune username
+        :param table_name: Name of the table
+        :param start: Inclusive Unix timestamp
+        :param end: Exclusive Unix timestamp
+        :param entity: Optional EntitySpec naming the id and timestamp columns. If not provided, uses Swap
+        :return: List of ids, or None if the query failed
+        """
+        entity = entity or SWAP
+        low, high = (int(edge) for edge in local_datetime64(np.array([start, end], dtype=np.int64)).astype(np.int64))
+        query = f"""
+        SELECT {entity.id_column} AS id
+        FROM {namespace}.{table_name}
+        WHERE {entity.cursor_column} >= from_unixtime({low}) AND {entity.cursor_column} < from_unixtime({high})
+        """
+        rows = self.run_sql(query, "id query")
+        if rows is None:
+            return None
+        return [row['id'] for row in rows]
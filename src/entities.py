@@ -0,0 +1,330 @@
+import json
+import os
+
+# Dune column types the transformer knows how to produce
+COLUMN_TYPES = ("varchar", "double", "bigint", "boolean", "timestamp")
+
+# Transforms applied to the raw Envio string values of a varchar column before it is stored
+COLUMN_TRANSFORMS = {
+    "lower": str.lower,
+    "upper": str.upper,
+    "strip": str.strip,
+}
+
+
+class Column:
+    """
+    One column of a Dune table and the Envio field it is read from
+    """
+    __slots__ = ("name", "field", "type", "transform")
+
+    def __init__(self, name, field=None, type="varchar", transform=None):
+        """
+        :param name: Dune column name
+        :param field: Envio field name. If not provided, same as the column name
+        :param type: One of COLUMN_TYPES. timestamp columns read Unix seconds and are written as local time
+        :param transform: Optional name of a COLUMN_TRANSFORMS entry, for varchar columns
+        """
+        if type not in COLUMN_TYPES:
+            raise ValueError(f"Unknown column type {type} for {name}, expected one of {', '.join(COLUMN_TYPES)}")
+        if transform is not None and transform not in COLUMN_TRANSFORMS:
+            raise ValueError(f"Unknown transform {transform} for {name}, expected one of {', '.join(COLUMN_TRANSFORMS)}")
+        self.name = name
+        self.field = field or name
+        self.type = type
+        self.transform = transform
+
+
+class TokenColumns:
+    """
+    Token metadata added to the rows of an entity: the symbol and decimals of the token
+    in one address column, and optionally an amount column scaled by those decimals.
+    The values come from the token metadata cache, not from Envio.
+    """
+    __slots__ = ("address", "amount", "symbol", "decimals", "normalized")
+
+    def __init__(self, address, amount=None, symbol=None, decimals=None, normalized=None):
+        """
+        :param address: Dune column holding the token address
+        :param amount: Optional Dune column holding a raw token amount
+        :param symbol: Name of the symbol column. If not provided, "<address>_symbol"
+        :param decimals: Name of the decimals column. If not provided, "<address>_decimals"
+        :param normalized: Name of the scaled amount column. If not provided, "<amount>_normalized"
+        """
+        self.address = address
+        self.amount = amount
+        self.symbol = symbol or f"{address}_symbol"
+        self.decimals = decimals or f"{address}_decimals"
+        self.normalized = (normalized or f"{amount}_normalized") if amount else None
+
+    @property
+    def columns(self):
+        """Dune columns added to the table"""
+        columns = [Column(self.symbol), Column(self.decimals, type="bigint")]
+        if self.amount:
+            columns.append(Column(self.normalized, type="double"))
+        return columns
+
+
+class RollupSpec:
+    """
+    Hourly aggregate of an entity kept in a companion Dune table: per hour of the time
+    column and distinct combination of the group columns, the number of rows, the sums
+    of some numeric columns and the number of distinct values of one column
+    """
+    __slots__ = ("table_name", "time_column", "group_by", "count", "sums", "distinct")
+
+    def __init__(self, table_name=None, time_column="timestamp", group_by=("token_in", "token_out"), count="swaps",
+                 sums=(("volume_in", "amount_in"), ("volume_out", "amount_out")), distinct=("unique_senders", "from")):
+        """
+        The defaults roll swaps up by token pair
+        :param table_name: Dune table of the rollup. If not provided, "<entity table>_hourly"
+        :param time_column: timestamp column the rows are bucketed by
+        :param group_by: varchar columns forming the key of a rollup row with the hour
+        :param count: Name of the row count column
+        :param sums: List of (rollup column, summed column) pairs
+        :param distinct: Optional (rollup column, counted column) pair of the distinct value count
+        """
+        self.table_name = table_name
+        self.time_column = time_column
+        self.group_by = tuple(group_by)
+        self.count = count
+        self.sums = tuple(tuple(pair) for pair in sums)
+        self.distinct = tuple(distinct) if distinct else None
+
+    @property
+    def schema(self):
+        """Column definitions of the rollup table; delta_seq numbers the delta rows"""
+        return ([{"name": "hour", "type": "timestamp"}]
+                + [{"name": name, "type": "varchar"} for name in self.group_by]
+                + [{"name": self.count, "type": "bigint"}]
+                + [{"name": name, "type": "double"} for name, _ in self.sums]
+                + ([{"name": self.distinct[0], "type": "bigint"}] if self.distinct else [])
+                + [{"name": "delta_seq", "type": "bigint"}])
+
+    @property
+    def fieldnames(self):
+        return [column["name"] for column in self.schema]
+
+
+class EntitySpec:
+    """
+    Declarative description of one indexer entity synced to one Dune table: the
+    fields queried from Envio, the Dune columns they become with their types and
+    transforms, and the (timestamp, id) fields the keyset cursor is built from.
+    Every query, schema and column list of the sync is derived from it. Token columns
+    optionally enrich the rows with token symbols, decimals and scaled amounts, and a
+    rollup describes an hourly aggregate kept next to the table.
+    """
+
+    def __init__(self, entity, table_name, columns, description=None, cursor_field="timeStamp", id_field="id",
+                 tokens=None, rollup=None):
+        """
+        :param entity: Envio entity name, e.g. "Swap"
+        :param table_name: Dune table the entity is synced to
+        :param columns: List of Column, in Dune column order
+        :param description: Description of the Dune table
+        :param cursor_field: Envio field holding the Unix timestamp the sync is ordered by
+        :param id_field: Envio field holding the unique id that breaks timestamp ties
+        :param tokens: Optional list of TokenColumns, added after the columns
+        :param rollup: Optional RollupSpec, maintained when the sync runs with rollups
+        """
+        self.entity = entity
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.description = description or f"{entity} data from Envio indexer"
+        self.cursor_field = cursor_field
+        self.id_field = id_field
+        by_field = {column.field: column for column in self.columns}
+        for field in (cursor_field, id_field):
+            if field not in by_field:
+                raise ValueError(f"{entity} spec has no column for its cursor field {field}")
+        self.cursor_column = by_field[cursor_field].name
+        self.id_column = by_field[id_field].name
+        self.tokens = list(tokens or [])
+        types = {column.name: column.type for column in self.columns}
+        for token in self.tokens:
+            if types.get(token.address) != "varchar":
+                raise ValueError(f"{entity} token columns need a varchar address column, got {token.address}")
+            if token.amount and types.get(token.amount) not in ("double", "bigint"):
+                raise ValueError(f"{entity} token columns need a double or bigint amount column, got {token.amount}")
+        self.rollup = rollup
+        if rollup is not None:
+            types = {column.name: column.type for column in self.dune_columns}
+            expected = [(rollup.time_column, ("timestamp",))]
+            expected += [(name, ("varchar",)) for name in rollup.group_by]
+            expected += [(column, ("double", "bigint")) for _, column in rollup.sums]
+            expected += [(rollup.distinct[1], ("varchar",))] if rollup.distinct else []
+            for name, allowed in expected:
+                if types.get(name) not in allowed:
+                    raise ValueError(f"{entity} rollup needs a {' or '.join(allowed)} column {name}")
+
+    @property
+    def dune_columns(self):
+        """Every Dune column in table order: the columns read from Envio, then the token columns"""
+        return self.columns + [column for token in self.tokens for column in token.columns]
+
+    @property
+    def rollup_table(self):
+        """Dune table of the rollup, or None without one"""
+        if self.rollup is None:
+            return None
+        return self.rollup.table_name or f"{self.table_name}_hourly"
+
+    @property
+    def fieldnames(self):
+        """Dune column names, in table order"""
+        return [column.name for column in self.dune_columns]
+
+    @property
+    def fields(self):
+        """Envio fields to query, each once"""
+        return list(dict.fromkeys(column.field for column in self.columns))
+
+    @property
+    def schema(self):
+        """Column definitions for DuneClient.create_table"""
+        return [{"name": column.name, "type": column.type} for column in self.dune_columns]
+
+    @property
+    def page_query(self):
+        """GraphQL query of one page ordered by (cursor field, id field) after a where expression"""
+        return """
+            query Get%(entity)sAfter($limit: Int!, $where: %(entity)s_bool_exp!) {
+                %(entity)s(limit: $limit, where: $where, order_by: [{%(cursor)s: asc}, {%(id)s: asc}]) {
+                    %(fields)s
+                }
+            }
+        """ % {"entity": self.entity, "cursor": self.cursor_field, "id": self.id_field,
+               "fields": "\n                    ".join(self.fields)}
+
+    @property
+    def stats_query(self):
+        """GraphQL aggregate query of the row count and cursor field range after a where expression"""
+        return """
+            query Get%(entity)sStats($where: %(entity)s_bool_exp!) {
+                %(entity)s_aggregate(where: $where) {
+                    aggregate {
+                        count
+                        min { %(cursor)s }
+                        max { %(cursor)s }
+                    }
+                }
+            }
+        """ % {"entity": self.entity, "cursor": self.cursor_field}
+
+    def count_query(self, buckets):
+        """
+        GraphQL query counting the rows of several cursor field ranges in one request:
+        aliases b0..b{n-1} aggregate over the where expressions $w0..$w{n-1}
+        """
+        variables = ", ".join(f"$w{i}: {self.entity}_bool_exp!" for i in range(buckets))
+        fields = "\n".join(f"                b{i}: {self.entity}_aggregate(where: $w{i}) {{ aggregate {{ count }} }}"
+                           for i in range(buckets))
+        return f"""
+            query Count{self.entity}Buckets({variables}) {{
+{fields}
+            }}
+        """
+
+    def keys(self):
+        """The same entity reduced to its cursor and id columns, for scans that only need the ids"""
+        columns = [column for column in self.columns if column.name in (self.cursor_column, self.id_column)]
+        return EntitySpec(self.entity, self.table_name, columns, self.description, self.cursor_field, self.id_field)
+
+    def dune_id(self, row):
+        """The id of a row as it is stored in Dune, after the transform of its column"""
+        column = next(column for column in self.columns if column.name == self.id_column)
+        value = str(row[self.id_field])
+        return COLUMN_TRANSFORMS[column.transform](value) if column.transform else value
+
+    def cursor(self, row):
+        """
+        Build the pagination cursor for a row
+        :param row: Entity dictionary from Envio
+        :return: (timestamp, id) tuple
+        """
+        return int(row[self.cursor_field]), row[self.id_field]
+
+    def where(self, cursor, until=None):
+        """
+        Build the bool_exp selecting rows strictly after a (timestamp, id) cursor.
+        The _gte bound keeps the indexer on the timestamp index, the _or breaks ties by id.
+        :param cursor: (timestamp, id) tuple or None
+        :param until: Optional exclusive upper bound on the cursor field
+        :return: where expression for the GraphQL query
+        """
+        where = {}
+        if cursor is not None:
+            timestamp, row_id = cursor
+            where[self.cursor_field] = {"_gte": timestamp}
+            where["_or"] = [
+                {self.cursor_field: {"_gt": timestamp}},
+                {self.id_field: {"_gt": row_id}}
+            ]
+        if until is not None:
+            where.setdefault(self.cursor_field, {})["_lt"] = until
+        return where
+
+    def with_table(self, table_name):
+        """The same entity synced to another Dune table"""
+        return EntitySpec(self.entity, table_name, self.columns, self.description, self.cursor_field, self.id_field,
+                          self.tokens, self.rollup)
+
+    @classmethod
+    def from_dict(cls, spec):
+        """
+        Build a spec from its JSON form:
+        {"entity": "Swap", "table": "swaps", "description": "...", "cursor_field": "timeStamp", "id_field": "id",
+         "columns": [{"name": "token_in", "field": "_tokenIn", "type": "varchar", "transform": "lower"}, ...],
+         "tokens": [{"address": "token_in", "amount": "amount_in"}, ...],
+         "rollup": {"table": "swaps_hourly", "time": "timestamp", "group_by": ["token_in", "token_out"],
+                    "count": "swaps", "sums": {"volume_in": "amount_in"}, "distinct": {"unique_senders": "from"}}}
+        """
+        columns = [Column(column["name"], column.get("field"), column.get("type", "varchar"), column.get("transform"))
+                   for column in spec["columns"]]
+        tokens = [TokenColumns(token["address"], token.get("amount"), token.get("symbol"), token.get("decimals"),
+                               token.get("normalized"))
+                  for token in spec.get("tokens", [])]
+        rollup = None
+        if "rollup" in spec:
+            fields = spec["rollup"]
+            defaults = RollupSpec()
+            rollup = RollupSpec(
+                fields.get("table"), fields.get("time", defaults.time_column), fields.get("group_by", defaults.group_by),
+                fields.get("count", defaults.count),
+                list(fields["sums"].items()) if "sums" in fields else defaults.sums,
+                next(iter((fields["distinct"] or {}).items()), None) if "distinct" in fields else defaults.distinct
+            )
+        return cls(spec["entity"], spec.get("table") or spec["entity"].lower(), columns, spec.get("description"),
+                   spec.get("cursor_field", "timeStamp"), spec.get("id_field", "id"), tokens, rollup)
+
+
+# The Swap entity, in the column order of the Dune swaps table
+SWAP = EntitySpec("Swap", "swaps", [
+    Column("id"),
+    Column("from"),
+    Column("token_in", "_tokenIn"),
+    Column("token_out", "_tokenOut"),
+    Column("amount_in", "_amountIn", "double"),
+    Column("amount_out", "_amountOut", "double"),
+    Column("timestamp", "timeStamp", "timestamp"),
+], description="Swap data from Envio indexer", rollup=RollupSpec())
+
+
+def load_entities(path=None):
+    """
+    Load the entities to sync
+    :param path: JSON file with an "entities" list of specs, see EntitySpec.from_dict.
+                 If not provided, uses ENTITIES_PATH from .env
+    :return: List of EntitySpec; without a file, only Swap synced to DUNE_TABLE_NAME
+    """
+    path = path or os.getenv('ENTITIES_PATH')
+    if not path:
+        return [SWAP.with_table(os.getenv('DUNE_TABLE_NAME', 'swaps'))]
+    with open(path) as f:
+        specs = [EntitySpec.from_dict(spec) for spec in json.load(f)["entities"]]
+    tables = [spec.table_name for spec in specs] + [spec.rollup_table for spec in specs if spec.rollup]
+    if len(set(tables)) != len(tables):
+        raise ValueError(f"{path} syncs several entities to the same Dune table")
+    return specs
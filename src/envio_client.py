@@ -1,39 +1,195 @@
+import os
+import threading
+
+import requests
 from gql import gql, Client
 from gql.transport.requests import RequestsHTTPTransport
-import os
-from dotenv import load_dotenv
+from graphql import GraphQLError, get_introspection_query
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Print current working directory to verify .env location
-print(f"Current working directory: {os.getcwd()}")
+import config
+import graphql_stream
+import log
+import metrics
+from schema_cache import SchemaCache
 
-# Load environment variables
-load_dotenv()
+SWAP_FIELDS = """
+                    id
+                    timeStamp
+                    _tokenIn
+                    _tokenOut
+                    _amountIn
+                    _amountOut
+                    from
+"""
+
+GET_SWAPS_QUERY = """
+            query GetSwaps($limit: Int!, $offset: Int!) {
+                Swap(limit: $limit, offset: $offset) {%s}
+            }
+""" % SWAP_FIELDS
+
+# Query documents are parsed, and raw request bodies compiled (see graphql_stream.request_body),
+# once per process rather than on every call
+COUNT_BUCKETS_PER_QUERY = 50  # Aliased aggregates sent in one count request
+
+_documents = {}
+
+
+def _document(query):
+    document = _documents.get(query)
+    if document is None:
+        document = _documents[query] = gql(query)
+    return document
+
+
+def _response_detail(error):
+    """Status and text of the HTTP response an exception carries, appended to its log line"""
+    if not hasattr(error, 'response'):
+        return ""
+    response = error.response
+    status = response.status_code if hasattr(response, 'status_code') else 'N/A'
+    text = response.text if hasattr(response, 'text') else 'N/A'
+    return f" (response status: {status}, text: {text})"
 
-# Print all environment variables for debugging
-print("Environment variables:")
-print(f"ENVIO_GRAPHQL_URL: {os.getenv('ENVIO_GRAPHQL_URL')}")
-print(f"BATCH_SIZE: {os.getenv('BATCH_SIZE')}")
 
 class EnvioClient:
-    def __init__(self):
-        graphql_url = os.getenv('ENVIO_GRAPHQL_URL')
+    def __init__(self, graphql_url=None, schema_cache=None):
+        """
+        Nothing is sent until the first query: the GraphQL client is built on first use,
+        from the cached schema when there is a valid one
+        param graphql_url: GraphQL endpoint. If not provided, uses ENVIO_GRAPHQL_URL from .env
+        param schema_cache: SchemaCache of the introspected schema. If not provided, uses ENVIO_SCHEMA_CACHE from .env
+        """
+        config.load()
+        graphql_url = graphql_url or os.getenv('ENVIO_GRAPHQL_URL')
         if not graphql_url:
             raise ValueError("ENVIO_GRAPHQL_URL not set in environment variables")
-            
-        print(f"Initializing EnvioClient with GraphQL URL: {graphql_url}")
-        
-        # Verify the URL format
-        if not graphql_url.startswith('https://'):
+
+        log.debug("Initializing EnvioClient with GraphQL URL: %s", graphql_url)
+
+        # Verify the URL format, plain http is only accepted for a local indexer
+        if not graphql_url.startswith(('https://', 'http://localhost', 'http://127.0.0.1')):
             raise ValueError(f"Invalid GraphQL URL format: {graphql_url}")
-            
+
+        self.graphql_url = graphql_url
+        self.schema_cache = schema_cache or SchemaCache()
+        self.batch_size = int(os.getenv('BATCH_SIZE', 10000))  # Default to 10000 if not set
+        # "gql" validates queries against the schema; "raw" posts a precompiled query on a pooled
+        # session and decodes the Swap array incrementally while the response is arriving
+        self.fetch_mode = os.getenv('ENVIO_FETCH_MODE', 'gql')
+        if self.fetch_mode not in ('gql', 'raw'):
+            raise ValueError(f"Invalid ENVIO_FETCH_MODE: {self.fetch_mode}, expected gql or raw")
+        self._session = None
+        self._client = None
+        self._schema_from_cache = False
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """Connected gql client session, built on first use and kept open so pages reuse its connections"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._build_client()
+        return self._client
+
+    def _build_client(self, refresh=False):
+        """
+        Build the gql Client with a known schema, so queries are validated locally
+        without an introspection round-trip on every start, and connect it. Client.execute
+        would open and close a requests session around every query.
+        param refresh: Ignore the cached schema and introspect the endpoint again
+        return: gql SyncClientSession
+        """
         transport = RequestsHTTPTransport(
-            url=graphql_url,
+            url=self.graphql_url,
             headers={},
             verify=True,
             retries=3  # Add retries for better reliability
         )
-        self.client = Client(transport=transport, fetch_schema_from_transport=True)
-        self.batch_size = int(os.getenv('BATCH_SIZE', 10000))  # Default to 10000 if not set
+        introspection = None if refresh else self.schema_cache.load(self.graphql_url)
+        self._schema_from_cache = introspection is not None
+        if introspection is None:
+            with metrics.ENVIO_REQUEST_SECONDS.labels("introspection").time():
+                introspection = Client(transport=transport).execute(gql(get_introspection_query()))
+            self.schema_cache.save(self.graphql_url, introspection)
+        return Client(transport=transport, introspection=introspection).connect_sync()
+
+    def close(self):
+        """Close the connections kept open to the indexer"""
+        with self._client_lock:
+            if self._client is not None:
+                self._client.client.close_sync()
+                self._client = None
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    @property
+    def session(self):
+        """requests Session of the raw fetch path, keeping connections to the indexer alive between pages"""
+        if self._session is None:
+            with self._client_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    # Same retries as the gql transport; queries are read-only, so POSTs are retried too
+                    retries = Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504],
+                                    allowed_methods=None)
+                    adapter = HTTPAdapter(max_retries=retries, pool_maxsize=4)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers.update({"Content-Type": "application/json", "Accept-Encoding": "gzip"})
+                    self._session = session
+        return self._session
+
+    def _execute(self, operation, query, variables):
+        """
+        Run a GraphQL query, recording its latency and outcome
+        param operation: Name of the query in the metrics
+        return: Query result, exceptions are re-raised
+        """
+        with metrics.ENVIO_REQUEST_SECONDS.labels(operation).time():
+            try:
+                try:
+                    result = self.client.execute(query, variable_values=variables)
+                except GraphQLError:
+                    if not self._schema_from_cache:
+                        raise
+                    # The query does not validate against the cached schema: the indexer may have changed
+                    log.info("Query %s does not match the cached Envio schema, fetching it again", operation)
+                    with self._client_lock:
+                        stale, self._client = self._client, self._build_client(refresh=True)
+                    stale.client.close_sync()
+                    result = self._client.execute(query, variable_values=variables)
+            except Exception:
+                metrics.ENVIO_REQUESTS.labels(operation, "error").inc()
+                raise
+        metrics.ENVIO_REQUESTS.labels(operation, "ok").inc()
+        return result
+
+    def _post_items(self, operation, field, body):
+        """
+        Post a precompiled query and decode the items of data.<field> as the response body
+        arrives, so the body is never held whole next to the rows; recording the request
+        latency and outcome
+        param operation: Name of the query in the metrics
+        param field: Root field of the query, e.g. "Swap"
+        param body: JSON request body, see graphql_stream.compile_request
+        return: List of dictionaries, exceptions are re-raised
+        """
+        with metrics.ENVIO_REQUEST_SECONDS.labels(operation).time():
+            try:
+                with self.session.post(self.graphql_url, data=body, stream=True, timeout=120) as response:
+                    response.raise_for_status()
+                    rows = list(graphql_stream.iter_items(response.iter_content(chunk_size=64 * 1024), field))
+            except Exception:
+                metrics.ENVIO_REQUESTS.labels(operation, "error").inc()
+                raise
+        metrics.ENVIO_REQUESTS.labels(operation, "ok").inc()
+        metrics.ENVIO_ROWS.inc(len(rows))
+        return rows
 
     def get_swaps(self, limit=None, offset=0):
         """
@@ -45,46 +201,105 @@ class EnvioClient:
         # Use BATCH_SIZE from .env if limit is not specified
         if limit is None:
             limit = self.batch_size
-            
-        query = gql("""
-            query GetSwaps($limit: Int!, $offset: Int!) {
-                Swap(limit: $limit, offset: $offset) {
-                    id
-                    timeStamp
-                    _tokenIn
-                    _tokenOut
-                    _amountIn
-                    _amountOut
-                    from
-                }
-            }
-        """)
-        
+
+        query = _document(GET_SWAPS_QUERY)
+
         variables = {
             "limit": limit,
             "offset": offset
         }
         
         try:
-            print(f"\nFetching swaps from Envio:")
-            print(f"URL: {self.client.transport.url}")
-            print(f"Limit: {limit}, Offset: {offset}")
-            
-            result = self.client.execute(query, variable_values=variables)
+            log.debug("Fetching swaps from Envio at %s, limit: %s, offset: %s", self.graphql_url, limit, offset)
+            result = self._execute("get_swaps", query, variables)
             swaps = result.get('Swap', [])
+            metrics.ENVIO_ROWS.inc(len(swaps))
             
             if not swaps and offset == 0:
-                print("Warning: No swaps found at offset 0. This might indicate a connection issue.")
-            else:
-                print(f"Successfully fetched {len(swaps)} swaps")
-                if swaps:
-                    print(f"First swap ID: {swaps[0]['id']}")
-                    print(f"Last swap ID: {swaps[-1]['id']}")
+                log.warning("No swaps found at offset 0. This might indicate a connection issue.")
+            elif swaps:
+                log.debug("Successfully fetched %d swaps, ids %s to %s", len(swaps), swaps[0]['id'], swaps[-1]['id'])
             
             return swaps
         except Exception as e:
-            print(f"Error fetching swaps from Envio: {e}")
-            if hasattr(e, 'response'):
-                print(f"Response status: {e.response.status_code if hasattr(e.response, 'status_code') else 'N/A'}")
-                print(f"Response text: {e.response.text if hasattr(e.response, 'text') else 'N/A'}")
-            return None  # Return None on error instead of empty list 
\ No newline at end of file
+            log.error("Error fetching swaps from Envio: %s%s", e, _response_detail(e))
+            return None  # Return None on error instead of empty list
+
+    def get_entities_after(self, entity, cursor=None, limit=None, until=None):
+        """
+        Get rows of an entity ordered by (cursor field, id field), starting strictly after a cursor
+        param entity: EntitySpec of the rows
+        param cursor: (timestamp, id) of the last row already processed, or None to start from the beginning
+        param limit: Number of rows to fetch. If None, uses BATCH_SIZE from .env
+        param until: Optional exclusive upper bound on the cursor field
+        return: List of rows or None if error
+        """
+        if limit is None:
+            limit = self.batch_size
+
+        variables = {
+            "limit": limit,
+            "where": entity.where(cursor, until)
+        }
+        operation = f"get_{entity.entity.lower()}s_after"
+
+        try:
+            log.debug("Fetching %s from Envio after cursor: %s, limit: %s", entity.entity, cursor, limit)
+            if self.fetch_mode == 'raw':
+                body = graphql_stream.request_body(entity.page_query)(variables)
+                rows = self._post_items(operation, entity.entity, body)
+            else:
+                result = self._execute(operation, _document(entity.page_query), variables)
+                rows = result.get(entity.entity, [])
+                metrics.ENVIO_ROWS.inc(len(rows))
+            log.debug("Successfully fetched %d %s rows", len(rows), entity.entity)
+            return rows
+        except Exception as e:
+            log.error("Error fetching %s from Envio: %s%s", entity.entity, e, _response_detail(e))
+            return None
+
+    def get_entity_stats(self, entity, cursor=None, until=None):
+        """
+        Get the number of rows of an entity and their cursor field range with one aggregate query
+        param entity: EntitySpec of the rows
+        param cursor: Only count rows strictly after this (timestamp, id) cursor
+        param until: Optional exclusive upper bound on the cursor field
+        return: Dictionary with count, min_timestamp and max_timestamp, or None if error
+        """
+        try:
+            result = self._execute(f"get_{entity.entity.lower()}_stats", _document(entity.stats_query),
+                                   {"where": entity.where(cursor, until)})
+            aggregate = result[f"{entity.entity}_aggregate"]['aggregate']
+            min_timestamp = (aggregate.get('min') or {}).get(entity.cursor_field)
+            max_timestamp = (aggregate.get('max') or {}).get(entity.cursor_field)
+            return {
+                "count": int(aggregate['count']),
+                "min_timestamp": int(min_timestamp) if min_timestamp is not None else None,
+                "max_timestamp": int(max_timestamp) if max_timestamp is not None else None
+            }
+        except Exception as e:
+            log.error("Error fetching %s stats from Envio: %s", entity.entity, e)
+            return None
+
+    def get_entity_counts(self, entity, bounds):
+        """
+        Count the rows of an entity in consecutive cursor field ranges with aliased aggregate
+        queries, up to COUNT_BUCKETS_PER_QUERY ranges per request
+        param entity: EntitySpec of the rows
+        param bounds: Ascending boundaries b0 < b1 < ... < bn, range i is [b_i, b_i+1)
+        return: List of the n counts, or None if error
+        """
+        counts = []
+        try:
+            for first in range(0, len(bounds) - 1, COUNT_BUCKETS_PER_QUERY):
+                part = bounds[first:first + COUNT_BUCKETS_PER_QUERY + 1]
+                variables = {f"w{i}": {entity.cursor_field: {"_gte": part[i], "_lt": part[i + 1]}}
+                             for i in range(len(part) - 1)}
+                result = self._execute(f"count_{entity.entity.lower()}_buckets",
+                                       _document(entity.count_query(len(part) - 1)), variables)
+                counts.extend(int(result[f"b{i}"]['aggregate']['count']) for i in range(len(part) - 1))
+            return counts
+        except Exception as e:
+            log.error("Error counting %s buckets in Envio: %s", entity.entity, e)
+            return None
+
@@ -0,0 +1,521 @@
+import calendar
+import csv
+import gzip
+import io
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from graphql import build_schema, graphql_sync, parse, validate
+
+from synthetic_data import generate_swaps, generate_transfers
+
+# The part of the Envio (Hasura-style) schema the sync uses
+ENVIO_SCHEMA = build_schema("""
+    scalar numeric
+
+    enum order_by { asc desc }
+
+    input String_comparison_exp { _eq: String _neq: String _gt: String _gte: String _lt: String _lte: String _in: [String!] }
+    input numeric_comparison_exp { _eq: numeric _neq: numeric _gt: numeric _gte: numeric _lt: numeric _lte: numeric _in: [numeric!] }
+
+    input Swap_bool_exp {
+        _and: [Swap_bool_exp!]
+        _or: [Swap_bool_exp!]
+        _not: Swap_bool_exp
+        id: String_comparison_exp
+        timeStamp: numeric_comparison_exp
+        from: String_comparison_exp
+        _tokenIn: String_comparison_exp
+        _tokenOut: String_comparison_exp
+    }
+
+    input Swap_order_by { id: order_by timeStamp: order_by }
+
+    type Swap {
+        id: String!
+        timeStamp: numeric!
+        _tokenIn: String!
+        _tokenOut: String!
+        _amountIn: numeric!
+        _amountOut: numeric!
+        from: String!
+    }
+
+    input Transfer_bool_exp {
+        _and: [Transfer_bool_exp!]
+        _or: [Transfer_bool_exp!]
+        _not: Transfer_bool_exp
+        id: String_comparison_exp
+        timeStamp: numeric_comparison_exp
+        token: String_comparison_exp
+        from: String_comparison_exp
+        to: String_comparison_exp
+    }
+
+    input Transfer_order_by { id: order_by timeStamp: order_by }
+
+    type Transfer {
+        id: String!
+        timeStamp: numeric!
+        token: String!
+        from: String!
+        to: String!
+        value: numeric!
+        blockNumber: numeric!
+    }
+
+    type Transfer_min_fields { timeStamp: numeric }
+    type Transfer_max_fields { timeStamp: numeric }
+    type Transfer_aggregate_fields { count: Int! min: Transfer_min_fields max: Transfer_max_fields }
+    type Transfer_aggregate { aggregate: Transfer_aggregate_fields }
+
+    type Swap_min_fields { timeStamp: numeric }
+    type Swap_max_fields { timeStamp: numeric }
+    type Swap_aggregate_fields { count: Int! min: Swap_min_fields max: Swap_max_fields }
+    type Swap_aggregate { aggregate: Swap_aggregate_fields }
+
+    type Query {
+        Swap(limit: Int, offset: Int, where: Swap_bool_exp, order_by: [Swap_order_by!]): [Swap!]!
+        Swap_aggregate(where: Swap_bool_exp): Swap_aggregate!
+        Transfer(limit: Int, offset: Int, where: Transfer_bool_exp, order_by: [Transfer_order_by!]): [Transfer!]!
+        Transfer_aggregate(where: Transfer_bool_exp): Transfer_aggregate!
+    }
+""")
+
+_COMPARISONS = {
+    "_eq": lambda a, b: a == b,
+    "_neq": lambda a, b: a != b,
+    "_gt": lambda a, b: a > b,
+    "_gte": lambda a, b: a >= b,
+    "_lt": lambda a, b: a < b,
+    "_lte": lambda a, b: a <= b,
+    "_in": lambda a, b: a in b,
+}
+
+
+def _field_value(swap, field):
+    value = swap[field]
+    return int(value) if field == "timeStamp" else value
+
+
+def _coerce(field, operand):
+    if field != "timeStamp":
+        return operand
+    return [int(v) for v in operand] if isinstance(operand, list) else int(operand)
+
+
+def matches(swap, where):
+    """Evaluate a Swap_bool_exp (or the bool_exp of another entity) against one row"""
+    for key, condition in (where or {}).items():
+        if key == "_and":
+            if not all(matches(swap, part) for part in condition):
+                return False
+        elif key == "_or":
+            if not any(matches(swap, part) for part in condition):
+                return False
+        elif key == "_not":
+            if matches(swap, condition):
+                return False
+        else:
+            value = _field_value(swap, key)
+            for operator, operand in condition.items():
+                if not _COMPARISONS[operator](value, _coerce(key, operand)):
+                    return False
+    return True
+
+
+def _lower_bound(where):
+    """Smallest timestamp the top level of a where clause allows, to skip straight to it"""
+    condition = (where or {}).get("timeStamp") or {}
+    bounds = [int(condition[op]) for op in ("_gte", "_gt", "_eq") if op in condition]
+    return max(bounds) if bounds else None
+
+
+class _Faults:
+    """Injected latency, 429s and 500s shared by both stand-ins"""
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, failure_rate=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def apply(self, handler):
+        """Sleep for the latency, then maybe answer with an error. Returns True if it did."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.throttle_rate:
+            handler.count("throttled")
+            handler.send_json(429, {"error": "Too many requests"}, {"Retry-After": str(self.retry_after)})
+            return True
+        if roll < self.throttle_rate + self.failure_rate:
+            handler.count("failed")
+            handler.send_json(500, {"error": "Injected failure"})
+            return True
+        return False
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, as the real APIs
+    faults = None
+    stats = None
+    lock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b"".join(parts)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeEnvioHandler(_Handler):
+    """
+    GraphQL endpoint serving synthetic Swap and Transfer entities. An entity and its
+    _aggregate are answered straight from its sorted rows, so the stand-in is never the
+    bottleneck; everything else (schema introspection) is executed by graphql-core.
+    """
+    entities = None  # Entity name -> (rows, (timestamp, id) keys), both in key order
+    validated = None
+    live = False
+
+    def do_POST(self):
+        request = json.loads(self.read_body() or b"{}")
+        self.count("requests")
+        if self.faults.apply(self):
+            return
+        query, variables = request.get("query", ""), request.get("variables") or {}
+
+        document = self.validated.get(query)
+        if document is None:
+            document = parse(query)
+            errors = validate(ENVIO_SCHEMA, document)
+            if errors:
+                self.send_json(200, {"errors": [{"message": error.message} for error in errors]})
+                return
+            self.validated[query] = document
+
+        fields = document.definitions[0].selection_set.selections
+        root = fields[0].name.value if len(fields) == 1 else None
+        aggregated = [field.name.value[:-len("_aggregate")] for field in fields if field.name.value.endswith("_aggregate")]
+        if root in self.entities:
+            self.send_json(200, {"data": {root: self.select_rows(root, fields[0], variables)}})
+        elif len(aggregated) == len(fields) and all(entity in self.entities for entity in aggregated):
+            # One or more aggregates, possibly aliased (bucket counts)
+            self.send_json(200, {"data": {
+                (field.alias or field.name).value: self.aggregate(entity, field, variables)
+                for field, entity in zip(fields, aggregated)
+            }})
+        else:
+            result = graphql_sync(ENVIO_SCHEMA, query, variable_values=variables)
+            payload = {"data": result.data}
+            if result.errors:
+                payload["errors"] = [{"message": error.message} for error in result.errors]
+            self.send_json(200, payload)
+
+    def _arguments(self, field, variables):
+        arguments = {}
+        for argument in field.arguments:
+            value = argument.value
+            if value.kind == "variable":
+                arguments[argument.name.value] = variables.get(value.name.value)
+            elif value.kind == "int_value":
+                arguments[argument.name.value] = int(value.value)
+        return arguments
+
+    def _visible(self, entity):
+        """Number of rows indexed so far: live rows appear once their second is over"""
+        rows, keys = self.entities[entity]
+        if not self.live:
+            return len(rows)
+        return bisect_left(keys, (int(time.time()), ""))
+
+    def _scan(self, entity, where):
+        rows, keys = self.entities[entity]
+        lower = _lower_bound(where)
+        start = bisect_left(keys, (lower, "")) if lower is not None else 0
+        for swap in rows[start:self._visible(entity)]:
+            if matches(swap, where):
+                yield swap
+            elif "timeStamp" in (where or {}) and "_lt" in where["timeStamp"] \
+                    and int(swap["timeStamp"]) >= int(where["timeStamp"]["_lt"]):
+                return  # Sorted by timestamp: nothing further can match
+
+    def select_rows(self, entity, field, variables):
+        # Rows are stored in (timeStamp, id) order, the only order the sync asks for
+        arguments = self._arguments(field, variables)
+        limit, offset = arguments.get("limit"), arguments.get("offset") or 0
+        names = [selection.name.value for selection in field.selection_set.selections]
+        page = []
+        for index, swap in enumerate(self._scan(entity, arguments.get("where"))):
+            if index < offset:
+                continue
+            if limit is not None and len(page) >= limit:
+                break
+            page.append({name: swap[name] for name in names})
+        self.count("rows_served", len(page))
+        return page
+
+    def aggregate(self, entity, field, variables):
+        timestamps = [int(swap["timeStamp"]) for swap in self._scan(entity, self._arguments(field, variables).get("where"))]
+        return {"aggregate": {
+            "count": len(timestamps),
+            "min": {"timeStamp": str(min(timestamps)) if timestamps else None},
+            "max": {"timeStamp": str(max(timestamps)) if timestamps else None},
+        }}
+
+
+class FakeDuneHandler(_Handler):
+    """
+    Dune API stand-in for the endpoints the sync calls: table create/get/delete,
+    insert (csv/ndjson, optionally gzip) and execution of the queries DuneClient
+    sends (latest row, bucket digests, ids of a range). Rows without an id, such as
+    rollup deltas, are kept whole and their numeric columns summed in /_stats.
+    drop_rate makes it accept a share of the inserts without storing them, leaving
+    gaps to reconcile; lost_rate makes it store a share of them but answer 504, as
+    when the answer of an applied insert is lost.
+    """
+    tables = None
+    drop_rate = 0.0
+    lost_rate = 0.0
+    random = None
+
+    def _table(self):
+        parts = self.path.split("?")[0].rstrip("/").split("/")
+        # /api/v1/table/{namespace}/{table}[/insert]
+        index = parts.index("table")
+        return f"{parts[index + 1]}.{parts[index + 2]}", parts[index + 3:] if len(parts) > index + 3 else []
+
+    def do_GET(self):
+        self.count("requests")
+        if self.path.startswith("/_stats"):
+            with self.lock:
+                stats = dict(self.stats, tables={
+                    name: {"rows": table["rows"], "unique_ids": len(table["ids"]), "totals": _totals(table["records"])}
+                    for name, table in self.tables.items()
+                })
+            self.send_json(200, stats)
+            return
+        name, _ = self._table()
+        if name in self.tables:
+            self.send_json(200, {"full_name": f"dune.{name}"})
+        else:
+            self.send_json(404, {"error": "Table not found"})
+
+    def do_DELETE(self):
+        self.count("requests")
+        name, _ = self._table()
+        with self.lock:
+            existed = self.tables.pop(name, None) is not None
+        self.send_json(200 if existed else 404, {"message": f"Table {name} deleted"} if existed else {"error": "Table not found"})
+
+    def do_POST(self):
+        body = self.read_body()
+        self.count("requests")
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/table/create"):
+            request = json.loads(body)
+            name = f"{request['namespace']}.{request['table_name']}"
+            with self.lock:
+                self.tables.setdefault(name, {"rows": 0, "ids": set(), "latest": None, "keys": [], "records": []})
+            self.send_json(200, {"namespace": request["namespace"], "table_name": request["table_name"],
+                                 "full_name": f"dune.{name}", "already_existed": False})
+            return
+        if path.endswith("/query/execute"):
+            self.send_json(200, {"result": {"rows": self.execute(json.loads(body or b"{}").get("query", ""))}})
+            return
+        if path.endswith("/insert"):
+            if self.faults.apply(self):
+                return
+            name, _ = self._table()
+            if name not in self.tables:
+                self.send_json(404, {"error": "Table not found"})
+                return
+            rows = self.parse_rows(body, self.headers.get("Content-Type", ""))
+            records = [row for row in rows if "id" not in row]
+            keys = [(row["timestamp"], row["id"]) for row in rows if "id" in row]
+            with self.lock:
+                roll = self.random.random()
+                dropped = roll < self.drop_rate
+                lost = not dropped and roll < self.drop_rate + self.lost_rate
+                table = self.tables[name]
+                if dropped:
+                    self.stats["dropped"] += len(rows)
+                else:
+                    table["rows"] += len(rows)
+                    table["records"].extend(records)
+                    table["ids"].update(row_id for _, row_id in keys)
+                    table["keys"].extend(keys)
+                    latest = max(keys, default=None)
+                    if latest and (table["latest"] is None or latest > table["latest"]):
+                        table["latest"] = latest
+                self.stats["rows_inserted"] += len(rows)
+                self.stats["bytes_received"] += len(body)
+                self.stats["last_insert_at"] = time.time()
+                if lost:
+                    self.stats["lost"] += 1
+            if lost:
+                self.send_json(504, {"error": "Gateway timeout"})
+                return
+            self.send_json(200, {"rows_written": len(rows), "bytes_written": len(body)})
+            return
+        self.send_json(404, {"error": f"Unknown endpoint {self.path}"})
+
+    @staticmethod
+    def parse_rows(body, content_type):
+        """Rows of an insert body, as dictionaries"""
+        if "ndjson" in content_type:
+            return [json.loads(line) for line in body.splitlines() if line.strip()]
+        return list(csv.DictReader(io.StringIO(body.decode("utf-8"))))
+
+    def execute(self, query):
+        match = re.search(r"FROM\s+(\S+)", query)
+        table = self.tables.get(match.group(1)) if match else None
+        if table is None:
+            return []
+        if "width_bucket" in query:
+            edges = [int(edge) for edge in re.search(r"ARRAY\[([^\]]*)\]", query).group(1).split(",")]
+            buckets = {}
+            with self.lock:
+                keys = list(table["keys"])
+            for timestamp, row_id in keys:
+                seconds = _utc_seconds(timestamp)
+                if edges[0] <= seconds < edges[-1]:
+                    bucket = buckets.setdefault(bisect_right(edges, seconds), [0, 0])
+                    bucket[0] += 1
+                    bucket[1] += zlib.crc32(row_id.encode("utf-8"))
+            return [{"bucket": index, "row_count": count, "id_digest": digest}
+                    for index, (count, digest) in sorted(buckets.items())]
+        if " AS found" in query:
+            column, values = re.search(r"CAST\((\w+) AS varchar\) IN \((.*)\)", query).groups()
+            wanted = {value.replace("''", "'") for value in re.findall(r"'((?:[^']|'')*)'", values)}
+            with self.lock:
+                if column == "id":
+                    found = sum(1 for _, row_id in table["keys"] if row_id in wanted)
+                else:
+                    found = sum(1 for record in table["records"] if str(record.get(column)) in wanted)
+            return [{"found": found}]
+        if " AS id" in query:
+            low, high = (int(value) for value in re.findall(r"from_unixtime\((\d+)\)", query))
+            with self.lock:
+                keys = list(table["keys"])
+            return [{"id": row_id} for timestamp, row_id in keys if low <= _utc_seconds(timestamp) < high]
+        if table["latest"]:
+            timestamp, latest_id = table["latest"]
+            return [{"latest_id": latest_id, "latest_timestamp": timestamp.replace("T", " ") + ".000 UTC"}]
+        return []
+
+
+def _totals(records):
+    """Sum of every numeric column of the rows of a table"""
+    totals = {}
+    for record in records:
+        for name, value in record.items():
+            try:
+                totals[name] = totals.get(name, 0) + float(value)
+            except (TypeError, ValueError):
+                continue
+    return totals
+
+
+def _utc_seconds(timestamp):
+    """A naive ISO timestamp read as UTC, as Dune reads the naive local times the sync writes"""
+    return calendar.timegm(time.strptime(timestamp.replace(" ", "T")[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+def _stats():
+    return {"requests": 0, "throttled": 0, "failed": 0, "dropped": 0, "lost": 0, "rows_served": 0, "rows_inserted": 0,
+            "bytes_received": 0, "last_insert_at": None}
+
+
+def make_envio_server(port=0, rows=100000, seed=0, live_rate=0.0, live_rows=100000, transfers=0, **faults):
+    """
+    Build the Envio stand-in
+    :param port: Port to listen on, 0 picks a free one
+    :param rows: Number of synthetic swaps to serve
+    :param seed: Seed of the synthetic swaps and of the injected faults
+    :param live_rate: Swaps per second indexed after the server starts, on top of the rows of history
+    :param live_rows: Number of live swaps, when live_rate is set
+    :param transfers: Number of synthetic Transfer entities to serve next to the swaps
+    :param faults: latency, throttle_rate, failure_rate, retry_after
+    :return: ThreadingHTTPServer, serve it with serve_forever()
+    """
+    swaps = generate_swaps(rows, seed=seed)
+    if live_rate:
+        # Live swaps are stamped with the second they are indexed in, starting next second
+        start = int(time.time()) + 1
+        live = generate_swaps(live_rows, seed=seed + 1, start_timestamp=start, swaps_per_second=1)
+        for index, swap in enumerate(live):
+            swap["id"] = swap["id"].rsplit("_", 1)[0] + f"_{rows + index}"
+            swap["timeStamp"] = str(start + int(index / live_rate))
+        live.sort(key=lambda swap: (int(swap["timeStamp"]), swap["id"]))
+        swaps += live
+    handler = type("EnvioHandler", (FakeEnvioHandler,), {
+        "entities": {name: (entities, [(int(row["timeStamp"]), row["id"]) for row in entities])
+                     for name, entities in (("Swap", swaps), ("Transfer", generate_transfers(transfers, seed=seed)))},
+        "validated": {},
+        "live": bool(live_rate),
+        "lock": threading.Lock(),
+        "faults": _Faults(seed=seed, **faults),
+        "stats": _stats(),
+    })
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+
+def make_dune_server(port=0, seed=0, drop_rate=0.0, lost_rate=0.0, **faults):
+    """
+    Build the Dune API stand-in; GET /_stats returns the request and row counters
+    :param port: Port to listen on, 0 picks a free one
+    :param seed: Seed of the injected faults
+    :param drop_rate: Share of inserts acknowledged but not stored
+    :param lost_rate: Share of inserts stored but answered with 504
+    :param faults: latency, throttle_rate, failure_rate, retry_after
+    :return: ThreadingHTTPServer, serve it with serve_forever()
+    """
+    handler = type("DuneHandler", (FakeDuneHandler,), {
+        "tables": {},
+        "drop_rate": drop_rate,
+        "lost_rate": lost_rate,
+        "random": random.Random(seed + 1),
+        "lock": threading.Lock(),
+        "faults": _Faults(seed=seed, **faults),
+        "stats": _stats(),
+    })
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
@@ -0,0 +1,173 @@
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_SKIP = frozenset(b" \t\r\n,")
+_OPEN_BRACE = ord("{")
+_CLOSE_BRACKET = ord("]")
+_HEAD_LIMIT = 1024  # Bytes of the body searched for the start of the array
+_FAST_PATH_ATTEMPTS = 4
+_PIECE_SIZE = 64 * 1024  # Largest slice decoded at once, so a failed fast-path attempt stays cheap
+
+_request_bodies = {}  # Query text -> compiled request body function
+
+
+class GraphQLResponseError(Exception):
+    """The endpoint answered with GraphQL errors instead of data"""
+
+
+def loads(data):
+    """Decode JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(value):
+    """Encode a value as JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def compile_request(query):
+    """
+    Encode a query document once, so a request only has to encode its variables
+    :param query: GraphQL query text
+    :return: Function(variables) returning the JSON request body as bytes
+    """
+    prefix = b'{"query":' + dumps(query) + b',"variables":'
+    return lambda variables: prefix + dumps(variables) + b"}"
+
+
+def request_body(query):
+    """
+    Compiled request body function of a query, see compile_request. Bodies are compiled
+    once per process and shared by every client posting the query
+    :param query: GraphQL query text
+    :return: Function(variables) returning the JSON request body as bytes
+    """
+    body = _request_bodies.get(query)
+    if body is None:
+        body = _request_bodies[query] = compile_request(query)
+    return body
+
+
+def _check_errors(response):
+    if response.get("errors"):
+        messages = "; ".join(str(error.get("message", error)) for error in response["errors"])
+        raise GraphQLResponseError(messages)
+
+
+def decode_data(body):
+    """
+    Decode a whole GraphQL response body
+    :param body: Response bytes
+    :return: The data dictionary, raises GraphQLResponseError on GraphQL errors
+    """
+    response = loads(body)
+    _check_errors(response)
+    return response.get("data") or {}
+
+
+def _decode_items(buffer, position):
+    """
+    Decode the complete array items in buffer, starting at position
+    :return: (list of items, position after the last complete item, True if the array was closed)
+    """
+    # Fast path: the items up to one of the last few '}' (the last one, or the one before the
+    # closing "]}}" of the body) form a valid array on their own, and decoding them with one
+    # call is much cheaper than one call per item. A '}' inside a string or a nested object
+    # never gives a valid array, so a successful decode always ends on an item boundary.
+    items = []
+    end = len(buffer)
+    for _ in range(_FAST_PATH_ATTEMPTS):
+        end = buffer.rfind(b"}", position, end)
+        if end == -1:
+            break
+        try:
+            items = loads(b"[" + buffer[position:end + 1].lstrip(b" \t\r\n,") + b"]")
+        except ValueError:
+            continue
+        position = end + 1
+        break
+    length = len(buffer)
+    while True:
+        while position < length and buffer[position] in _SKIP:
+            position += 1
+        if position == length:
+            return items, position, False
+        if buffer[position] == _CLOSE_BRACKET:
+            return items, position + 1, True
+        if buffer[position] != _OPEN_BRACE:
+            raise ValueError(f"Expected an object in the GraphQL response at byte {position}")
+        # The first '}' that closes a valid object ends the item; a '}' inside a string or
+        # a nested object only makes the attempt fail and the search moves on
+        end = buffer.find(b"}", position)
+        while end != -1:
+            try:
+                item = loads(buffer[position:end + 1])
+                break
+            except ValueError:
+                end = buffer.find(b"}", end + 1)
+        if end == -1:
+            return items, position, False
+        items.append(item)
+        position = end + 1
+
+
+def _pieces(chunks):
+    for chunk in chunks:
+        if len(chunk) <= _PIECE_SIZE:
+            yield chunk
+        else:
+            for start in range(0, len(chunk), _PIECE_SIZE):
+                yield chunk[start:start + _PIECE_SIZE]
+
+
+def iter_items(chunks, field):
+    """
+    Yield the objects of data.<field> from a GraphQL response body while it is still
+    arriving. Each object is decoded on its own as soon as its bytes are in, so the
+    body is never held whole and the rows never all at once next to it. A response
+    in another shape (errors, extra keys first) is decoded whole instead.
+    :param chunks: Iterable of body bytes, e.g. response.iter_content()
+    :param field: Name of the queried root field, e.g. "Swap"
+    :return: Generator of dictionaries, raises GraphQLResponseError on GraphQL errors
+    """
+    head = re.compile(rb'\s*\{\s*"data"\s*:\s*\{\s*"' + re.escape(field.encode("utf-8")) + rb'"\s*:\s*\[')
+    chunks = _pieces(chunks)
+    buffer = b""
+    position = None
+    for chunk in chunks:
+        buffer += chunk
+        match = head.match(buffer)
+        if match:
+            position = match.end()
+            break
+        if len(buffer) > _HEAD_LIMIT:
+            break
+    if position is None:
+        response = loads(buffer + b"".join(chunks))
+        _check_errors(response)
+        yield from (response.get("data") or {}).get(field) or []
+        return
+
+    while True:
+        items, position, closed = _decode_items(buffer, position)
+        yield from items
+        if closed:
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("GraphQL response ended inside the data array")
+        buffer = buffer[position:] + chunk
+        position = 0
+    tail = buffer[position:] + b"".join(chunks)
+    if b'"errors"' in tail:
+        # Rebuild the rest of the body around an empty array to read errors sent after the data
+        _check_errors(loads(b'{"data":{"' + field.encode("utf-8") + b'":[]' + tail))
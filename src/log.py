@@ -0,0 +1,60 @@
+import os
+import threading
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+_LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+level = _LEVELS.get(os.getenv('LOG_LEVEL', 'info').lower(), INFO)
+_sample_counts = {}
+_sample_lock = threading.Lock()
+
+
+def set_level(name):
+    """Change the level at runtime: debug, info, warning or error"""
+    global level
+    level = _LEVELS[name.lower()]
+
+
+def enabled(at):
+    return at >= level
+
+
+def _emit(at, message, args):
+    # Messages are only formatted once we know they are printed, so disabled calls cost one comparison
+    if at >= level:
+        print(message % args if args else message)
+
+
+def debug(message, *args):
+    _emit(DEBUG, message, args)
+
+
+def info(message, *args):
+    _emit(INFO, message, args)
+
+
+def warning(message, *args):
+    _emit(WARNING, message, args)
+
+
+def error(message, *args):
+    _emit(ERROR, message, args)
+
+
+def sampled(key, every, message, *args, at=DEBUG):
+    """
+    Log the first occurrence of a repeated event and then one in every `every`,
+    with the number of occurrences so far, e.g. for per-row messages
+    :param key: Name of the event the occurrences are counted under
+    :param every: Log one occurrence in this many
+    :param message: %-style message
+    :param at: Level of the message
+    """
+    if at < level:
+        return
+    with _sample_lock:
+        count = _sample_counts.get(key, 0) + 1
+        _sample_counts[key] = count
+    if count == 1 or count % every == 0:
+        print(f"{message % args if args else message} [{count} so far]")
+
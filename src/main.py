@@ -1,186 +1,374 @@
 from envio_client import EnvioClient
 from dune_client import DuneClient
-from data_transformer import DataTransformer
-import time
+from data_transformer import DataTransformer, to_unix_timestamp
+from checkpoint_store import CheckpointStore
+from pipeline import SyncPipeline
+from spill_queue import SpillQueue
+from upload_ledger import UploadLedger
+from backfill import Backfill
+from reconcile import Reconciler
+from rollup import RollupStore
+from entities import SWAP, load_entities
+from payload_encoder import compare_payload_formats, print_payload_comparison
+from metrics import MetricsExporter
+import config
+import log
+import argparse
+import calendar
 import os
-from dotenv import load_dotenv
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-# Force reload environment variables
-load_dotenv(override=True)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Transfer swap data from Envio to Dune")
+    parser.add_argument("--backfill", action="store_true",
+                        help="Load the missing history with parallel range partitions before the incremental sync")
+    parser.add_argument("--partitions", type=int, default=None,
+                        help="Number of backfill partitions (default: BACKFILL_PARTITIONS from .env or 8)")
+    parser.add_argument("--follow", action="store_true",
+                        help="Keep running after catching up and tail Envio at an adaptive interval until SIGINT/SIGTERM")
+    parser.add_argument("--entities", default=None, metavar="PATH",
+                        help="JSON file of the entities to sync (default: ENTITIES_PATH from .env, or only Swap)")
+    parser.add_argument("--rollups", action="store_true",
+                        help="Maintain the hourly rollup table of each entity that declares one (Swap: by token pair)")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="Compare Envio and Dune bucket by bucket, upload the rows Dune is missing, then exit")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="With --reconcile, only report the missing rows")
+    parser.add_argument("--verify-ids", action="store_true",
+                        help="With --reconcile, also compare id digests of buckets whose counts match (scans their ids)")
+    parser.add_argument("--since", type=parse_time, default=None, metavar="TIME",
+                        help="Start of the --reconcile range, Unix timestamp or UTC ISO date (default: oldest Envio row)")
+    parser.add_argument("--until", type=parse_time, default=None, metavar="TIME",
+                        help="End of the --reconcile range, Unix timestamp or UTC ISO date (default: last checkpoint)")
+    parser.add_argument("--compare-formats", action="store_true",
+                        help="Encode one Envio page in every Dune payload format, print sizes and speeds, then exit")
+    parser.add_argument("--link-mbps", type=float, default=None,
+                        help="Uplink speed in megabits/s used by --compare-formats to estimate send time")
+    parser.add_argument("--log-level", choices=["debug", "info", "warning", "error"], default=None,
+                        help="Log level (default: LOG_LEVEL from .env or info)")
+    parser.add_argument("--profile", nargs="?", const="profile.json", default=None, metavar="REPORT",
+                        help="Run under cProfile and tracemalloc and write a per-stage JSON report "
+                             "(default: profile.json, raw stats in profile.pstats)")
+    return parser.parse_args(argv)
 
-# Validate environment variables
-required_vars = ['ENVIO_GRAPHQL_URL', 'DUNE_API_KEY', 'DUNE_NAMESPACE']
-missing_vars = [var for var in required_vars if not os.getenv(var)]
+def parse_time(value):
+    """Unix timestamp, or ISO date/datetime read as UTC"""
+    if value.isdigit():
+        return int(value)
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a Unix timestamp or an ISO date, got {value}")
+    return calendar.timegm(moment.utctimetuple()) if moment.tzinfo else calendar.timegm(moment.timetuple())
 
-if missing_vars:
-    print("Error: Missing required environment variables:")
-    for var in missing_vars:
-        print(f"- {var}")
-    exit(1)
+def main(argv=None):
+    args = parse_args(argv)
+    config.load()
+    if args.entities:
+        os.environ['ENTITIES_PATH'] = args.entities
+    if args.log_level:
+        log.set_level(args.log_level)
 
-print("\nEnvironment variables loaded:")
-print(f"ENVIO_GRAPHQL_URL: {os.getenv('ENVIO_GRAPHQL_URL')}")
-print(f"DUNE_NAMESPACE: {os.getenv('DUNE_NAMESPACE')}")
-print(f"BATCH_SIZE: {os.getenv('BATCH_SIZE')}")
+    # Validate environment variables
+    missing_vars = config.missing()
+    if missing_vars:
+        print("Error: Missing required environment variables:")
+        for var in missing_vars:
+            print(f"- {var}")
+        return 1
 
-def main():
+    print("\nEnvironment variables loaded:")
+    for name, value in config.summary().items():
+        print(f"{name}: {value}")
+
+    # Metrics are served or written only when METRICS_PORT or METRICS_TEXTFILE is set
+    exporter = MetricsExporter().start()
+    try:
+        if args.profile:
+            from profiler import SyncProfiler
+            with SyncProfiler(args.profile):
+                return sync(args)
+        return sync(args)
+    finally:
+        exporter.stop()
+
+def sync(args):
+    """
+    Run the sync selected by the command line arguments
+    :return: Exit status, 1 if a table could not be prepared or a pipeline, backfill or reconcile failed
+    """
     envio_client = EnvioClient()
-    dune_client = DuneClient()
+    dune_client = DuneClient(ledger=UploadLedger())
     transformer = DataTransformer()
+    checkpoints = CheckpointStore()
+    spool = SpillQueue()  # Chunks left over by a previous run are uploaded first
+    rollups = RollupStore() if args.rollups else None
+    entities = load_entities()  # Swap to DUNE_TABLE_NAME unless ENTITIES_PATH lists more
     
     # Configuration
     BATCH_SIZE = int(os.getenv('BATCH_SIZE', 10000))
-    print(f"Loaded BATCH_SIZE from .env: {BATCH_SIZE}")
     DUNE_NAMESPACE = os.getenv('DUNE_NAMESPACE')
-    DUNE_TABLE_NAME = os.getenv('DUNE_TABLE_NAME', 'swaps')
     MAX_RETRIES = 3
     RETRY_DELAY = 5  # seconds
     
     if not DUNE_NAMESPACE:
         print("Error: DUNE_NAMESPACE not set in environment variables")
-        return
+        return 1
+
+    if args.compare_formats:
+        compare_formats(envio_client, transformer, BATCH_SIZE, args.link_mbps, entities[0])
+        return 0
 
-    # Define the schema for our swaps table
-    schema = [
-        {"name": "id", "type": "varchar"},
-        {"name": "from", "type": "varchar"},
-        {"name": "token_in", "type": "varchar"},
-        {"name": "token_out", "type": "varchar"},
-        {"name": "amount_in", "type": "double"},
-        {"name": "amount_out", "type": "double"},
-        {"name": "timestamp", "type": "timestamp"}
-    ]
+    if args.reconcile:
+        reports = [reconcile(args, envio_client, dune_client, transformer, checkpoints, spool, DUNE_NAMESPACE, entity)
+                   for entity in entities]
+        return 0 if None not in reports else 1
+
+    # One pipeline per entity; they share the Dune client, so its HTTP connection pool and
+    # rate limiter, the spill queue and the checkpoints. A gql client is not safe to share
+    # between threads, so each pipeline fetches with its own Envio client
+    pipelines = []
+    for entity in entities:
+        ready, cursor = prepare_table(dune_client, checkpoints, spool, DUNE_NAMESPACE, entity)
+        if not ready:
+            return 1
+        if rollups is not None and entity.rollup is not None:
+            if not prepare_rollup_table(dune_client, rollups, spool, DUNE_NAMESPACE, entity, cursor):
+                return 1
+
+        if args.backfill:
+            backfill = Backfill(
+                envio_client=envio_client,
+                dune_client=dune_client,
+                transformer=transformer,
+                checkpoints=checkpoints,
+                namespace=DUNE_NAMESPACE,
+                table_name=entity.table_name,
+                batch_size=BATCH_SIZE,
+                partitions=args.partitions,
+                max_retries=MAX_RETRIES,
+                retry_delay=RETRY_DELAY,
+                spool=spool,
+                entity=entity,
+                rollups=rollups
+            )
+            if not backfill.run(cursor):
+                print("Backfill did not complete, rerun with --backfill to retry the failed partitions")
+                return 1
+            cursor = checkpoints.load(f"{DUNE_NAMESPACE}.{entity.table_name}") or cursor
+
+        # Fetch, transform and upload run concurrently; the checkpoint advances in fetch order
+        pipeline = SyncPipeline(
+            envio_client=EnvioClient(envio_client.graphql_url, envio_client.schema_cache),
+            dune_client=dune_client,
+            transformer=transformer,
+            checkpoints=checkpoints,
+            namespace=DUNE_NAMESPACE,
+            table_name=entity.table_name,
+            batch_size=BATCH_SIZE,
+            max_retries=MAX_RETRIES,
+            retry_delay=RETRY_DELAY,
+            spool=spool,
+            follow=args.follow,
+            entity=entity,
+            rollups=rollups
+        )
+        pipelines.append((pipeline, cursor))
+
+    if args.follow:
+        stop_on_signals(lambda: [pipeline.stop() for pipeline, _ in pipelines])
+        print(f"Following {', '.join(pipeline.stream for pipeline, _ in pipelines)}, stop with Ctrl-C or SIGTERM")
+    if len(pipelines) == 1:
+        results = [run_pipeline(*pipelines[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=len(pipelines), thread_name_prefix="entity") as executor:
+            results = list(executor.map(lambda item: run_pipeline(*item), pipelines))
+    for (pipeline, _), ok in zip(pipelines, results):
+        if not ok:
+            print(f"Sync of {pipeline.stream} stopped before reaching the end of the Envio data, rerun to resume from the last checkpoint")
+    return 0 if all(results) else 1
+
+def run_pipeline(pipeline, cursor):
+    """Run the pipeline of one entity, then close the Envio client it fetched with"""
+    try:
+        return pipeline.run(cursor)
+    finally:
+        pipeline.envio_client.close()
+
+def prepare_table(dune_client, checkpoints, spool, namespace, entity):
+    """
+    Create the Dune table of an entity if needed and find where its sync resumes
+    :param dune_client: DuneClient
+    :param checkpoints: CheckpointStore
+    :param spool: SpillQueue, cleared of chunks bound for a table that had to be created
+    :param namespace: Your Dune username
+    :param entity: EntitySpec of the table
+    :return: (True, cursor to resume after or None), or (False, None) if the table could not be created
+    """
+    table_name = entity.table_name
+    stream = f"{namespace}.{table_name}"
 
     # Check if table exists
-    table_exists = dune_client.table_exists(DUNE_NAMESPACE, DUNE_TABLE_NAME)
+    table_exists = dune_client.table_exists(namespace, table_name)
     
     if not table_exists:
-        print(f"Table {DUNE_NAMESPACE}.{DUNE_TABLE_NAME} does not exist. Creating...")
+        print(f"Table {stream} does not exist. Creating...")
         # Create the table if it doesn't exist
         table_result = dune_client.create_table(
-            namespace=DUNE_NAMESPACE,
-            table_name=DUNE_TABLE_NAME,
-            description="Swap data from Envio indexer",
-            schema=schema
+            namespace=namespace,
+            table_name=table_name,
+            description=entity.description,
+            schema=entity.schema
         )
 
         if not table_result:
-            print("Error creating table in Dune")
-            return
+            print(f"Error creating table {stream} in Dune")
+            return False, None
 
-        print(f"Table {DUNE_NAMESPACE}.{DUNE_TABLE_NAME} created successfully")
-        offset = 0  # Start from beginning if table is new
-        latest_timestamp = None  # No previous data to compare against
-        print(f"Starting with offset: {offset} (new table)")
-    else:
-        print(f"Table {DUNE_NAMESPACE}.{DUNE_TABLE_NAME} already exists")
-        # Get the latest transaction data from Dune
-        latest_id, latest_timestamp = dune_client.get_latest_id(DUNE_NAMESPACE, DUNE_TABLE_NAME)
-        if latest_timestamp:
-            print(f"Latest data in Dune - ID: {latest_id}, Timestamp: {latest_timestamp}")
-            # Start from beginning to find new transactions
-            offset = 0
-            print(f"Starting from beginning to find new transactions after timestamp: {latest_timestamp}")
-        else:
-            print("No existing data found, starting from beginning")
-            offset = 0
-            latest_timestamp = None
-            print(f"Starting with offset: {offset} (no existing data)")
-    
-    consecutive_empty_responses = 0
-    MAX_EMPTY_RESPONSES = 3  # Number of empty responses before we assume we're done
-    processed_hashes = set()  # Keep track of processed transaction hashes
-    
-    while True:
-        # Fetch swaps from Envio with retry logic
-        retries = 0
-        while retries < MAX_RETRIES:
-            try:
-                print(f"\nFetching swaps from Envio with offset: {offset}, limit: {BATCH_SIZE}")
-                swaps = envio_client.get_swaps(limit=BATCH_SIZE, offset=offset)
-                if swaps is not None:  # Valid response received
-                    print(f"Fetched {len(swaps)} swaps from Envio")
-                    if swaps:
-                        print(f"First swap ID: {swaps[0]['id']}, Last swap ID: {swaps[-1]['id']}")
-                        print(f"First swap timestamp: {swaps[0]['timeStamp']}, Last swap timestamp: {swaps[-1]['timeStamp']}")
-                    break
-                retries += 1
-                if retries < MAX_RETRIES:
-                    print(f"Empty response from Envio, retrying in {RETRY_DELAY} seconds... (Attempt {retries + 1}/{MAX_RETRIES})")
-                    time.sleep(RETRY_DELAY)
-            except Exception as e:
-                retries += 1
-                if retries < MAX_RETRIES:
-                    print(f"Error fetching from Envio: {e}")
-                    print(f"Retrying in {RETRY_DELAY} seconds... (Attempt {retries + 1}/{MAX_RETRIES})")
-                    time.sleep(RETRY_DELAY)
-                else:
-                    print(f"Failed to fetch from Envio after {MAX_RETRIES} attempts")
-                    return
-        
-        if not swaps:
-            consecutive_empty_responses += 1
-            if consecutive_empty_responses >= MAX_EMPTY_RESPONSES:
-                print(f"No more swaps to process after {MAX_EMPTY_RESPONSES} consecutive empty responses")
-                break
-            print(f"Empty response from Envio ({consecutive_empty_responses}/{MAX_EMPTY_RESPONSES}), retrying...")
-            time.sleep(RETRY_DELAY)
-            continue
-        else:
-            consecutive_empty_responses = 0  # Reset counter on successful response
-            
-        # Filter out already processed transactions and older transactions
-        new_swaps = []
-        for swap in swaps:
-            swap_id = swap['id']
-            swap_timestamp = int(swap['timeStamp'])
-            
-            # Skip if we've already processed this transaction
-            if swap_id in processed_hashes:
-                print(f"Skipping already processed transaction: {swap_id}")
-                continue
-                
-            # Skip if this transaction is older than our latest timestamp
-            if latest_timestamp and swap_timestamp <= int(latest_timestamp):
-                print(f"Skipping older transaction: {swap_id} (timestamp: {swap_timestamp})")
-                continue
-                
-            new_swaps.append(swap)
-            processed_hashes.add(swap_id)  # Mark this hash as processed
-        
-        if not new_swaps:
-            print("No new transactions found in this batch, moving to next batch")
-            offset += BATCH_SIZE
-            continue
-            
-        # Transform the data
-        transformed_data = transformer.transform_swaps(new_swaps)
-        print(f"Transformed {len(transformed_data)} swaps")
-        if transformed_data:
-            print(f"First transformed ID: {transformed_data[0]['id']}, Last transformed ID: {transformed_data[-1]['id']}")
-        
-        # Upload to Dune using SQL INSERT
-        # Use the actual number of records as the batch size since we've already filtered them
-        actual_batch_size = len(transformed_data)
-        print(f"Uploading {actual_batch_size} records to Dune")
-        result = dune_client.upload_data(
-            namespace=DUNE_NAMESPACE,
-            table_name=DUNE_TABLE_NAME,
-            data=transformed_data,
-            batch_size=actual_batch_size  # Use actual number of records as batch size
-        )
-        
-        if result:
-            print(f"Successfully uploaded {actual_batch_size} swaps to Dune")
-            # Update offset by the original BATCH_SIZE for next iteration
-            offset += BATCH_SIZE
-            print(f"Updated offset to: {offset} (incremented by original batch size)")
-        else:
-            print("Failed to upload data to Dune")
-            time.sleep(RETRY_DELAY)  # Wait before retrying
-            continue  # Don't increment offset, try the same batch again
-            
-        time.sleep(1)  # Rate limiting
+        print(f"Table {stream} created successfully")
+        checkpoints.reset(stream)  # Any local checkpoint belonged to a previous table
+        spool.discard(namespace, table_name)  # So did any chunk still queued for it
+        dune_client.ledger.reset(stream)  # And the record of its uploads
+        print("Starting from the beginning (new table)")
+        return True, None
+
+    print(f"Table {stream} already exists")
+    cursor = checkpoints.load(stream)
+    if cursor:
+        print(f"Resuming from local checkpoint: {cursor}")
+        return True, cursor
+    # No local checkpoint yet: bootstrap from the latest (timestamp, id) pair already in Dune
+    latest_id, latest_timestamp = dune_client.get_latest_id(namespace, table_name, entity)
+    if latest_timestamp:
+        cursor = (to_unix_timestamp(latest_timestamp), latest_id)
+        checkpoints.seed(stream, cursor)
+        print(f"Latest data in Dune - ID: {latest_id}, Timestamp: {latest_timestamp}")
+        print(f"Resuming after cursor: {cursor}")
+        return True, cursor
+    print("No existing data found, starting from beginning")
+    return True, None
+
+def prepare_rollup_table(dune_client, rollups, spool, namespace, entity, cursor):
+    """
+    Create the Dune rollup table of an entity if needed
+    :param dune_client: DuneClient
+    :param rollups: RollupStore, cleared of the state of a rollup table that had to be created
+    :param spool: SpillQueue, cleared of chunks bound for a rollup table that had to be created
+    :param namespace: Your Dune username
+    :param entity: EntitySpec with a rollup
+    :param cursor: Cursor the sync of the entity resumes after, None for a new table
+    :return: False if the table could not be created
+    """
+    table_name = entity.rollup_table
+    stream = f"{namespace}.{table_name}"
+    if dune_client.table_exists(namespace, table_name):
+        print(f"Rollup table {stream} already exists")
+        if cursor is None and rollups.cursor(f"{namespace}.{entity.table_name}") is not None:
+            # The entity table was created anew under a rollup that already counts its old rows
+            print(f"Warning: {namespace}.{entity.table_name} is synced from the start again, delete {stream} "
+                  f"or its totals will count the rows synced before twice")
+            rollups.reset(stream, f"{namespace}.{entity.table_name}")
+        return True
+
+    print(f"Rollup table {stream} does not exist. Creating...")
+    table_result = dune_client.create_table(
+        namespace=namespace,
+        table_name=table_name,
+        description=f"Hourly rollup of {namespace}.{entity.table_name}, SUM the rows of an hour and group for totals",
+        schema=entity.rollup.schema
+    )
+    if not table_result:
+        print(f"Error creating table {stream} in Dune")
+        return False
+
+    print(f"Rollup table {stream} created successfully")
+    rollups.reset(stream, f"{namespace}.{entity.table_name}")
+    spool.discard(namespace, table_name)
+    dune_client.ledger.reset(stream)
+    if cursor is not None:
+        print(f"Rows already synced to {namespace}.{entity.table_name} are not in the rollup, "
+              f"only those after {cursor}")
+    return True
+
+def reconcile(args, envio_client, dune_client, transformer, checkpoints, spool, namespace, entity):
+    """
+    Find and upload the rows missing from the Dune table of an entity
+    :return: Reconciler report, an empty one if there is nothing to reconcile, or None if it could not run
+    """
+    stream = f"{namespace}.{entity.table_name}"
+    if not dune_client.table_exists(namespace, entity.table_name):
+        print(f"Table {stream} does not exist, nothing to reconcile")
+        return {}
+    queued = spool.pending(namespace, entity.table_name)
+    if queued:
+        # Their rows would look missing and be uploaded twice
+        print(f"{queued} chunks for {stream} are still in the spill queue, run the sync before reconciling")
+        return None
+    until, last_id = args.until, None
+    if until is None:
+        # Rows after the checkpoint are not synced yet; every row up to and including it is
+        cursor = checkpoints.load(stream)
+        if not cursor:
+            latest_id, latest_timestamp = dune_client.get_latest_id(namespace, entity.table_name, entity)
+            cursor = (to_unix_timestamp(latest_timestamp), latest_id) if latest_timestamp else None
+        if not cursor:
+            print(f"Table {stream} is empty, nothing to reconcile")
+            return {}
+        until, last_id = cursor
+    since = args.since
+    if since is None:
+        stats = envio_client.get_entity_stats(entity, until=until if last_id is None else until + 1)
+        if stats is None:
+            print(f"Error reading the {entity.entity} range to reconcile from Envio")
+            return None
+        if not stats["count"]:
+            print(f"No {entity.entity} rows in Envio before {until}, nothing to reconcile")
+            return {}
+        since = stats["min_timestamp"]
+    reconciler = Reconciler(envio_client, dune_client, transformer, namespace, entity, verify_ids=args.verify_ids)
+    return reconciler.run(since, until, repair=not args.dry_run, last_id=last_id)
+
+def stop_on_signals(stop):
+    """
+    Call stop() on the first SIGINT or SIGTERM so pending swaps are flushed and uploaded;
+    a second signal interrupts right away
+    :param stop: Function asking the sync to finish
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return  # Signal handlers can only be installed from the main thread
+    received = []
+
+    def handler(signum, frame):
+        if received:
+            raise KeyboardInterrupt
+        received.append(signum)
+        print(f"\nReceived {signal.Signals(signum).name}, flushing pending swaps (send it again to exit now)")
+        stop()
+
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+def compare_formats(envio_client, transformer, batch_size, link_mbps=None, entity=SWAP):
+    """
+    Compare the Dune payload formats on one real page of swaps
+    :param envio_client: EnvioClient to fetch the sample page from
+    :param transformer: DataTransformer used by the sync
+    :param batch_size: Number of swaps in the sample page
+    :param link_mbps: Optional uplink speed in megabits/s
+    :param entity: EntitySpec of the sample page
+    """
+    rows = envio_client.get_entities_after(entity, cursor=None, limit=batch_size)
+    if not rows:
+        print("Error: could not fetch a sample page from Envio")
+        return
+    batch = transformer.transform_batch(rows, entity)
+    print(f"\nPayload formats for one page of {len(batch)} {entity.entity} rows:")
+    print_payload_comparison(compare_payload_formats(batch, link_mbps=link_mbps))
+    print("\nSet DUNE_PAYLOAD_FORMAT to choose the format used for uploads")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(main()) 
\ No newline at end of file
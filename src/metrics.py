@@ -0,0 +1,400 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Request latencies range from a few milliseconds (local Envio) to minutes (large Dune inserts)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    Base of the metric types: one value per combination of label values.
+    labels() returns a child bound to those values, so hot paths can keep it around.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _default(self):
+        return self._children[()]
+
+    def collect(self):
+        """Lines of the Prometheus text exposition format for this metric"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            lines.extend(child.samples(self.name, self.labelnames, values))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labelnames, values):
+        return [f"{name}{_format_labels(labelnames, values)} {_format_value(self.value)}"]
+
+
+class Counter(_Metric):
+    """Monotonically increasing total, e.g. rows uploaded or requests sent"""
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function() at collection time, e.g. a queue size"""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float("nan")
+        return self.value
+
+    def samples(self, name, labelnames, values):
+        return [f"{name}{_format_labels(labelnames, values)} {_format_value(self.get())}"]
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, e.g. queue depth or checkpoint lag"""
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(tuple(str(value) for value in values), None)
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of the block in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by linear interpolation inside its bucket, as Prometheus' histogram_quantile does
+        :param q: Quantile between 0 and 1
+        :return: Estimated value, or None without observations
+        """
+        with self._lock:
+            counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]  # In the +Inf bucket: the highest finite bound is all we know
+
+    def samples(self, name, labelnames, values):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = f'le="{_format_value(float(bound))}"'
+            lines.append(f"{name}_bucket{_format_labels(labelnames, values, le)} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, values)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labelnames, values)} {cumulative}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets, e.g. request latency"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def quantile(self, q):
+        return self._default().quantile(q)
+
+
+class Registry:
+    """
+    Set of metrics rendered together in the Prometheus text format
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """
+        Write the metrics for the node_exporter textfile collector. The file is
+        replaced atomically, so the collector never reads a half-written file.
+        """
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+
+# Envio
+ENVIO_REQUESTS = REGISTRY.counter("envio_requests_total", "Envio GraphQL requests", ("operation", "status"))
+ENVIO_REQUEST_SECONDS = REGISTRY.histogram("envio_request_seconds", "Envio GraphQL request latency", ("operation",))
+ENVIO_ROWS = REGISTRY.counter("envio_rows_fetched_total", "Swaps fetched from Envio")
+
+# Transformation
+TRANSFORM_ROWS = REGISTRY.counter("transform_rows_total", "Swaps transformed into Dune rows")
+TRANSFORM_DROPPED_ROWS = REGISTRY.counter("transform_dropped_rows_total", "Swaps dropped for missing or malformed fields")
+TRANSFORM_SECONDS = REGISTRY.histogram("transform_seconds", "Time spent transforming one Envio page")
+TOKEN_LOOKUPS = REGISTRY.counter("token_metadata_lookups_total",
+                                 "Distinct token addresses looked up per page, by where the metadata came from",
+                                 ("result",))
+
+# Dune
+DUNE_REQUESTS = REGISTRY.counter("dune_requests_total", "Dune API requests", ("operation", "status"))
+DUNE_REQUEST_SECONDS = REGISTRY.histogram("dune_request_seconds", "Dune API request latency", ("operation",))
+DUNE_BYTES_SENT = REGISTRY.counter("dune_bytes_sent_total", "Payload bytes sent to the Dune insert endpoint")
+DUNE_ROWS_UPLOADED = REGISTRY.counter("dune_rows_uploaded_total", "Rows accepted by Dune")
+DUNE_DUPLICATES_SKIPPED = REGISTRY.counter("dune_duplicate_chunks_skipped_total",
+                                           "Chunks not sent because the upload ledger records them as accepted")
+DUNE_RETRIES = REGISTRY.counter("dune_retries_total", "Dune insert attempts that were retried", ("reason",))
+DUNE_THROTTLED = REGISTRY.counter("dune_throttled_total", "Dune responses with status 429, or 503 with Retry-After")
+DUNE_RATE = REGISTRY.gauge("dune_rate_limit", "Current Dune requests per second allowed by the rate limiter")
+DUNE_CONCURRENCY = REGISTRY.gauge("dune_concurrency_limit", "Current Dune uploads allowed in flight")
+
+# Pipeline
+QUEUE_DEPTH = REGISTRY.gauge("pipeline_queue_depth", "Batches waiting in a pipeline stage queue", ("stream", "stage"))
+SPOOL_CHUNKS = REGISTRY.gauge("spool_pending_chunks", "Encoded chunks waiting in the spill queue")
+SPOOL_BYTES = REGISTRY.gauge("spool_bytes", "Bytes held by the spill queue")
+BATCH_SECONDS = REGISTRY.histogram("pipeline_batch_seconds", "Seconds from fetching a batch to checkpointing it")
+SPOOL_CHUNK_SECONDS = REGISTRY.histogram("spool_chunk_seconds", "Seconds from spooling a chunk to Dune accepting it")
+CHECKPOINT_ROWS = REGISTRY.counter("checkpoint_rows_total", "Rows committed to the checkpoint store", ("stream",))
+CHECKPOINT_TIMESTAMP = REGISTRY.gauge("checkpoint_timestamp_seconds", "Swap timestamp of the last committed cursor", ("stream",))
+CHECKPOINT_LAG = REGISTRY.gauge("checkpoint_lag_seconds", "Seconds between now and the swap timestamp of the last committed cursor", ("stream",))
+DELIVERY_LAG_SECONDS = REGISTRY.histogram("delivery_lag_seconds", "Seconds from the newest swap of a chunk to Dune accepting it, once a follow run caught up",
+                                          buckets=(1.0, 2.5, 5.0, 10.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0))
+COALESCE_FLUSHES = REGISTRY.counter("coalesce_flushes_total", "Groups of batches spooled together, by what triggered the flush", ("reason",))
+ROLLUP_ROWS = REGISTRY.counter("rollup_delta_rows_total", "Hourly rollup delta rows queued for Dune", ("table",))
+DEDUP_IDS = REGISTRY.gauge("dedup_window_ids", "Ids tracked exactly by the replay filter, older ones are in its Bloom filter", ("stream",))
+FOLLOW_POLL_INTERVAL = REGISTRY.gauge("follow_poll_interval_seconds", "Current delay between Envio polls in follow mode", ("stream",))
+
+
+def count_bytes(body, counter=DUNE_BYTES_SENT):
+    """
+    Count the bytes of a request body as it is sent, without buffering it
+    :param body: bytes, an open file, or an iterable of bytes blocks
+    :return: A body requests can send the same way as the original one
+    """
+    if isinstance(body, (bytes, bytearray)):
+        counter.inc(len(body))
+        return body
+    if hasattr(body, "fileno"):
+        counter.inc(os.fstat(body.fileno()).st_size)
+        return body  # Kept as a file so requests still sends a Content-Length
+
+    def blocks():
+        for block in body:
+            counter.inc(len(block))
+            yield block
+    return blocks()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        payload = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a log line each
+
+
+def start_http_server(port, address="", registry=REGISTRY):
+    """
+    Serve the metrics at http://address:port/metrics from a daemon thread
+    :return: The HTTP server, call shutdown() to stop it
+    """
+    handler = type("MetricsHandler", (_Handler,), {"registry": registry})
+    server = ThreadingHTTPServer((address, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+class MetricsExporter:
+    """
+    Exposes the registry as configured in .env: an HTTP endpoint on METRICS_PORT
+    and/or a textfile at METRICS_TEXTFILE rewritten every METRICS_INTERVAL seconds.
+    Does nothing when neither is set.
+    """
+
+    def __init__(self, port=None, textfile=None, interval=None, registry=REGISTRY):
+        """
+        :param port: Port of the /metrics endpoint. If not provided, uses METRICS_PORT from .env
+        :param textfile: Path of the textfile. If not provided, uses METRICS_TEXTFILE from .env
+        :param interval: Seconds between textfile writes. If not provided, uses METRICS_INTERVAL from .env
+        """
+        port = port or os.getenv('METRICS_PORT')
+        self.port = int(port) if port else None
+        self.textfile = textfile or os.getenv('METRICS_TEXTFILE')
+        self.interval = float(interval or os.getenv('METRICS_INTERVAL', 15))
+        self.registry = registry
+        self._server = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.port:
+            self._server = start_http_server(self.port, registry=self.registry)
+            print(f"Serving metrics on http://localhost:{self.port}/metrics")
+        if self.textfile:
+            self._thread = threading.Thread(target=self._write_loop, name="metrics-textfile", daemon=True)
+            self._thread.start()
+            print(f"Writing metrics to {self.textfile} every {self.interval:g}s")
+        return self
+
+    def _write_loop(self):
+        while not self._stop.wait(self.interval):
+            self.registry.write_textfile(self.textfile)
+
+    def stop(self):
+        """Stop serving and write the final values to the textfile"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.registry.write_textfile(self.textfile)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
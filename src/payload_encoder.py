@@ -0,0 +1,263 @@
+import csv
+import io
+import json
+import re
+import time
+import zlib
+
+import numpy as np
+
+CSV_LINE_TERMINATOR = b"\r\n"  # Same terminator csv.writer uses, so payloads are byte-identical
+_CSV_SPECIAL = (b",", b'"', b"\r", b"\n")
+_JSON_ESCAPED = re.compile(rb'[\x00-\x1f"\\\x80-\xff]')  # Bytes json.dumps would escape
+
+
+def _bytes_values(column):
+    """
+    Render a column slice as a list of CSV-ready bytes, or None when a value needs
+    quoting or the column type has no vectorized rendering
+    """
+    kind = column.dtype.kind
+    if kind == "S":
+        for special in _CSV_SPECIAL:
+            if (np.char.find(column, special) >= 0).any():
+                return None
+        return column.tolist()
+    if kind in "fiu":
+        # repr() is what csv.writer writes for numbers
+        return _ascii_values(map(repr, column.tolist()))
+    if kind == "M":
+        return _ascii_values(np.datetime_as_string(column, unit="s").tolist())
+    return None
+
+
+def _ascii_values(strings):
+    """Encode many newline-free ASCII strings with one encode call instead of one per value"""
+    return "\n".join(strings).encode("ascii").split(b"\n")
+
+
+def _csv_block_fallback(batch, start, stop):
+    """Encode rows with the csv module, for blocks holding values that need quoting"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerows(batch.rows(start, stop))
+    return output.getvalue().encode("utf-8")
+
+
+def encode_csv_block(batch, start, stop):
+    """
+    Encode rows [start, stop) of a RowBatch as CSV bytes, without a header
+    :param batch: RowBatch to encode
+    :param start: First row index
+    :param stop: Row index to stop before
+    :return: bytes ending with a line terminator
+    """
+    columns = []
+    for column in batch.columns:
+        values = _bytes_values(column[start:stop])
+        if values is None:
+            return _csv_block_fallback(batch, start, stop)
+        columns.append(values)
+    return CSV_LINE_TERMINATOR.join(map(b",".join, zip(*columns))) + CSV_LINE_TERMINATOR
+
+
+def csv_header(fieldnames):
+    output = io.StringIO()
+    csv.writer(output).writerow(fieldnames)
+    return output.getvalue().encode("utf-8")
+
+
+def iter_csv(batch, start=0, stop=None, block_rows=2048):
+    """
+    Stream rows of a RowBatch as CSV: a header, then one bytes block per block_rows rows.
+    Every value is written exactly once, straight to bytes, so no full-chunk string or
+    second encoded copy is ever built.
+    :param batch: RowBatch to encode
+    :param start: First row index
+    :param stop: Row index to stop before. If not provided, runs to the end of the batch
+    :param block_rows: Rows per yielded block
+    """
+    stop = len(batch) if stop is None else min(stop, len(batch))
+    yield csv_header(batch.fieldnames)
+    for offset in range(start, stop, block_rows):
+        yield encode_csv_block(batch, offset, min(offset + block_rows, stop))
+
+
+def encode_csv(batch, start=0, stop=None):
+    """Whole CSV payload for rows [start, stop) as one bytes object"""
+    return b"".join(iter_csv(batch, start, stop))
+
+
+def _json_values(column, name):
+    """
+    Render a column slice as '"name":value' bytes for NDJSON rows, or None when a
+    value needs JSON escaping or the column type has no vectorized rendering
+    """
+    prefix = json.dumps(name).encode("utf-8") + b":"  # Compact separators, as json.dumps(separators=(",", ":"))
+    kind = column.dtype.kind
+    if kind == "S":
+        values = column.tolist()
+        if _JSON_ESCAPED.search(b"".join(values)):
+            return None
+        return [prefix + b'"' + value + b'"' for value in values]
+    if kind == "f":
+        if not np.isfinite(column).all():
+            return None  # NaN/inf have no JSON representation, let json.dumps decide
+        return [prefix + value for value in _ascii_values(map(repr, column.tolist()))]
+    if kind in "iu":
+        return [prefix + value for value in _ascii_values(map(repr, column.tolist()))]
+    if kind == "M":
+        return [prefix + b'"' + value + b'"' for value in _ascii_values(np.datetime_as_string(column, unit="s").tolist())]
+    return None
+
+
+def encode_ndjson_block(batch, start, stop):
+    """
+    Encode rows [start, stop) of a RowBatch as newline-delimited JSON objects
+    :return: bytes ending with a newline
+    """
+    columns = []
+    for name, column in zip(batch.fieldnames, batch.columns):
+        values = _json_values(column[start:stop], name)
+        if values is None:
+            lines = [json.dumps(row, separators=(",", ":")) for row in batch.dicts(start, stop)]
+            return ("\n".join(lines) + "\n").encode("utf-8")
+        columns.append(values)
+    return b"\n".join(b"{" + b",".join(row) + b"}" for row in zip(*columns)) + b"\n"
+
+
+def iter_ndjson(batch, start=0, stop=None, block_rows=2048):
+    """Stream rows of a RowBatch as NDJSON, one bytes block per block_rows rows"""
+    stop = len(batch) if stop is None else min(stop, len(batch))
+    for offset in range(start, stop, block_rows):
+        yield encode_ndjson_block(batch, offset, min(offset + block_rows, stop))
+
+
+def iter_gzip(blocks, level=6):
+    """Gzip-compress a stream of bytes blocks on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 writes a gzip container
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_parquet(batch, start=0, stop=None):
+    """
+    Encode rows [start, stop) as one Parquet file. Parquet is columnar, so the whole
+    chunk is written at once; requires the optional pyarrow package.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("The parquet payload format requires pyarrow: pipenv install pyarrow")
+    stop = len(batch) if stop is None else min(stop, len(batch))
+    arrays = []
+    for column in batch.columns:
+        part = column[start:stop]
+        if part.dtype.kind == "S":
+            part = part.astype("U")
+        arrays.append(pa.array(part))
+    output = io.BytesIO()
+    pq.write_table(pa.Table.from_arrays(arrays, names=batch.fieldnames), output, compression="zstd")
+    yield output.getvalue()
+
+
+class PayloadFormat:
+    """
+    How an upload chunk is serialized for the Dune insert endpoint
+    """
+    __slots__ = ("name", "content_type", "content_encoding", "encoder")
+
+    def __init__(self, name, content_type, encoder, content_encoding=None):
+        """
+        :param name: Name used in DUNE_PAYLOAD_FORMAT and upload_data(payload_format=...)
+        :param content_type: Content-Type header of the request
+        :param encoder: Function (batch, start, stop) -> iterator of bytes blocks
+        :param content_encoding: Optional Content-Encoding header, e.g. gzip
+        """
+        self.name = name
+        self.content_type = content_type
+        self.encoder = encoder
+        self.content_encoding = content_encoding
+
+    def iter_encode(self, batch, start=0, stop=None):
+        return self.encoder(batch, start, stop)
+
+    def encode(self, batch, start=0, stop=None):
+        return b"".join(self.encoder(batch, start, stop))
+
+    def headers(self, api_key):
+        headers = {
+            "X-DUNE-API-KEY": api_key,
+            "Content-Type": self.content_type
+        }
+        if self.content_encoding:
+            headers["Content-Encoding"] = self.content_encoding
+        return headers
+
+
+PAYLOAD_FORMATS = {
+    "csv": PayloadFormat("csv", "text/csv", iter_csv),
+    "csv_gzip": PayloadFormat("csv_gzip", "text/csv", lambda b, s, e: iter_gzip(iter_csv(b, s, e)), "gzip"),
+    "ndjson": PayloadFormat("ndjson", "application/x-ndjson", iter_ndjson),
+    "ndjson_gzip": PayloadFormat("ndjson_gzip", "application/x-ndjson", lambda b, s, e: iter_gzip(iter_ndjson(b, s, e)), "gzip"),
+    "parquet": PayloadFormat("parquet", "application/vnd.apache.parquet", iter_parquet),
+}
+
+
+def get_payload_format(name):
+    """
+    Look up a payload format by name
+    :param name: One of PAYLOAD_FORMATS
+    :return: PayloadFormat
+    """
+    try:
+        return PAYLOAD_FORMATS[name]
+    except KeyError:
+        raise ValueError(f"Unknown payload format {name!r}, expected one of {sorted(PAYLOAD_FORMATS)}")
+
+
+def compare_payload_formats(batch, link_mbps=None, formats=None):
+    """
+    Encode the same batch in every payload format and report size and speed
+    :param batch: RowBatch to encode
+    :param link_mbps: Optional uplink speed in megabits/s, to estimate transfer time per format
+    :param formats: Optional list of format names. If not provided, compares all of them
+    :return: List of dictionaries with format, bytes, ratio (vs plain CSV), encode_mb_s and rows_s
+    """
+    results = []
+    baseline = None
+    for name in formats or PAYLOAD_FORMATS:
+        payload_format = get_payload_format(name)
+        started = time.perf_counter()
+        try:
+            size = sum(len(block) for block in payload_format.iter_encode(batch))
+        except ValueError as e:
+            print(f"Skipping {name}: {e}")
+            continue
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        if baseline is None:
+            baseline = size
+        result = {
+            "format": name,
+            "bytes": size,
+            "ratio": size / baseline,
+            "encode_mb_s": size / 1e6 / elapsed,
+            "rows_s": len(batch) / elapsed,
+        }
+        if link_mbps:
+            # A request costs encoding plus transfer, the encoder streams so both overlap
+            result["transfer_s"] = max(size * 8 / (link_mbps * 1e6), elapsed)
+        results.append(result)
+    return results
+
+
+def print_payload_comparison(results):
+    print(f"\n{'format':<12} {'bytes':>12} {'vs csv':>7} {'encode MB/s':>12} {'rows/s':>10} {'est. send s':>12}")
+    for result in results:
+        transfer = f"{result['transfer_s']:.2f}" if "transfer_s" in result else "-"
+        print(f"{result['format']:<12} {result['bytes']:>12} {result['ratio']:>7.2f} "
+              f"{result['encode_mb_s']:>12.1f} {result['rows_s']:>10.0f} {transfer:>12}")
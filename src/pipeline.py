@@ -0,0 +1,478 @@
+import os
+import queue
+import threading
+import time
+
+import log
+import metrics
+from adaptive_poller import AdaptivePoller
+from coalescer import Coalescer
+from dedup import DedupWindow
+from entities import SWAP
+from payload_encoder import get_payload_format
+from row_batch import RowBatch
+from spill_queue import SpillQueue
+from upload_ledger import chunk_key
+
+_DONE = object()  # Sentinel passed down the queues once the fetch stage is exhausted
+MAX_RETRY_DELAY = 300  # Seconds, cap of the exponential delay between attempts of a spooled chunk
+
+
+class Batch:
+    """
+    One Envio page travelling through the pipeline
+    """
+    __slots__ = ("seq", "swaps", "rows", "first_cursor", "last_cursor", "fetched_at", "live")
+
+    def __init__(self, seq, swaps, first_cursor, last_cursor, live=False):
+        self.seq = seq
+        self.swaps = swaps
+        self.rows = None
+        self.first_cursor = first_cursor
+        self.last_cursor = last_cursor
+        self.fetched_at = time.time()
+        self.live = live  # Fetched in follow mode after the history was caught up
+
+
+class CommitTracker:
+    """
+    Commits finished batches to the checkpoint store strictly in fetch order.
+    Uploads may complete out of order, but the checkpoint only moves over a
+    contiguous prefix of finished batches, so a restart never skips a batch.
+    """
+
+    def __init__(self, checkpoints, stream, next_seq=0):
+        self.checkpoints = checkpoints
+        self.stream = stream
+        self.next_seq = next_seq
+        self.cursor = None
+        self.rows_committed = 0
+        self._finished = {}
+        self._lock = threading.Lock()
+
+    def finish(self, batch, rows_uploaded):
+        """
+        Mark a batch as uploaded and commit every batch that is now contiguous
+        :param batch: The finished Batch
+        :param rows_uploaded: Number of rows Dune accepted for it
+        """
+        with self._lock:
+            self._finished[batch.seq] = (batch, rows_uploaded)
+            while self.next_seq in self._finished:
+                done, rows = self._finished.pop(self.next_seq)
+                self.checkpoints.commit(self.stream, done.first_cursor, done.last_cursor, rows)
+                self.cursor = done.last_cursor
+                self.rows_committed += rows
+                self.next_seq += 1
+                metrics.CHECKPOINT_ROWS.labels(self.stream).inc(rows)
+                metrics.BATCH_SECONDS.observe(time.time() - done.fetched_at)
+                metrics.CHECKPOINT_TIMESTAMP.labels(self.stream).set(done.last_cursor[0])
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._finished)
+
+
+class SyncPipeline:
+    """
+    Fetch -> transform -> spool -> upload pipeline with one thread per stage (and
+    several upload threads), connected by bounded queues. Envio and Dune round-trips
+    overlap, so throughput approaches the slowest stage instead of the sum of all of them.
+    Encoded chunks go through a durable SpillQueue: a batch is checkpointed as soon as
+    its chunks are on disk, and upload workers drain the queue independently, so the
+    fetch side keeps going while Dune is slow or down and no Envio page is fetched twice.
+    Small transformed batches are coalesced before they are spooled, so a trickle of new
+    swaps becomes a few full inserts instead of one request per page. With a RollupStore,
+    the hourly rollup of the entity is updated as its rows are spooled and its delta rows
+    go through the same spill queue to the rollup table.
+    In follow mode the fetch stage never runs out: it tails Envio at an adaptive interval.
+    """
+
+    def __init__(self, envio_client, dune_client, transformer, checkpoints, namespace, table_name,
+                 batch_size, upload_workers=None, queue_size=None, max_retries=3, retry_delay=5,
+                 max_empty_responses=3, stream=None, until=None, spool=None, chunk_size=None,
+                 follow=False, poller=None, coalescer=None, entity=None, rollups=None):
+        """
+        :param envio_client: EnvioClient to fetch swaps from
+        :param dune_client: DuneClient to upload to
+        :param transformer: DataTransformer converting Envio swaps to Dune rows
+        :param checkpoints: CheckpointStore recording committed batches
+        :param namespace: Your Dune username
+        :param table_name: Name of the Dune table
+        :param batch_size: Number of swaps per Envio page
+        :param upload_workers: Number of concurrent upload threads. If not provided, uses UPLOAD_WORKERS from .env
+        :param queue_size: Capacity of each stage queue. If not provided, uses PIPELINE_QUEUE_SIZE from .env
+        :param max_retries: Attempts per Envio fetch, and per spooled chunk before it is parked for the next run
+        :param retry_delay: Seconds to wait between attempts
+        :param max_empty_responses: Consecutive empty pages before the source is considered exhausted
+        :param stream: Checkpoint stream to commit to. If not provided, uses "namespace.table_name"
+        :param until: Optional exclusive upper bound on swap timestamps, used by backfill partitions
+        :param spool: SpillQueue holding encoded chunks. If not provided, opens SPOOL_PATH from .env
+        :param chunk_size: Rows per insert request. If not provided, uses the DuneClient batch size
+        :param follow: Keep polling Envio after reaching the end of the data, until stop() is called
+        :param poller: AdaptivePoller pacing the polls in follow mode. If not provided, uses FOLLOW_* from .env
+        :param coalescer: Coalescer buffering transformed batches before they are spooled. If not provided, uses COALESCE_* from .env
+        :param entity: EntitySpec of the synced rows. If not provided, syncs Swap
+        :param rollups: Optional RollupStore maintaining the rollup of the entity, see EntitySpec.rollup
+        """
+        self.entity = entity or SWAP
+        self.envio_client = envio_client
+        self.dune_client = dune_client
+        self.transformer = transformer
+        self.checkpoints = checkpoints
+        self.namespace = namespace
+        self.table_name = table_name
+        self.stream = stream or f"{namespace}.{table_name}"
+        self.until = until
+        self.batch_size = batch_size
+        self.upload_workers = upload_workers or int(os.getenv('UPLOAD_WORKERS', 2))
+        self.queue_size = queue_size or int(os.getenv('PIPELINE_QUEUE_SIZE', 2))
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_empty_responses = max_empty_responses
+        self.spool = spool if spool is not None else SpillQueue()
+        self.chunk_size = chunk_size or dune_client.batch_size
+        self.follow = follow
+        self.poller = poller or AdaptivePoller()
+        self.coalescer = coalescer or Coalescer()
+        self.rollups = rollups if self.entity.rollup is not None else None
+
+        self._transform_queue = queue.Queue(maxsize=self.queue_size)
+        self._spool_queue = queue.Queue(maxsize=self.queue_size)
+        self._stop = threading.Event()
+        self._shutdown = threading.Event()
+        self._spooling_done = threading.Event()
+        self._error = None
+        self._tracker = None
+        self._uploaded_before = 0
+
+    def run(self, cursor):
+        """
+        Sync everything after the given cursor and return once the source is exhausted
+        (or stop() was called in follow mode) and the spill queue is drained
+        :param cursor: (timestamp, id) to resume after, or None to start from the beginning
+        :return: True if every fetched batch was uploaded, False otherwise
+        """
+        self._tracker = CommitTracker(self.checkpoints, self.stream)
+        self._tracker.cursor = cursor
+        self._uploaded_before = self.spool.uploaded(self.stream, self.table_name)
+        started = time.time()
+        self._register_metrics()
+
+        fetch_worker = self._follow_worker if self.follow else self._fetch_worker
+        threads = [
+            threading.Thread(target=self._guard, args=(fetch_worker, cursor), name="fetch"),
+            threading.Thread(target=self._guard, args=(self._transform_worker,), name="transform"),
+            threading.Thread(target=self._guard, args=(self._spool_worker,), name="spool"),
+        ]
+        for i in range(self.upload_workers):
+            threads.append(threading.Thread(target=self._guard, args=(self._upload_worker,), name=f"upload-{i}"))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._unregister_metrics()
+
+        elapsed = time.time() - started
+        rows = self._tracker.rows_committed
+        rate = self.rows_uploaded / elapsed if elapsed > 0 else 0.0
+        print(f"\nPipeline {self.stream} finished: {rows} rows checkpointed, {self.rows_uploaded} rows uploaded in {elapsed:.1f}s ({rate:.1f} rows/s)")
+        print(f"Last committed cursor: {self._tracker.cursor}")
+        stats = self.spool.stats(self.max_retries)
+        parked = stats["pending"] if self.follow else stats["parked"]
+        if parked and not self._error:
+            self._error = f"{parked} chunks could not be uploaded and stay in the spill queue for the next run"
+        if self._error:
+            print(f"Pipeline stopped with error: {self._error}")
+            return False
+        return True
+
+    def _register_metrics(self):
+        """Gauges read at scrape time, so the hot path pays nothing for them"""
+        tracker, spool = self._tracker, self.spool
+        metrics.QUEUE_DEPTH.labels(self.stream, "transform").set_function(self._transform_queue.qsize)
+        metrics.QUEUE_DEPTH.labels(self.stream, "spool").set_function(self._spool_queue.qsize)
+        metrics.CHECKPOINT_LAG.labels(self.stream).set_function(
+            lambda: time.time() - tracker.cursor[0] if tracker.cursor else float("nan"))
+        # Process-wide gauges of the shared spill queue, not of this pipeline, so a finished one is not kept alive
+        metrics.SPOOL_CHUNKS.set_function(lambda: spool.stats()["pending"])
+        metrics.SPOOL_BYTES.set_function(lambda: spool.bytes)
+
+    def _unregister_metrics(self):
+        metrics.QUEUE_DEPTH.remove(self.stream, "transform")
+        metrics.QUEUE_DEPTH.remove(self.stream, "spool")
+        metrics.CHECKPOINT_LAG.remove(self.stream)
+        metrics.DEDUP_IDS.remove(self.stream)
+        if self.follow:
+            metrics.FOLLOW_POLL_INTERVAL.remove(self.stream)
+
+    def stop(self):
+        """
+        Ask a running pipeline to finish: fetching stops, pending swaps are flushed and
+        run() returns once everything fetched so far is spooled and uploaded. Safe to
+        call from a signal handler.
+        """
+        self._shutdown.set()
+
+    @property
+    def rows_uploaded(self):
+        """Rows of this stream Dune accepted during the run, counted by the spill queue whichever pipeline uploaded them"""
+        return self.spool.uploaded(self.stream, self.table_name) - self._uploaded_before
+
+    @property
+    def cursor(self):
+        """Last committed (timestamp, id) cursor"""
+        return self._tracker.cursor if self._tracker else None
+
+    def _guard(self, target, *args):
+        try:
+            target(*args)
+        except Exception as e:
+            self._fail(f"{threading.current_thread().name} stage crashed: {e}")
+
+    def _fail(self, message):
+        if self._error is None:
+            self._error = message
+        self._stop.set()
+        self._shutdown.set()
+
+    def _put(self, q, item):
+        """Blocking put that gives up once the pipeline is stopping"""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q, timeout=None):
+        """Blocking get that gives up once the pipeline is stopping, or returns None after timeout seconds"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._stop.is_set():
+            wait = 0.5 if deadline is None else min(0.5, deadline - time.monotonic())
+            if wait <= 0:
+                return None
+            try:
+                return q.get(timeout=wait)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fetch(self, cursor):
+        for attempt in range(1, self.max_retries + 1):
+            swaps = self.envio_client.get_entities_after(self.entity, cursor=cursor, limit=self.batch_size, until=self.until)
+            if swaps is not None:
+                return swaps
+            if attempt < self.max_retries:
+                log.warning("Error fetching from Envio, retrying in %s seconds... (Attempt %d/%d)", self.retry_delay, attempt + 1, self.max_retries)
+                time.sleep(self.retry_delay)
+        return None
+
+    def _dedup_window(self):
+        """Ids seen by this run, with a fixed memory budget"""
+        return DedupWindow(cursor_field=self.entity.cursor_field, id_field=self.entity.id_field)
+
+    def _fetch_worker(self, cursor):
+        seq = 0
+        consecutive_empty_responses = 0
+        seen = self._dedup_window()
+        try:
+            while not self._stop.is_set():
+                swaps = self._fetch(cursor)
+                if swaps is None:
+                    self._fail(f"Failed to fetch from Envio after {self.max_retries} attempts")
+                    return
+
+                if not swaps:
+                    consecutive_empty_responses += 1
+                    if consecutive_empty_responses >= self.max_empty_responses:
+                        print(f"No more {self.entity.entity} rows for {self.stream} after {self.max_empty_responses} consecutive empty responses")
+                        return
+                    print(f"Empty response from Envio ({consecutive_empty_responses}/{self.max_empty_responses}), retrying...")
+                    time.sleep(self.retry_delay)
+                    continue
+                consecutive_empty_responses = 0
+
+                last_cursor = self.entity.cursor(swaps[-1])
+                # Pages start strictly after the cursor, so only ids replayed by the indexer are dropped here
+                new_swaps = seen.filter(swaps)
+                metrics.DEDUP_IDS.labels(self.stream).set(len(seen))
+
+                first_cursor = self.entity.cursor(new_swaps[0]) if new_swaps else None
+                print(f"Fetched batch {seq}: {len(new_swaps)} new swaps up to cursor {last_cursor}")
+                if not self._put(self._transform_queue, Batch(seq, new_swaps, first_cursor, last_cursor)):
+                    return
+                seq += 1
+                cursor = last_cursor
+        finally:
+            self._put(self._transform_queue, _DONE)
+
+    def _follow_worker(self, cursor):
+        seq = 0
+        seen = self._dedup_window()
+        caught_up = False  # Set after the first page that was not full: later rows are fresh
+        try:
+            while not self._shutdown.is_set():
+                swaps = self._fetch(cursor)
+                if swaps is None:
+                    # A daemon outlives indexer outages: wait for the longest poll interval and try again
+                    log.warning("Failed to fetch from Envio after %d attempts, polling again in %s seconds", self.max_retries, self.poller.max_interval)
+                    self._shutdown.wait(self.poller.max_interval)
+                    continue
+
+                new_swaps = []
+                if swaps:
+                    last_cursor = self.entity.cursor(swaps[-1])
+                    new_swaps = seen.filter(swaps)
+                    metrics.DEDUP_IDS.labels(self.stream).set(len(seen))
+                    first_cursor = self.entity.cursor(new_swaps[0]) if new_swaps else None
+                    # Handed on right away: the coalescer groups the small pages of quiet polls
+                    log.info("Fetched batch %d: %d new swaps up to cursor %s", seq, len(new_swaps), last_cursor)
+                    if not self._put(self._transform_queue, Batch(seq, new_swaps, first_cursor, last_cursor, caught_up)):
+                        return
+                    seq += 1
+                    cursor = last_cursor
+                page_full = len(swaps) >= self.batch_size
+                caught_up = caught_up or not page_full
+                delay = self.poller.observe(len(new_swaps), page_full=page_full)
+                metrics.FOLLOW_POLL_INTERVAL.labels(self.stream).set(self.poller.interval)
+                log.debug("Next Envio poll in %.1f seconds", delay)
+                self._shutdown.wait(delay)
+        finally:
+            self._put(self._transform_queue, _DONE)
+
+    def _transform_worker(self):
+        try:
+            while True:
+                batch = self._get(self._transform_queue)
+                if batch is _DONE:
+                    return
+                # The compact RowBatch replaces the raw page, which is dropped right away
+                batch.rows = self.transformer.transform_batch(batch.swaps, self.entity)
+                batch.swaps = None
+                if not self._put(self._spool_queue, batch):
+                    return
+        finally:
+            self._put(self._spool_queue, _DONE)
+
+    def _spool_worker(self):
+        coalescer = self.coalescer
+        try:
+            while True:
+                batch = self._get(self._spool_queue, coalescer.timeout())
+                if batch is _DONE:
+                    break
+                if batch is not None:
+                    coalescer.add(batch)
+                reason = coalescer.due()
+                if reason is None:
+                    continue
+                metrics.COALESCE_FLUSHES.labels(reason).inc()
+                if not self._spool_batches(coalescer.flush()):
+                    return
+            if len(coalescer) and not self._stop.is_set():
+                metrics.COALESCE_FLUSHES.labels("end").inc()
+                self._spool_batches(coalescer.flush())
+        finally:
+            self._spooling_done.set()
+
+    def _spool_batches(self, batches):
+        """
+        Encode a group of consecutive batches into chunks on disk and checkpoint them
+        :return: False if the pipeline stopped before every chunk was written
+        """
+        rows = RowBatch.concat([batch.rows for batch in batches])
+        last = batches[-1]
+        for start in range(0, len(rows), self.chunk_size):
+            stop = min(start + self.chunk_size, len(rows))
+            # Identifies the chunk in the upload ledger, so it is never inserted twice
+            key = chunk_key(rows, start, stop, self.entity.id_column) if self.dune_client.ledger is not None else None
+            if not self._spool_chunk(rows, start, stop, self.table_name, key, last, self.entity.id_column):
+                return False
+        if self.rollups is not None and not self._spool_rollup(batches):
+            return False
+        # Every chunk of the group is on disk: it is safe to move the checkpoint past its batches
+        for batch in batches:
+            self._tracker.finish(batch, len(batch.rows))
+            batch.rows = None
+        return True
+
+    def _spool_rollup(self, batches):
+        """
+        Fold a group of spooled batches into the rollup and spool its delta rows. Runs before
+        the checkpoint moves: pages fetched again after a crash in between are skipped by the rollup
+        :return: False if the pipeline stopped before every delta row was written
+        """
+        table = f"{self.namespace}.{self.entity.rollup_table}"
+        self.rollups.apply(self.stream, table, self.entity.rollup, [(batch.rows, batch.last_cursor) for batch in batches])
+
+        def put(deltas, key):
+            return self._spool_chunk(deltas, 0, len(deltas), self.entity.rollup_table, key, batches[-1],
+                                     id_column="delta_seq")
+        return self.rollups.flush(table, self.entity.rollup, put, self.chunk_size)
+
+    def _spool_chunk(self, rows, start, stop, table_name, key, last, id_column=None):
+        """
+        Encode rows [start, stop) of a RowBatch into one chunk in the spill queue
+        :param table_name: Dune table the chunk goes to
+        :param key: Optional upload ledger key of the chunk
+        :param last: Last Batch the rows come from
+        :param id_column: Optional column holding the ids of the key, to look the chunk up in Dune
+        :return: False if the pipeline stopped before the chunk was written
+        """
+        meta = {
+            "namespace": self.namespace,
+            "table_name": table_name,
+            "payload_format": self.dune_client.payload_format,
+            "rows": stop - start,
+            "stream": self.stream,
+            "batch_seq": last.seq,
+            "last_cursor": list(last.last_cursor),
+        }
+        if key is not None:
+            meta["key"] = list(key)
+            meta["id_column"] = id_column
+        if last.live and table_name == self.table_name:
+            # Only the rows of a caught up daemon say how far Dune is behind the indexer
+            meta["live"] = True
+        encoding = get_payload_format(self.dune_client.payload_format)
+        return self.spool.put(encoding.iter_encode(rows, start, stop), meta, self._stop) is not None
+
+    def _upload_worker(self):
+        while not self._stop.is_set():
+            # A daemon keeps retrying failed chunks instead of parking them for a next run
+            item = self.spool.get(timeout=0.5, max_attempts=None if self.follow else self.max_retries)
+            if item is None:
+                stats = self.spool.stats(self.max_retries)
+                if self._spooling_done.is_set() and not stats["claimed"] and (
+                        stats["pending"] == stats["parked"] or self.follow):
+                    # Nothing left that can be uploaded in this run; a stopping daemon leaves
+                    # chunks that are waiting for a retry in the spill queue for its next start
+                    return
+                continue
+
+            meta, path = item
+            label = f"spooled chunk {meta['seq']} ({meta['rows']} rows of {meta['namespace']}.{meta['table_name']})"
+            result = self.dune_client.upload_payload(
+                namespace=meta['namespace'],
+                table_name=meta['table_name'],
+                path=path,
+                payload_format=meta['payload_format'],
+                label=label,
+                rows=meta['rows'],
+                key=tuple(meta['key']) if meta.get('key') else None,
+                id_column=meta.get('id_column')
+            )
+            if result is None:
+                attempts = self.spool.attempts(meta['seq']) + 1
+                delay = min(self.retry_delay * (2 ** (attempts - 1)), MAX_RETRY_DELAY)
+                log.warning("Failed to upload %s, keeping it queued and retrying in %s seconds (Attempt %d/%d)", label, delay, attempts, self.max_retries)
+                self.spool.nack(meta['seq'], delay)
+                continue
+
+            self.spool.ack(meta['seq'])
+            metrics.SPOOL_CHUNK_SECONDS.observe(time.time() - meta['queued_at'])
+            if meta.get('live'):
+                metrics.DELIVERY_LAG_SECONDS.observe(time.time() - meta['last_cursor'][0])
@@ -0,0 +1,224 @@
+import cProfile
+import dis
+import json
+import os
+import platform
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from json.decoder import JSONDecoder
+
+import graphql_stream
+from checkpoint_store import CheckpointStore
+from data_transformer import DataTransformer
+from dune_client import DuneClient
+from envio_client import EnvioClient
+from payload_encoder import csv_header, encode_csv_block, encode_ndjson_block, iter_parquet
+from rate_limiter import AdaptiveRateLimiter
+
+# Stage name -> functions whose time and allocations are attributed to it. Python functions
+# count their cumulative time; C functions (given by their pstats name) their own time.
+# Stages may nest: envio_request includes json_decode and network_wait, upload includes
+# network_wait and rate_limit_wait, and encoding happens inside spool or upload.
+STAGES = {
+    "envio_request": [EnvioClient._execute, EnvioClient._stream],
+    "json_decode": [JSONDecoder.raw_decode, graphql_stream._decode_items],
+    "transform": [DataTransformer.transform_batch],
+    "encode": [encode_csv_block, encode_ndjson_block, csv_header, iter_parquet,
+               "<method 'compress' of 'zlib.Compress' objects>",
+               "<method 'flush' of 'zlib.Compress' objects>"],
+    "spool_write": ["<method 'write' of '_io.BufferedWriter' objects>", "<built-in method posix.fsync>"],
+    "upload": [DuneClient._upload_chunk],
+    "rate_limit_wait": [AdaptiveRateLimiter.acquire],
+    "network_wait": ["<method 'recv_into' of '_socket.socket' objects>",
+                     "<method 'sendall' of '_socket.socket' objects>",
+                     "<method 'connect' of '_socket.socket' objects>",
+                     "<method 'read' of '_ssl._SSLSocket' objects>",
+                     "<method 'write' of '_ssl._SSLSocket' objects>",
+                     "<method 'do_handshake' of '_ssl._SSLSocket' objects>",
+                     "<built-in method _socket.getaddrinfo>"],
+    "checkpoint": [CheckpointStore.commit],
+}
+
+
+def _code_range(function):
+    """(filename, first line, last line) covered by a Python function, nested code included"""
+    code = function.__code__
+    last = code.co_firstlineno
+    pending = [code]
+    while pending:
+        current = pending.pop()
+        last = max([last] + [line for _, line in dis.findlinestarts(current)])
+        pending.extend(const for const in current.co_consts if hasattr(const, 'co_code'))
+    return code.co_filename, code.co_firstlineno, last
+
+
+class _Snapshot:
+    """Stats of a profiler that may still be running in another thread, in the form pstats loads"""
+
+    def __init__(self, profile):
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        pass
+
+
+class SyncProfiler:
+    """
+    Runs a block under cProfile (in every thread it starts) and tracemalloc, then
+    writes a JSON report with the time and memory of each pipeline stage, the top
+    functions and the top allocation sites, plus the raw pstats file next to it.
+    Two reports can be diffed stage by stage to find where a sync got slower.
+    """
+
+    def __init__(self, path, sample_interval=1.0, traceback_depth=25, top=30):
+        """
+        :param path: Path of the JSON report. The pstats file is written to the same path with .pstats
+        :param sample_interval: Seconds between tracemalloc snapshots used to find each stage's peak memory
+        :param traceback_depth: Frames kept per allocation, deep enough to reach the stage functions
+        :param top: Number of functions and allocation sites listed in the report
+        """
+        self.path = path
+        self.sample_interval = sample_interval
+        self.traceback_depth = traceback_depth
+        self.top = top
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._peak_bytes = {name: 0 for name in STAGES}
+        self._peak_snapshot = None
+        self._peak_total = 0
+        self._ranges = {
+            name: [_code_range(target) for target in targets if not isinstance(target, str)]
+            for name, targets in STAGES.items()
+        }
+        self._attribution = {}
+
+    def __enter__(self):
+        self._started = time.time()
+        self._started_perf = time.perf_counter()
+        tracemalloc.start(self.traceback_depth)
+        # The sampler starts before the hook is installed, so it is not profiled itself
+        self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+        self._sampler.start()
+        # From 3.12 cProfile uses sys.monitoring, where the one profiler already sees every thread
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._start_thread)
+        self._main_profile = self._new_profile()
+        self._main_profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._main_profile.disable()
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        wall = time.perf_counter() - self._started_perf
+        self._stop.set()
+        self._sampler.join()
+        self._sample()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats = pstats.Stats(*[_Snapshot(profile) for profile in self._profiles])
+        report = self._report(stats, wall, peak)
+        with open(self.path, 'w') as f:
+            json.dump(report, f, indent=2)
+        stats.dump_stats(os.path.splitext(self.path)[0] + '.pstats')
+        print(f"\nProfile written to {self.path}")
+        for name, stage in report["stages"].items():
+            print(f"  {name:<16} {stage['seconds']:>9.3f}s {stage['calls']:>9} calls {stage['peak_live_bytes'] / 1e6:>9.1f} MB peak")
+        return False
+
+    def _new_profile(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        return profile
+
+    def _start_thread(self, frame, event, arg):
+        # Called once by every new thread: replace this hook with a profiler of its own
+        self._new_profile().enable()
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.sample_interval):
+            self._sample()
+
+    def _sample(self):
+        snapshot = tracemalloc.take_snapshot()
+        by_stage = dict.fromkeys(STAGES, 0)
+        total = 0
+        for statistic in snapshot.statistics('traceback'):
+            total += statistic.size
+            stage = self._stage_of(statistic.traceback)
+            if stage is not None:
+                by_stage[stage] += statistic.size
+        for name, size in by_stage.items():
+            self._peak_bytes[name] = max(self._peak_bytes[name], size)
+        if total >= self._peak_total:
+            self._peak_total = total
+            self._peak_snapshot = snapshot
+
+    def _stage_of(self, traceback):
+        """Innermost stage whose code appears in an allocation traceback"""
+        key = tuple((frame.filename, frame.lineno) for frame in traceback)
+        if key in self._attribution:
+            return self._attribution[key]
+        stage = None
+        for filename, lineno in reversed(key):  # Frames go from the oldest to the most recent
+            for name, ranges in self._ranges.items():
+                if any(filename == path and first <= lineno <= last for path, first, last in ranges):
+                    stage = name
+            if stage is not None:
+                break
+        self._attribution[key] = stage
+        return stage
+
+    def _report(self, stats, wall, peak):
+        stages = {}
+        for name, targets in STAGES.items():
+            seconds, calls = 0.0, 0
+            for target in targets:
+                for (filename, lineno, function), (cc, nc, tt, ct, callers) in stats.stats.items():
+                    if isinstance(target, str):
+                        if filename == '~' and function == target:
+                            seconds += tt
+                            calls += nc
+                    elif (filename == target.__code__.co_filename and lineno == target.__code__.co_firstlineno
+                          and function == target.__code__.co_name):
+                        seconds += ct
+                        calls += nc
+            stages[name] = {"seconds": seconds, "calls": calls, "peak_live_bytes": self._peak_bytes[name]}
+
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+        allocations = []
+        if self._peak_snapshot is not None:
+            for statistic in self._peak_snapshot.statistics('lineno')[:self.top]:
+                frame = statistic.traceback[0]
+                allocations.append({"site": f"{frame.filename}:{frame.lineno}", "bytes": statistic.size, "blocks": statistic.count})
+
+        return {
+            "started_at": self._started,
+            "wall_seconds": wall,
+            "argv": sys.argv,
+            "python": platform.python_version(),
+            "threads": len(self._profiles),
+            "note": "Stage seconds are summed over threads and may nest, see profiler.STAGES",
+            "stages": stages,
+            "memory": {
+                "peak_traced_bytes": peak,
+                "top_allocations_at_peak": allocations,
+            },
+            "top_functions": [
+                {
+                    "function": pstats.func_std_string(key),
+                    "calls": nc,
+                    "tottime": tt,
+                    "cumtime": ct,
+                }
+                for key, (cc, nc, tt, ct, callers) in functions
+            ],
+        }
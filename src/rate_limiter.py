@@ -0,0 +1,183 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+
+
+def parse_retry_after(value, now=None):
+    """
+    Parse a Retry-After header
+    :param value: Delay in seconds or an HTTP date
+    :param now: Current Unix time, defaults to time.time()
+    :return: Seconds to wait, or None if the header is missing or malformed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - (now or time.time()))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket plus AIMD concurrency window shared by every request to one API.
+    Tokens refill at `rate` requests/s and cap the request rate; the window caps the
+    number of requests in flight. Both grow additively while requests succeed and are
+    halved when the server throttles, and a Retry-After pauses everyone until it expires.
+    X-RateLimit-Remaining/Reset headers cap the rate to what is left of the quota.
+    Threads wait with slot(), coroutines with async_slot(); both share the same budget.
+    """
+
+    def __init__(self, rate=None, max_rate=None, max_concurrency=None, min_rate=0.1):
+        """
+        :param rate: Initial requests per second. If not provided, uses DUNE_RATE_LIMIT from .env
+        :param max_rate: Ceiling for the request rate. If not provided, uses DUNE_MAX_RATE_LIMIT from .env
+        :param max_concurrency: Ceiling for requests in flight. If not provided, uses DUNE_MAX_CONCURRENCY from .env
+        :param min_rate: Floor for the request rate after repeated throttling
+        """
+        self.rate = float(rate or os.getenv('DUNE_RATE_LIMIT', 1.0))
+        self.max_rate = float(max_rate or os.getenv('DUNE_MAX_RATE_LIMIT', 10.0))
+        self.max_concurrency = int(max_concurrency or os.getenv('DUNE_MAX_CONCURRENCY', 4))
+        self.min_rate = min_rate
+        self.concurrency = 1.0  # Fractional so the window grows by 1 per window of successes
+        self.in_flight = 0
+        self.throttled = 0
+        self._tokens = 1.0
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._quota_rate = None
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        rate = min(self.rate, self._quota_rate) if self._quota_rate else self.rate
+        self._tokens = min(max(1.0, rate), self._tokens + (now - self._refilled_at) * rate)
+        self._refilled_at = now
+        return rate
+
+    def _try_acquire(self):
+        """
+        Take a token and an in-flight slot if both are available; call with the condition held
+        :return: 0 if acquired, else seconds to wait, or None to wait for a release()
+        """
+        now = time.monotonic()
+        rate = self._refill(now)
+        wait = self._paused_until - now
+        if wait <= 0 and self.in_flight >= int(self.concurrency):
+            return None
+        if wait <= 0 and self._tokens < 1.0:
+            return (1.0 - self._tokens) / rate
+        if wait <= 0:
+            self._tokens -= 1.0
+            self.in_flight += 1
+            return 0
+        return wait
+
+    def acquire(self):
+        """Block until a token and an in-flight slot are available"""
+        with self._cond:
+            while True:
+                wait = self._try_acquire()
+                if wait == 0:
+                    return
+                self._cond.wait(wait)
+
+    async def async_acquire(self, poll_interval=0.01):
+        """
+        Wait without blocking the event loop until a token and an in-flight slot are available
+        :param poll_interval: Seconds between checks while every slot is taken
+        """
+        while True:
+            with self._cond:
+                wait = self._try_acquire()
+            if wait == 0:
+                return
+            await asyncio.sleep(poll_interval if wait is None else wait)
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Hold one request slot for the duration of the block"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        """Hold one request slot for the duration of an async with block"""
+        await self.async_acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def on_success(self, headers=None):
+        """Additive increase after a request the server accepted"""
+        with self._cond:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / max(self.concurrency, 1.0))
+            self.rate = min(self.max_rate, self.rate + 0.1)
+            self._read_quota(headers)
+            self._cond.notify_all()
+
+    def on_throttled(self, headers=None, default_delay=5.0):
+        """
+        Multiplicative decrease after a 429 (or 503), pausing every caller for Retry-After
+        :param headers: Response headers
+        :param default_delay: Pause when the server sent no Retry-After
+        :return: Seconds every caller is paused for
+        """
+        delay = parse_retry_after((headers or {}).get('Retry-After'))
+        if delay is None:
+            delay = default_delay
+        with self._cond:
+            self.throttled += 1
+            self.concurrency = max(1.0, self.concurrency / 2)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._read_quota(headers)
+            self._cond.notify_all()
+        return delay
+
+    def _read_quota(self, headers):
+        """Cap the rate so the remaining quota lasts until the reset"""
+        if not headers:
+            return
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining, reset = float(remaining), float(reset)
+        except ValueError:
+            return
+        # Reset is either seconds from now or a Unix timestamp
+        seconds = reset - time.time() if reset > 1e9 else reset
+        if remaining <= 0:
+            self._paused_until = max(self._paused_until, time.monotonic() + max(seconds, 0.0))
+            self._quota_rate = None
+        else:
+            self._quota_rate = max(self.min_rate, remaining / max(seconds, 1.0))
+
+    def snapshot(self):
+        """Current limiter state, for logging"""
+        with self._cond:
+            return {
+                "rate": self.rate,
+                "quota_rate": self._quota_rate,
+                "concurrency": int(self.concurrency),
+                "in_flight": self.in_flight,
+                "throttled": self.throttled
+            }
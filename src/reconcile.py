@@ -0,0 +1,229 @@
+import math
+import os
+import time
+import zlib
+from collections import Counter
+
+import log
+from entities import SWAP
+
+
+def id_digest(ids):
+    """
+    Order-independent digest of a collection of ids: the sum of their CRC32, the
+    same value DuneClient.get_bucket_digests computes in SQL
+    """
+    return sum(zlib.crc32(row_id.encode("utf-8")) for row_id in ids)
+
+
+def split_range(start, end, parts):
+    """
+    Split [start, end) into at most parts consecutive ranges of whole seconds
+    :return: Boundaries start = b0 < b1 < ... < bn = end
+    """
+    step = max(1, math.ceil((end - start) / parts))
+    return list(range(start, end, step)) + [end]
+
+
+class Reconciler:
+    """
+    Finds and repairs the rows of one entity that are missing from its Dune table,
+    without reloading it. A time range is split into buckets whose row counts are
+    compared between Envio (aliased aggregate queries) and Dune (one grouped SQL
+    query returning counts and id digests per bucket). Only the buckets that differ
+    are split again, recursively, until a bucket holds at most leaf_rows rows or
+    spans min_seconds; the ids of those leaves are then compared one by one and the
+    missing rows are uploaded, batch_size at a time. A day with one gap costs a few
+    queries per level instead of a full reload.
+
+    Counts alone miss a bucket where a missing row is hidden by a duplicate; with
+    verify_ids the buckets whose counts match are also compared by id digest, which
+    costs a scan of their ids in Envio. Rows Dune holds twice or that Envio no longer
+    has (e.g. after a reorg) are reported, they cannot be deleted from an upload table.
+    """
+
+    def __init__(self, envio_client, dune_client, transformer, namespace, entity=None,
+                 buckets=None, leaf_rows=None, min_seconds=None, verify_ids=False, batch_size=None):
+        """
+        :param envio_client: EnvioClient to count and fetch rows from
+        :param dune_client: DuneClient to compare with and upload the missing rows to
+        :param transformer: DataTransformer converting the missing rows
+        :param namespace: Your Dune username
+        :param entity: EntitySpec of the table. If not provided, reconciles Swap
+        :param buckets: Buckets a mismatching range is split into. If not provided, uses RECONCILE_BUCKETS from .env
+        :param leaf_rows: Rows below which a bucket is compared id by id. If not provided, uses RECONCILE_LEAF_ROWS from .env
+        :param min_seconds: Narrowest bucket, in seconds. If not provided, uses RECONCILE_MIN_SECONDS from .env
+        :param verify_ids: Also compare the id digests of buckets whose counts match
+        :param batch_size: Missing rows uploaded per insert. If not provided, uses BATCH_SIZE from .env
+        """
+        self.envio_client = envio_client
+        self.dune_client = dune_client
+        self.transformer = transformer
+        self.namespace = namespace
+        self.entity = entity or SWAP
+        self.buckets = int(buckets or os.getenv('RECONCILE_BUCKETS', 24))
+        self.leaf_rows = int(leaf_rows or os.getenv('RECONCILE_LEAF_ROWS', 10000))
+        self.min_seconds = int(min_seconds or os.getenv('RECONCILE_MIN_SECONDS', 60))
+        self.verify_ids = verify_ids
+        self.batch_size = int(batch_size or os.getenv('BATCH_SIZE', 10000))
+        self.table_name = self.entity.table_name
+        self._keys = self.entity.keys()
+        self.report = None
+        self._missing = []  # Rows waiting to be uploaded, from any number of leaves
+
+    def run(self, start=None, end=None, repair=True, last_id=None):
+        """
+        Reconcile a time range
+        :param start: Inclusive Unix timestamp. If not provided, the oldest row in Envio
+        :param end: Exclusive Unix timestamp. If not provided, just after the newest row in Envio
+        :param repair: Upload the missing rows; if False, only report them
+        :param last_id: Optional id of the last synced row of second `end`, e.g. from the checkpoint cursor:
+                        the rows of that second up to and including it are compared id by id too
+        :return: Report dictionary (buckets compared, mismatching leaves, missing, inserted and extra rows),
+                 or None if Envio or Dune could not be queried
+        """
+        started = time.time()
+        self.report = {"buckets": 0, "queries": 0, "leaves": [], "missing": 0, "inserted": 0, "extra": 0}
+        self._missing = []
+        if start is None or end is None:
+            stats = self.envio_client.get_entity_stats(self.entity)
+            if stats is None:
+                print("Error reading the Envio range to reconcile")
+                return None
+            if not stats["count"]:
+                print(f"No {self.entity.entity} rows in Envio, nothing to reconcile")
+                return self._report(started)
+            start = stats["min_timestamp"] if start is None else start
+            end = stats["max_timestamp"] + 1 if end is None else end
+
+        through = f" and up to {last_id}" if last_id is not None else ""
+        print(f"Reconciling {self.namespace}.{self.table_name} from {start} to {end}{through} "
+              f"({self.buckets} buckets per level, leaves of {self.leaf_rows} rows)")
+        if end > start and not self._reconcile(start, end, repair):
+            return None
+        if last_id is not None:
+            self.report["buckets"] += 1
+            if not self._repair(end, end + 1, repair, last_id):
+                return None
+        if not self._upload():
+            return None
+        return self._report(started)
+
+    def _report(self, started):
+        report = self.report
+        report["seconds"] = time.time() - started
+        print(f"Reconciliation of {self.namespace}.{self.table_name}: {report['buckets']} buckets compared, "
+              f"{len(report['leaves'])} mismatching ranges, {report['missing']} rows missing, "
+              f"{report['inserted']} inserted, {report['extra']} extra rows in Dune, {report['seconds']:.1f}s")
+        return report
+
+    def _reconcile(self, start, end, repair):
+        """Compare the buckets of [start, end) and narrow down or repair the ones that differ"""
+        bounds = split_range(start, end, self.buckets)
+        envio_counts = self.envio_client.get_entity_counts(self.entity, bounds)
+        dune_buckets = self.dune_client.get_bucket_digests(self.namespace, self.table_name, bounds, self.entity)
+        self.report["queries"] += 2
+        if envio_counts is None or dune_buckets is None:
+            print(f"Error comparing buckets {start}-{end}")
+            return False
+        self.report["buckets"] += len(envio_counts)
+        envio_digests = None
+        if self.verify_ids:
+            envio_digests = self._envio_digests(bounds, envio_counts, dune_buckets)
+            if envio_digests is None:
+                return False
+
+        for index, envio_count in enumerate(envio_counts):
+            low, high = bounds[index], bounds[index + 1]
+            dune_count, dune_digest = dune_buckets[index]
+            if envio_count == dune_count and (envio_digests is None or envio_digests[index] == dune_digest):
+                continue
+            log.info("Bucket %d-%d differs: %d rows in Envio, %d in Dune", low, high, envio_count, dune_count)
+            if max(envio_count, dune_count) <= self.leaf_rows or high - low <= self.min_seconds:
+                if not self._repair(low, high, repair):
+                    return False
+            elif not self._reconcile(low, high, repair):
+                return False
+        return True
+
+    def _envio_rows(self, entity, start, end, cursor=None):
+        """Yield the rows of [start, end) from Envio, page by page, after the cursor if one is given"""
+        cursor = cursor or (start, "")
+        while True:
+            rows = self.envio_client.get_entities_after(entity, cursor=cursor, until=end)
+            if rows is None:
+                raise RuntimeError(f"could not fetch {entity.entity} rows {start}-{end} from Envio")
+            if not rows:
+                return
+            yield from rows
+            cursor = entity.cursor(rows[-1])
+
+    def _envio_digests(self, bounds, envio_counts, dune_buckets):
+        """Id digests of the buckets whose counts match, from one scan of their ids"""
+        digests = [0] * len(envio_counts)
+        for index, envio_count in enumerate(envio_counts):
+            if not envio_count or envio_count != dune_buckets[index][0]:
+                continue  # Empty, or already known to differ
+            try:
+                rows = self._envio_rows(self._keys, bounds[index], bounds[index + 1])
+                digests[index] = id_digest(self.entity.dune_id(row) for row in rows)
+            except RuntimeError as e:
+                print(f"Error scanning ids: {e}")
+                return None
+        return digests
+
+    def _repair(self, start, end, repair, last_id=None):
+        """
+        Compare the ids of one leaf bucket and upload the rows Dune is missing
+        :param last_id: Optional id of the last synced row: rows after it are not compared, they are not due yet
+        """
+        dune_ids = self.dune_client.get_ids(self.namespace, self.table_name, start, end, self.entity)
+        self.report["queries"] += 1
+        if dune_ids is None:
+            return False
+        try:
+            envio_rows = list(self._envio_rows(self.entity, start, end))
+            if last_id is not None:
+                # Selected by the indexer with the sync's own cursor filter, so both agree on the id order
+                after = {row[self.entity.id_field] for row in self._envio_rows(self._keys, start, end, (start, last_id))}
+                envio_rows = [row for row in envio_rows if row[self.entity.id_field] not in after]
+        except RuntimeError as e:
+            print(f"Error fetching the rows to repair: {e}")
+            return False
+
+        stored = Counter(dune_ids)
+        envio_ids = set()
+        missing = []
+        for row in envio_rows:
+            row_id = self.entity.dune_id(row)
+            envio_ids.add(row_id)
+            if row_id not in stored:
+                missing.append(row)
+        extra = sum(count - 1 if row_id in envio_ids else count for row_id, count in stored.items())
+        if last_id is not None and not missing and not extra:
+            return True  # The last synced second is compared on every run, it only counts when it differs
+        self.report["leaves"].append((start, end))
+        self.report["missing"] += len(missing)
+        self.report["extra"] += extra
+        print(f"Range {start}-{end}: {len(envio_rows)} rows in Envio, {len(dune_ids)} in Dune, "
+              f"{len(missing)} missing, {extra} extra")
+
+        if repair:
+            self._missing.extend(missing)
+            if len(self._missing) >= self.batch_size:
+                return self._upload()
+        return True
+
+    def _upload(self):
+        """Upload the missing rows collected so far"""
+        while self._missing:
+            rows = self._missing[:self.batch_size]
+            batch = self.transformer.transform_batch(rows, self.entity)
+            # Dune was just seen to lack these rows, whatever the upload ledger remembers
+            if self.dune_client.upload_data(self.namespace, self.table_name, batch, entity=self.entity,
+                                            skip_uploaded=False) is None:
+                print(f"Error uploading {len(rows)} missing rows to {self.namespace}.{self.table_name}")
+                return False
+            del self._missing[:len(rows)]
+            self.report["inserted"] += len(batch)
+        return True
@@ -0,0 +1,235 @@
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+import metrics
+from data_transformer import local_datetime64
+from row_batch import RowBatch
+from upload_ledger import chunk_key
+
+_GROUP_SEPARATOR = "\x1f"  # Joins the group column values of a rollup row into one key
+
+
+def _hour_starts(times):
+    """A datetime64 array truncated to the hour, as int64 seconds: the hour keys of rollup rows"""
+    return times.astype("datetime64[h]").astype("datetime64[s]").astype(np.int64)
+
+
+def _strings(column):
+    """A RowBatch column as a list of str"""
+    if column.dtype.kind == "S":
+        return column.astype("U").tolist()
+    return [str(value) for value in column.tolist()]
+
+
+class RollupStore:
+    """
+    Local state of the hourly rollups maintained next to the synced tables. Dune upload
+    tables are append-only, so a rollup is not updated in place: every group of spooled
+    rows adds delta rows (its swap count, sums and newly seen distinct values per hour and
+    group), and SUM over a rollup table grouped by hour and group gives the totals. The
+    distinct values already counted are kept on disk, which is what makes the unique
+    counts additive. Deltas are queued in the same transaction that records the rows they
+    came from, and leave the queue only once they are in the spill queue, so each one is
+    uploaded exactly once (the upload ledger drops a chunk queued twice by a crash, and the
+    delta_seq column holding their queue position lets it look a chunk up in Dune). Rows of
+    a stream come in cursor order, so the distinct values of the hours every stream of a
+    rollup has passed can no longer change and are dropped.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: SQLite file to use. If not provided, uses ROLLUP_PATH from .env,
+                     or the checkpoint file CHECKPOINT_PATH
+        """
+        self.path = path or os.getenv('ROLLUP_PATH') or os.getenv('CHECKPOINT_PATH', 'checkpoints.db')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS rollup_cursors (
+                    stream TEXT PRIMARY KEY,
+                    cursor_timestamp INTEGER NOT NULL,
+                    cursor_id TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS rollup_members (
+                    rollup TEXT NOT NULL,
+                    hour INTEGER NOT NULL,
+                    group_key TEXT NOT NULL,
+                    member TEXT NOT NULL,
+                    PRIMARY KEY (rollup, hour, group_key, member)
+                ) WITHOUT ROWID
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS rollup_deltas (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    rollup TEXT NOT NULL,
+                    row TEXT NOT NULL
+                )
+            """)
+
+    def cursor(self, stream):
+        """
+        :param stream: Checkpoint stream
+        :return: (timestamp, id) of the last row folded into a rollup from the stream, or None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT cursor_timestamp, cursor_id FROM rollup_cursors WHERE stream = ?", (stream,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def start(self, stream, cursor):
+        """
+        Record where a stream will start folding rows, unless it already did. Holds the values of
+        the hours after the cursor until the stream passed them, e.g. for backfill partitions that
+        have not fetched anything yet
+        :param stream: Checkpoint stream
+        :param cursor: (timestamp, id) at or before the first row of the stream
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO rollup_cursors (stream, cursor_timestamp, cursor_id) VALUES (?, ?, ?)",
+                (stream, cursor[0], cursor[1])
+            )
+
+    def forget(self, stream):
+        """Drop the cursor of a stream that will not fold rows anymore, e.g. a finished backfill partition"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM rollup_cursors WHERE stream = ?", (stream,))
+
+    def apply(self, stream, table, rollup, pages):
+        """
+        Fold pages of spooled rows into a rollup, queueing its delta rows for Dune
+        :param stream: Checkpoint stream the pages belong to
+        :param table: "namespace.table_name" of the rollup table
+        :param rollup: RollupSpec
+        :param pages: List of (RowBatch, (timestamp, id) cursor of its last row), in fetch order.
+                      Pages up to the last one already applied for the stream are skipped, so the
+                      pages fetched again after a restart from an older checkpoint are not counted twice
+        :return: Number of delta rows queued
+        """
+        main = stream.split("#", 1)[0]
+        applied = self.cursor(stream)
+        pages = [(rows, cursor) for rows, cursor in pages if applied is None or tuple(cursor) > applied]
+        if not pages:
+            return 0
+        batch = RowBatch.concat([rows for rows, _ in pages])
+        cursor = pages[-1][1]
+
+        # Rows -> index of their (hour, group values) rollup row
+        hours = _hour_starts(batch.column(rollup.time_column))
+        groups = [_strings(batch.column(name)) for name in rollup.group_by]
+        codes = {}
+        index = np.fromiter((codes.setdefault(key, len(codes)) for key in zip(hours.tolist(), *groups)),
+                            dtype=np.int64, count=len(batch))
+        keys = list(codes)
+        counts = np.bincount(index, minlength=len(keys))
+        sums = [np.bincount(index, weights=batch.column(column).astype(np.float64), minlength=len(keys))
+                for _, column in rollup.sums]
+        members = [set() for _ in keys]
+        if rollup.distinct:
+            for code, member in zip(index.tolist(), _strings(batch.column(rollup.distinct[1]))):
+                members[code].add(member)
+
+        with self._lock, self._conn:
+            new_members = []
+            for (hour, *group), values in zip(keys, members):
+                # One statement per rollup row; the change count tells how many of its values are new
+                changes = self._conn.total_changes
+                group_key = _GROUP_SEPARATOR.join(group)
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO rollup_members (rollup, hour, group_key, member) VALUES (?, ?, ?, ?)",
+                    ((table, hour, group_key, member) for member in values)
+                )
+                new_members.append(self._conn.total_changes - changes)
+            deltas = [
+                [*keys[code], int(counts[code]), *(float(column[code]) for column in sums)]
+                + ([new_members[code]] if rollup.distinct else [])
+                for code in range(len(keys))
+            ]
+            self._conn.executemany("INSERT INTO rollup_deltas (rollup, row) VALUES (?, ?)",
+                                   [(table, json.dumps(delta)) for delta in deltas])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rollup_cursors (stream, cursor_timestamp, cursor_id) VALUES (?, ?, ?)",
+                (stream, cursor[0], cursor[1])
+            )
+            # The main stream and its backfill partitions feed the rollup; none of them goes back
+            # before its cursor, so the hours before the lowest one are complete. Timestamp columns
+            # hold local times, so the cursor is converted the same way as the rows before comparing
+            low = self._conn.execute(
+                "SELECT min(cursor_timestamp) FROM rollup_cursors WHERE stream = ? OR substr(stream, 1, ?) = ?",
+                (main, len(main) + 1, main + "#")
+            ).fetchone()[0]
+            self._conn.execute("DELETE FROM rollup_members WHERE rollup = ? AND hour < ?",
+                               (table, int(_hour_starts(local_datetime64(np.array([low], dtype=np.int64)))[0])))
+        metrics.ROLLUP_ROWS.labels(table).inc(len(deltas))
+        return len(deltas)
+
+    def flush(self, table, rollup, put, chunk_size):
+        """
+        Hand the queued delta rows of a rollup over, chunk by chunk
+        :param table: "namespace.table_name" of the rollup table
+        :param rollup: RollupSpec
+        :param put: Function(RowBatch, key) storing a chunk durably and returning True, or False if it could not;
+                    key is (content hash, first delta, last delta), stable if the same chunk is put again
+        :param chunk_size: Delta rows per chunk
+        :return: True once the queue is empty, False if put failed
+        """
+        with self._lock:
+            while True:
+                rows = self._conn.execute(
+                    "SELECT seq, row FROM rollup_deltas WHERE rollup = ? ORDER BY seq LIMIT ?", (table, chunk_size)
+                ).fetchall()
+                if not rows:
+                    return True
+                batch = self._batch(rollup, [seq for seq, _ in rows], [json.loads(row) for _, row in rows])
+                key = (chunk_key(batch, 0, len(batch), "hour")[0], str(rows[0][0]), str(rows[-1][0]))
+                if not put(batch, key):
+                    return False
+                with self._conn:
+                    self._conn.execute("DELETE FROM rollup_deltas WHERE rollup = ? AND seq <= ?", (table, rows[-1][0]))
+
+    @staticmethod
+    def _batch(rollup, seqs, deltas):
+        """RowBatch of delta rows and their queue positions, in the column order of the rollup table"""
+        values = list(zip(*deltas))
+        columns = {"hour": np.array(values[0], dtype=np.int64).astype("datetime64[s]")}
+        position = 1
+        for name in rollup.group_by:
+            columns[name] = np.array(values[position], dtype=object)
+            position += 1
+        columns[rollup.count] = np.array(values[position], dtype=np.int64)
+        for offset, (name, _) in enumerate(rollup.sums, start=position + 1):
+            columns[name] = np.array(values[offset], dtype=np.float64)
+        if rollup.distinct:
+            columns[rollup.distinct[0]] = np.array(values[-1], dtype=np.int64)
+        columns["delta_seq"] = np.array(seqs, dtype=np.int64)
+        return RowBatch.from_columns(columns, rollup.fieldnames)
+
+    def pending(self, table):
+        """:return: Number of delta rows of a rollup not handed over yet"""
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM rollup_deltas WHERE rollup = ?", (table,)).fetchone()[0]
+
+    def reset(self, table, stream):
+        """
+        Forget a rollup, e.g. after its Dune table was created anew
+        :param table: "namespace.table_name" of the rollup table
+        :param stream: Checkpoint stream of the rolled up table; its backfill partitions are forgotten too
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM rollup_members WHERE rollup = ?", (table,))
+            self._conn.execute("DELETE FROM rollup_deltas WHERE rollup = ?", (table,))
+            self._conn.execute("DELETE FROM rollup_cursors WHERE stream = ? OR stream LIKE ?", (stream, f"{stream}#%"))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
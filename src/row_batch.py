@@ -0,0 +1,113 @@
+import numpy as np
+
+
+def _compact(values):
+    """
+    Store a column in the smallest array type that round-trips it: ASCII strings
+    (hex ids and addresses) become fixed-width bytes, everything else stays as is.
+    """
+    array = values if isinstance(values, np.ndarray) else np.array(values, dtype=object)
+    if array.dtype == object and len(array) and all(isinstance(v, str) for v in array):
+        try:
+            return np.array(array.tolist(), dtype="S")
+        except UnicodeEncodeError:
+            return array
+    return array
+
+
+def _python_values(column, start, stop):
+    """Materialize part of a column as plain Python values (str, float, ISO timestamp)"""
+    part = column[start:stop]
+    kind = part.dtype.kind
+    if kind == "S":
+        return part.astype("U").tolist()
+    if kind == "M":
+        return np.datetime_as_string(part, unit="s").tolist()
+    return part.tolist()
+
+
+class RowBatch:
+    """
+    Column-backed batch of transformed rows. Strings are kept as fixed-width byte
+    arrays and timestamps as datetime64, so a batch costs a fraction of the
+    equivalent list of dicts. Rows are only materialized in small slices through
+    the rows()/dicts() generators, which is how batches are streamed to Dune.
+    """
+    __slots__ = ("fieldnames", "columns")
+
+    def __init__(self, fieldnames, columns):
+        """
+        :param fieldnames: Column names, in output order
+        :param columns: Equally long numpy arrays, one per field name
+        """
+        self.fieldnames = list(fieldnames)
+        self.columns = list(columns)
+
+    @classmethod
+    def from_columns(cls, columns, fieldnames=None):
+        """
+        Build a batch from a dictionary of column name -> array-like, compacting string columns
+        :param columns: Dictionary of column name -> values
+        :param fieldnames: Optional column order. If not provided, uses the dictionary order
+        """
+        fieldnames = list(fieldnames or columns.keys())
+        return cls(fieldnames, [_compact(columns[name]) for name in fieldnames])
+
+    @classmethod
+    def from_dicts(cls, rows, fieldnames=None):
+        """
+        Build a batch from a list of row dictionaries
+        :param rows: List of dictionaries sharing the same keys
+        :param fieldnames: Optional column order. If not provided, uses the keys of the first row
+        """
+        if fieldnames is None:
+            fieldnames = list(rows[0].keys()) if rows else []
+        return cls.from_columns({name: [row.get(name) for row in rows] for name in fieldnames}, fieldnames)
+
+    @classmethod
+    def concat(cls, batches):
+        """
+        Join batches with the same fields into one, in order
+        :param batches: List of RowBatch
+        :return: RowBatch holding the rows of every batch
+        """
+        batches = [batch for batch in batches if len(batch)] or batches[:1]
+        if len(batches) == 1:
+            return batches[0]
+        return cls(batches[0].fieldnames, [np.concatenate(columns) for columns in zip(*(batch.columns for batch in batches))])
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def column(self, name):
+        return self.columns[self.fieldnames.index(name)]
+
+    def slice(self, start, stop):
+        """Batch over rows [start, stop) sharing memory with this one"""
+        return RowBatch(self.fieldnames, [column[start:stop] for column in self.columns])
+
+    def row(self, index):
+        """One row as a dictionary of plain Python values"""
+        return dict(zip(self.fieldnames, next(self.rows(index, index + 1))))
+
+    def rows(self, start=0, stop=None, chunk_size=4096):
+        """
+        Yield rows as tuples of plain Python values, materializing at most chunk_size rows at a time
+        :param start: First row index
+        :param stop: Row index to stop before. If not provided, runs to the end of the batch
+        :param chunk_size: Number of rows converted per step
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        for offset in range(start, stop, chunk_size):
+            end = min(offset + chunk_size, stop)
+            yield from zip(*(_python_values(column, offset, end) for column in self.columns))
+
+    def dicts(self, start=0, stop=None):
+        """Yield rows as dictionaries, in the format transform_swaps has always returned"""
+        for values in self.rows(start, stop):
+            yield dict(zip(self.fieldnames, values))
+
+    @property
+    def nbytes(self):
+        """Approximate memory held by the column arrays"""
+        return sum(column.nbytes for column in self.columns)
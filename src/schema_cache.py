@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+import time
+
+
+class SchemaCache:
+    """
+    On-disk cache of the GraphQL introspection result, so a process start does not
+    pay for an introspection round-trip. An entry is valid for one endpoint URL and
+    for ttl seconds; EnvioClient also refreshes it early when a query no longer
+    validates against the cached schema.
+    """
+
+    def __init__(self, path=None, ttl=None):
+        """
+        :param path: Cache file. If not provided, uses ENVIO_SCHEMA_CACHE from .env
+        :param ttl: Seconds an entry stays valid. If not provided, uses ENVIO_SCHEMA_TTL from .env
+        """
+        self.path = path or os.getenv('ENVIO_SCHEMA_CACHE', '.envio_schema.json')
+        self.ttl = float(ttl if ttl is not None else os.getenv('ENVIO_SCHEMA_TTL', 24 * 3600))
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def load(self, url):
+        """
+        :param url: GraphQL endpoint the schema belongs to
+        :return: Introspection result dictionary, or None if missing, stale or unreadable
+        """
+        if self.ttl <= 0:
+            return None
+        try:
+            with open(self.path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("key") != self._key(url) or time.time() - entry.get("fetched_at", 0) > self.ttl:
+            return None
+        return entry.get("introspection")
+
+    def save(self, url, introspection):
+        """Store an introspection result, replacing the file atomically"""
+        if self.ttl <= 0:
+            return
+        entry = {"key": self._key(url), "fetched_at": time.time(), "introspection": introspection}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not write the schema cache {self.path}: {e}")
+
+    def invalidate(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,205 @@
+import json
+import os
+import threading
+import time
+
+
+class SpillQueue:
+    """
+    Durable FIFO of encoded upload chunks, one file per chunk in a directory.
+    A chunk is written (and fsynced) before its batch is checkpointed, so once it
+    is queued the Envio side never has to fetch it again. Upload workers claim the
+    oldest chunk, delete it once Dune accepted it, or release it with a retry delay
+    when the upload failed, so failures stay queued until they go through.
+    The bytes held on disk are bounded: put() blocks while the queue is full.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        """
+        :param path: Directory holding the chunks. If not provided, uses SPOOL_PATH from .env
+        :param max_bytes: Bytes on disk before put() blocks. If not provided, uses SPOOL_MAX_BYTES from .env
+        """
+        self.path = path or os.getenv('SPOOL_PATH', 'spool')
+        self.max_bytes = int(max_bytes or os.getenv('SPOOL_MAX_BYTES', 512 * 1024 * 1024))
+        os.makedirs(self.path, exist_ok=True)
+        self._cond = threading.Condition()
+        self._chunks = {}  # seq -> metadata
+        self._claimed = set()
+        self._retry_at = {}
+        self._attempts = {}
+        self._uploaded = {}  # (stream, table_name) -> rows acknowledged, whichever worker uploaded them
+        self.bytes = 0
+
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(self.path, name))  # Left over by a crash mid-write
+            elif name.endswith('.json'):
+                with open(os.path.join(self.path, name)) as f:
+                    meta = json.load(f)
+                self._chunks[meta['seq']] = meta
+                self.bytes += meta['bytes']
+        self._next_seq = max(self._chunks, default=0) + 1
+        if self._chunks:
+            print(f"Spill queue {self.path}: {len(self._chunks)} chunks ({self.bytes} bytes) pending from a previous run")
+
+    def _payload_path(self, seq):
+        return os.path.join(self.path, f"{seq:012d}.chunk")
+
+    def _meta_path(self, seq):
+        return os.path.join(self.path, f"{seq:012d}.json")
+
+    def put(self, blocks, meta, stop_event=None):
+        """
+        Durably queue one encoded chunk
+        :param blocks: Iterable of bytes blocks making up the payload
+        :param meta: JSON-serializable dictionary describing the chunk (target table, format, rows, ...)
+        :param stop_event: Optional threading.Event that aborts waiting for free space
+        :return: Sequence number of the chunk, or None if aborted
+        """
+        with self._cond:
+            while self.bytes >= self.max_bytes and self._chunks:
+                if stop_event is not None and stop_event.is_set():
+                    return None
+                self._cond.wait(0.5)
+            seq = self._next_seq
+            self._next_seq += 1
+
+        payload_path = self._payload_path(seq)
+        size = 0
+        with open(payload_path + '.tmp', 'wb') as f:
+            for block in blocks:
+                f.write(block)
+                size += len(block)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(payload_path + '.tmp', payload_path)
+
+        meta = dict(meta, seq=seq, bytes=size, queued_at=time.time())
+        meta_path = self._meta_path(seq)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # The metadata file is what makes a chunk visible, so it is written last
+        os.replace(meta_path + '.tmp', meta_path)
+
+        with self._cond:
+            self._chunks[seq] = meta
+            self.bytes += size
+            self._cond.notify_all()
+        return seq
+
+    def get(self, timeout=None, max_attempts=None):
+        """
+        Claim the oldest chunk that is not claimed and not waiting for a retry
+        :param timeout: Seconds to wait for a chunk. If not provided, waits forever
+        :param max_attempts: Skip chunks that already failed this many times in this process
+        :return: (metadata, payload path), or None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                next_retry = None
+                for seq in sorted(self._chunks):
+                    if seq in self._claimed:
+                        continue
+                    if max_attempts is not None and self._attempts.get(seq, 0) >= max_attempts:
+                        continue
+                    retry_at = self._retry_at.get(seq, 0)
+                    if retry_at > now:
+                        next_retry = retry_at if next_retry is None else min(next_retry, retry_at)
+                        continue
+                    self._claimed.add(seq)
+                    return self._chunks[seq], self._payload_path(seq)
+                wait = None if deadline is None else deadline - now
+                if next_retry is not None:
+                    wait = next_retry - now if wait is None else min(wait, next_retry - now)
+                if wait is not None and wait <= 0:
+                    if deadline is not None and now >= deadline:
+                        return None
+                    continue
+                self._cond.wait(wait)
+
+    def ack(self, seq):
+        """Delete a chunk Dune has accepted, counting its rows as uploaded for the stream that spooled it"""
+        meta = self._remove(seq)
+        if meta:
+            key = (meta.get('stream'), meta.get('table_name'))
+            with self._cond:
+                self._uploaded[key] = self._uploaded.get(key, 0) + meta['rows']
+
+    def _remove(self, seq):
+        """Delete a chunk from the queue and the disk, returning its metadata"""
+        for path in (self._meta_path(seq), self._payload_path(seq)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._cond:
+            meta = self._chunks.pop(seq, None)
+            if meta:
+                self.bytes -= meta['bytes']
+            self._claimed.discard(seq)
+            self._retry_at.pop(seq, None)
+            self._attempts.pop(seq, None)
+            self._cond.notify_all()
+        return meta
+
+    def nack(self, seq, delay=0):
+        """
+        Release a chunk whose upload failed, keeping it queued
+        :param seq: Sequence number of the chunk
+        :param delay: Seconds before the chunk can be claimed again
+        """
+        with self._cond:
+            self._claimed.discard(seq)
+            self._attempts[seq] = self._attempts.get(seq, 0) + 1
+            self._retry_at[seq] = time.monotonic() + delay
+            self._cond.notify_all()
+
+    def discard(self, namespace, table_name):
+        """
+        Drop every unclaimed chunk bound for a table, e.g. after the table was deleted
+        :return: Number of chunks dropped
+        """
+        with self._cond:
+            seqs = [seq for seq, meta in self._chunks.items()
+                    if seq not in self._claimed and meta.get('namespace') == namespace
+                    and meta.get('table_name') == table_name]
+        for seq in seqs:
+            self._remove(seq)
+        return len(seqs)
+
+    def pending(self, namespace, table_name):
+        """Number of chunks still queued for a table"""
+        with self._cond:
+            return sum(1 for meta in self._chunks.values()
+                       if meta.get('namespace') == namespace and meta.get('table_name') == table_name)
+
+    def uploaded(self, stream, table_name):
+        """Rows of a stream acknowledged for a table since the queue was opened"""
+        with self._cond:
+            return self._uploaded.get((stream, table_name), 0)
+
+    def attempts(self, seq):
+        with self._cond:
+            return self._attempts.get(seq, 0)
+
+    def stats(self, max_attempts=None):
+        """
+        Counters of the queue
+        :param max_attempts: Count chunks that failed this many times as parked
+        :return: Dictionary with pending, claimed, parked and bytes
+        """
+        with self._cond:
+            parked = 0
+            if max_attempts is not None:
+                parked = sum(1 for seq in self._chunks
+                             if seq not in self._claimed and self._attempts.get(seq, 0) >= max_attempts)
+            return {
+                "pending": len(self._chunks),
+                "claimed": len(self._claimed),
+                "parked": parked,
+                "bytes": self.bytes
+            }
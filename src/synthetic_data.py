@@ -0,0 +1,63 @@
+import random
+
+SYNTHETIC_START_TIMESTAMP = 1700000000
+
+
+def generate_swaps(count, seed=0, start_timestamp=SYNTHETIC_START_TIMESTAMP, swaps_per_second=3, tokens=20, senders=500):
+    """
+    Generate deterministic swaps shaped like the Envio Swap entity
+    :param count: Number of swaps
+    :param seed: Random seed, the same seed always produces the same swaps
+    :param start_timestamp: Timestamp of the first swap
+    :param swaps_per_second: Swaps sharing each timestamp
+    :param tokens: Number of distinct token addresses
+    :param senders: Number of distinct sender addresses
+    :return: List of swap dictionaries ordered by (timeStamp, id)
+    """
+    rng = random.Random(seed)
+    token_addresses = [f"0x{rng.getrandbits(160):040x}" for _ in range(tokens)]
+    sender_addresses = [f"0x{rng.getrandbits(160):040x}" for _ in range(senders)]
+    swaps = []
+    for i in range(count):
+        token_in, token_out = rng.sample(token_addresses, 2)
+        swaps.append({
+            "id": f"0x{rng.getrandbits(256):064x}_{i}",
+            "timeStamp": str(start_timestamp + i // swaps_per_second),
+            "_tokenIn": token_in,
+            "_tokenOut": token_out,
+            "_amountIn": str(rng.randint(10 ** 6, 10 ** 24)),
+            "_amountOut": str(rng.randint(10 ** 6, 10 ** 24)),
+            "from": rng.choice(sender_addresses),
+        })
+    swaps.sort(key=lambda swap: (int(swap["timeStamp"]), swap["id"]))
+    return swaps
+
+
+def generate_transfers(count, seed=0, start_timestamp=SYNTHETIC_START_TIMESTAMP, transfers_per_second=2, tokens=20, holders=500):
+    """
+    Generate deterministic token transfers shaped like an Envio Transfer entity
+    :param count: Number of transfers
+    :param seed: Random seed, the same seed always produces the same transfers
+    :param start_timestamp: Timestamp of the first transfer
+    :param transfers_per_second: Transfers sharing each timestamp
+    :param tokens: Number of distinct token addresses
+    :param holders: Number of distinct holder addresses
+    :return: List of transfer dictionaries ordered by (timeStamp, id)
+    """
+    rng = random.Random(seed)
+    token_addresses = [f"0x{rng.getrandbits(160):040x}" for _ in range(tokens)]
+    holder_addresses = [f"0x{rng.getrandbits(160):040x}" for _ in range(holders)]
+    transfers = []
+    for i in range(count):
+        sender, receiver = rng.sample(holder_addresses, 2)
+        transfers.append({
+            "id": f"0x{rng.getrandbits(256):064x}_{i}",
+            "timeStamp": str(start_timestamp + i // transfers_per_second),
+            "token": rng.choice(token_addresses),
+            "from": sender,
+            "to": receiver,
+            "value": str(rng.randint(1, 10 ** 24)),
+            "blockNumber": str(18000000 + i // (transfers_per_second * 12)),
+        })
+    transfers.sort(key=lambda transfer: (int(transfer["timeStamp"]), transfer["id"]))
+    return transfers
@@ -0,0 +1,80 @@
+#Testing the asyncio Envio and Dune clients against the local stand-ins of fake_servers
+#Needs the async dependencies: pipenv install --categories "packages async"
+
+import asyncio
+import json
+import threading
+import urllib.request
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+import fake_servers
+from async_dune_client import AsyncDuneClient
+from async_envio_client import AsyncEnvioClient
+from data_transformer import DataTransformer
+from entities import SWAP
+from synthetic_data import generate_swaps
+from upload_ledger import UploadLedger
+
+ROWS = 2500
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    envio = fake_servers.make_envio_server(rows=ROWS)
+    dune = fake_servers.make_dune_server(throttle_rate=0.3, retry_after=0)
+    for server in (envio, dune):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("ENVIO_GRAPHQL_URL", f"http://127.0.0.1:{envio.server_address[1]}/v1/graphql")
+    monkeypatch.setenv("DUNE_API_URL", f"http://127.0.0.1:{dune.server_address[1]}/api/v1")
+    monkeypatch.setenv("DUNE_API_KEY", "test")
+    monkeypatch.setenv("BATCH_SIZE", "1000")
+    yield dune
+    for server in (envio, dune):
+        server.shutdown()
+        server.server_close()
+
+
+def dune_tables(dune):
+    with urllib.request.urlopen(f"http://127.0.0.1:{dune.server_address[1]}/_stats") as response:
+        return json.load(response)["tables"]
+
+
+def test_async_envio_client_pages_counts_and_stats(servers):
+    async def run():
+        async with AsyncEnvioClient() as envio:
+            stats = await envio.get_entity_stats(SWAP)
+            bounds = list(range(stats["min_timestamp"], stats["max_timestamp"] + 1, 100)) + [stats["max_timestamp"] + 1]
+            counts = await envio.get_entity_counts(SWAP, bounds)
+            rows = [row async for page in envio.iter_pages(SWAP, limit=700) for row in page]
+            return stats, counts, rows
+
+    stats, counts, rows = asyncio.run(run())
+    swaps = generate_swaps(ROWS)
+    assert stats == {"count": ROWS, "min_timestamp": int(swaps[0]["timeStamp"]),
+                     "max_timestamp": int(swaps[-1]["timeStamp"])}
+    assert sum(counts) == ROWS
+    assert [row["id"] for row in rows] == [swap["id"] for swap in swaps]
+
+
+def test_async_dune_client_uploads_each_chunk_once(servers, tmp_path):
+    batch = DataTransformer().transform_batch(generate_swaps(ROWS), SWAP)
+
+    async def run():
+        async with AsyncDuneClient(ledger=UploadLedger(str(tmp_path / "ledger.db"))) as dune:
+            assert await dune.create_table("ns", "swaps", "Swaps", SWAP.schema)
+            assert await dune.table_exists("ns", "swaps") and not await dune.table_exists("ns", "other")
+            first = await dune.upload_data("ns", "swaps", batch, batch_size=1000, entity=SWAP)
+            # Sent again, every chunk is found in the upload ledger
+            again = await dune.upload_data("ns", "swaps", batch, batch_size=1000, entity=SWAP)
+            latest = await dune.get_latest_id("ns", "swaps", SWAP)
+            return first, again, latest
+
+    first, again, latest = asyncio.run(run())
+    assert len(first) == 3 and not any(result.get("duplicate") for result in first)
+    assert len(again) == 3 and all(result.get("duplicate") for result in again)
+    assert latest[0] == generate_swaps(ROWS)[-1]["id"]
+    table = dune_tables(servers)["ns.swaps"]
+    assert table["rows"] == table["unique_ids"] == ROWS
@@ -0,0 +1,80 @@
+#Testing the checkpoint store and the commit order of the pipeline
+#A restart must resume right after the last batch Dune accepted, never past a batch still uploading
+
+from checkpoint_store import CheckpointStore
+from pipeline import Batch, CommitTracker
+
+
+def batch(seq):
+    """Batch of two rows at seconds 2*seq and 2*seq + 1"""
+    return Batch(seq, [], (1000 + 2 * seq, f"0x{2 * seq}"), (1001 + 2 * seq, f"0x{2 * seq + 1}"))
+
+
+def test_commits_survive_reopening_the_store(tmp_path):
+    path = str(tmp_path / "checkpoints.db")
+    store = CheckpointStore(path)
+    assert store.load("ns.swaps") is None
+    store.commit("ns.swaps", (1000, "0xa"), (1001, "0xb"), 2)
+    store.commit("ns.swaps", (1002, "0xc"), (1003, "0xd"), 3)
+    store.commit("ns.transfers", (1000, "0xe"), (1000, "0xe"), 1)
+    store.close()
+
+    store = CheckpointStore(path)
+    assert store.load("ns.swaps") == (1003, "0xd")
+    stats = store.stats("ns.swaps")
+    assert (stats["cursor"], stats["rows_total"], stats["batches_total"]) == ((1003, "0xd"), 5, 2)
+    assert store.load("ns.transfers") == (1000, "0xe")
+
+    # Seeding only applies to a stream without a checkpoint
+    store.seed("ns.swaps", (1, "0x0"))
+    store.seed("ns.other", (1, "0x0"))
+    assert store.load("ns.swaps") == (1003, "0xd")
+    assert store.load("ns.other") == (1, "0x0")
+
+    store.reset("ns.swaps")
+    assert store.load("ns.swaps") is None and store.stats("ns.swaps") is None
+    store.close()
+
+
+def test_partition_plan_round_trip(tmp_path):
+    path = str(tmp_path / "checkpoints.db")
+    store = CheckpointStore(path)
+    store.save_partitions("ns.swaps", [(200, 300), (100, 200)])
+    store.set_partition_status("ns.swaps", 100, "running")
+    store.set_partition_status("ns.swaps", 100, "failed")
+    store.set_partition_status("ns.swaps", 100, "running")
+    store.set_partition_status("ns.swaps", 100, "done")
+    store.close()
+
+    store = CheckpointStore(path)
+    assert store.load_partitions("ns.swaps") == [
+        {"start": 100, "end": 200, "status": "done", "attempts": 2},
+        {"start": 200, "end": 300, "status": "pending", "attempts": 0},
+    ]
+    # A new plan replaces the old one
+    store.save_partitions("ns.swaps", [(300, 400)])
+    assert [p["start"] for p in store.load_partitions("ns.swaps")] == [300]
+    store.save_partitions("ns.swaps", [])
+    assert store.load_partitions("ns.swaps") == []
+    store.close()
+
+
+def test_checkpoint_only_moves_over_contiguous_uploads(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints.db"))
+    tracker = CommitTracker(store, "ns.swaps")
+    batches = [batch(seq) for seq in range(4)]
+
+    # Uploads 2 and 1 finish before 0: nothing can be committed yet
+    tracker.finish(batches[2], 2)
+    tracker.finish(batches[1], 2)
+    assert store.load("ns.swaps") is None
+    assert tracker.pending == 2
+
+    tracker.finish(batches[0], 2)
+    assert store.load("ns.swaps") == batches[2].last_cursor
+    assert (tracker.cursor, tracker.rows_committed, tracker.pending) == (batches[2].last_cursor, 6, 0)
+
+    tracker.finish(batches[3], 1)
+    stats = store.stats("ns.swaps")
+    assert (stats["cursor"], stats["rows_total"], stats["batches_total"]) == (batches[3].last_cursor, 7, 4)
+    store.close()
@@ -0,0 +1,81 @@
+#Testing the columnar transform against the original row-by-row transform_swaps
+#Rows with missing fields are dropped and null varchar values kept, whatever else is in the page
+
+from datetime import datetime
+
+from data_transformer import DataTransformer
+from entities import SWAP, EntitySpec, TokenColumns
+from synthetic_data import generate_swaps
+
+
+def reference_transform(swaps):
+    """The row-by-row loop transform_swaps used before the columnar path"""
+    transformed = []
+    for swap in swaps:
+        try:
+            transformed.append({
+                "id": swap["id"],
+                "from": swap["from"],
+                "token_in": swap["_tokenIn"],
+                "token_out": swap["_tokenOut"],
+                "amount_in": float(swap["_amountIn"]),
+                "amount_out": float(swap["_amountOut"]),
+                "timestamp": datetime.fromtimestamp(int(swap["timeStamp"])).isoformat()
+            })
+        except (KeyError, ValueError):
+            continue
+    return transformed
+
+
+def swaps_with_nulls():
+    swaps = generate_swaps(6)
+    swaps[1]["from"] = None
+    swaps[2]["_tokenIn"] = None
+    swaps[3]["_amountOut"] = "not a number"
+    return swaps
+
+
+def test_null_varchar_values_are_kept_like_the_row_by_row_path():
+    swaps = swaps_with_nulls()
+    assert DataTransformer().transform_swaps(swaps) == reference_transform(swaps)
+    assert len(reference_transform(swaps)) == 5
+
+
+def test_missing_fields_drop_only_their_rows():
+    swaps = swaps_with_nulls()
+    del swaps[4]["_amountIn"]
+    del swaps[5]["from"]
+    transformed = DataTransformer().transform_swaps(swaps)
+    assert transformed == reference_transform(swaps)
+    # The rows with null values are kept although the page also takes the missing-field path
+    assert [swap["id"] for swap in transformed] == [swaps[0]["id"], swaps[1]["id"], swaps[2]["id"]]
+    assert transformed[1]["from"] is None and transformed[2]["token_in"] is None
+
+
+def test_null_numbers_are_dropped():
+    swaps = generate_swaps(3)
+    swaps[1]["_amountIn"] = None
+    transformed = DataTransformer().transform_swaps(swaps)
+    assert [swap["id"] for swap in transformed] == [swaps[0]["id"], swaps[2]["id"]]
+
+
+class StubTokenCache:
+    """Token metadata of known addresses, failing on anything that is not an address"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def lookup(self, addresses):
+        return {address: self.tokens.get(address.lower(), (None, None)) for address in addresses}
+
+
+def test_rows_without_a_token_address_get_null_metadata():
+    entity = EntitySpec("Swap", "swaps", SWAP.columns, tokens=[TokenColumns("token_in", "amount_in")])
+    swaps = generate_swaps(3)
+    swaps[1]["_tokenIn"] = None
+    swaps[2]["_tokenIn"] = ""
+    cache = StubTokenCache({swaps[0]["_tokenIn"].lower(): ("WETH", 18)})
+    columns = DataTransformer(token_cache=cache).transform_columnar(swaps, entity)
+    assert columns["token_in_symbol"].tolist() == ["WETH", None, None]
+    assert columns["token_in_decimals"].tolist() == [18, None, None]
+    assert columns["amount_in_normalized"].tolist()[1:] == [None, None]
@@ -0,0 +1,59 @@
+#Testing the replay filter once ids leave its exact window
+#Evicted ids must still drop replays, new ids must never be mistaken for them, and memory must stay flat
+
+from dedup import BloomFilter, DedupWindow
+
+
+def page(first, count, timestamp, prefix="0x"):
+    """Rows with consecutive ids sharing one timestamp"""
+    return [{"id": f"{prefix}{i}", "timeStamp": str(timestamp)} for i in range(first, first + count)]
+
+
+def test_replayed_evicted_page_is_dropped():
+    seen = DedupWindow(window_seconds=10, max_ids=1000, bloom_capacity=1000, error_rate=1e-6)
+    old = page(0, 100, 1000)
+    assert len(seen.filter(old)) == 100
+    # Advancing the watermark past the window moves the first page to the Bloom filter
+    assert len(seen.filter(page(100, 100, 1100))) == 100
+    assert len(seen) == 100
+    assert seen._evicted_upto == 1000
+
+    assert seen.filter(old) == []
+
+
+def test_new_ids_at_the_eviction_watermark_are_kept():
+    seen = DedupWindow(window_seconds=10, max_ids=1000, bloom_capacity=1000, error_rate=1e-6)
+    seen.filter(page(0, 100, 1000))
+    seen.filter(page(100, 100, 1100))
+
+    # Same timestamp as the evicted ids, so they are checked against the Bloom filter
+    late = page(0, 100, 1000, prefix="0xlate")
+    assert seen.filter(late) == late
+    # And are then tracked exactly: replaying them is dropped too
+    assert seen.filter(late) == []
+
+
+def test_memory_stays_flat_with_max_ids_and_both_bloom_generations():
+    seen = DedupWindow(window_seconds=10 ** 9, max_ids=500, bloom_capacity=2000, error_rate=1e-3)
+    sizes = []
+    for number in range(100):
+        rows = page(number * 100, 100, 1000 + number)
+        assert len(seen.filter(rows)) == 100
+        assert len(seen) <= 500 + 100  # max_ids, give or take one page
+        sizes.append(seen.nbytes)
+
+    # 9500 ids went through a Bloom filter holding 2000 per generation: both are in use and
+    # the oldest were dropped, so the bytes held stopped growing at two generations
+    assert seen._previous_bloom is not None
+    assert seen.nbytes == 2 * BloomFilter(2000, 1e-3).nbytes
+    assert len(set(sizes[-20:])) == 1
+    # The newest generation still drops a replay of the last evicted page
+    assert seen.filter(page(9000, 100, 1090)) == []
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(10000, 1e-4)
+    keys = [f"0x{i}" for i in range(10000)]
+    bloom.add(keys)
+    assert bloom.contains(keys).all()
+    assert bloom.contains([f"0xnew{i}" for i in range(10000)]).sum() < 10
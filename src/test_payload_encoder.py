@@ -0,0 +1,67 @@
+#Testing the CSV encoder against csv.writer
+#The vectorized blocks must be byte-identical to what csv.writer writes for the same rows
+
+import csv
+import io
+
+import numpy as np
+
+from data_transformer import DataTransformer
+from payload_encoder import encode_csv, encode_csv_block, iter_csv
+from row_batch import RowBatch
+from synthetic_data import generate_swaps
+
+
+def csv_writer_bytes(fieldnames, rows):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(fieldnames)
+    writer.writerows(rows)
+    return output.getvalue().encode("utf-8")
+
+
+def test_swaps_match_csv_writer():
+    swaps = generate_swaps(5000)
+    transformer = DataTransformer()
+    batch = transformer.transform_swaps_batch(swaps)
+    rows = [list(row.values()) for row in transformer.transform_swaps(swaps)]
+    assert encode_csv(batch) == csv_writer_bytes(batch.fieldnames, rows)
+    # Block boundaries do not change the bytes
+    assert b"".join(iter_csv(batch, block_rows=7)) == encode_csv(batch)
+
+
+def test_values_that_need_quoting_match_csv_writer():
+    rows = [
+        {"id": "0x1", "note": "plain", "amount": 1.5, "count": 3},
+        {"id": "0x2", "note": "with, comma", "amount": 0.1, "count": -1},
+        {"id": "0x3", "note": 'with "quotes"', "amount": 1e300, "count": 0},
+        {"id": "0x4", "note": "two\nlines", "amount": 1.5e-7, "count": 2 ** 40},
+        {"id": "0x5", "note": "carriage\rreturn", "amount": -0.0, "count": 7},
+        {"id": "0x6", "note": None, "amount": None, "count": None},
+        {"id": "0x7", "note": "ünïcode", "amount": 7.669672902085988e+23, "count": 1},
+    ]
+    fieldnames = ["id", "note", "amount", "count"]
+    expected = csv_writer_bytes(fieldnames, [[row[name] for name in fieldnames] for row in rows])
+    batch = RowBatch.from_dicts(rows, fieldnames)
+    assert encode_csv(batch) == expected
+
+    # One block per row gives the same bytes
+    header = expected.split(b"\r\n", 1)[0] + b"\r\n"
+    blocks = b"".join(encode_csv_block(batch, index, index + 1) for index in range(len(rows)))
+    assert header + blocks == expected
+
+
+def test_plain_numeric_columns_take_the_vectorized_path():
+    columns = {"id": ["0xa", "0xb", "0xc"], "amount": [0.1, 2.0, 3e-9], "count": [1, 22, 333]}
+    batch = RowBatch.from_columns({"id": columns["id"], "amount": np.array(columns["amount"]),
+                                   "count": np.array(columns["count"], dtype=np.int64)})
+    assert [column.dtype.kind for column in batch.columns] == ["S", "f", "i"]
+    rows = list(zip(*columns.values()))
+    assert encode_csv(batch) == csv_writer_bytes(list(columns), rows)
+
+    # A fixed-width column holding a comma falls back to csv.writer for its block only
+    ids = ["0xa", "0x,b", "0xc"]
+    batch = RowBatch.from_columns({"id": ids, "amount": np.array(columns["amount"])})
+    assert batch.column("id").dtype.kind == "S"
+    expected = csv_writer_bytes(["id", "amount"], list(zip(ids, columns["amount"])))
+    assert b"".join(iter_csv(batch, block_rows=1)) == expected
@@ -0,0 +1,68 @@
+#Testing the hourly rollup under a local timezone
+#Timestamp columns hold local times: pruning must not drop the distinct values of the hour still being filled
+
+import os
+import time
+
+import pytest
+
+from data_transformer import DataTransformer
+from entities import SWAP
+from rollup import RollupStore
+from synthetic_data import generate_swaps
+
+
+@pytest.fixture
+def new_york():
+    previous = os.environ.get("TZ")
+    os.environ["TZ"] = "America/New_York"
+    time.tzset()
+    yield
+    if previous is None:
+        del os.environ["TZ"]
+    else:
+        os.environ["TZ"] = previous
+    time.tzset()
+
+
+def pages_of(swaps):
+    """One transformed page per swap, with its cursor"""
+    transformer = DataTransformer()
+    return [(transformer.transform_batch([swap], SWAP), SWAP.cursor(swap)) for swap in swaps]
+
+
+def test_pages_within_one_hour_count_a_sender_once(new_york, tmp_path):
+    hour = 1700000000 - 1700000000 % 3600
+    template = generate_swaps(1)[0]
+    swaps = [dict(template, id=f"0x{i}", timeStamp=str(hour + 60 * (i + 1))) for i in range(3)]
+    store = RollupStore(str(tmp_path / "rollup.db"))
+    table = "ns.swaps_hourly"
+    for page in pages_of(swaps):
+        store.apply("ns.swaps", table, SWAP.rollup, [page])
+
+    chunks = []
+    store.flush(table, SWAP.rollup, lambda batch, key: chunks.append(batch) or True, 100)
+    deltas = [row for batch in chunks for row in batch.dicts()]
+    assert [row["swaps"] for row in deltas] == [1, 1, 1]
+    assert [row["unique_senders"] for row in deltas] == [1, 0, 0]
+    store.close()
+
+
+def test_hours_every_stream_passed_are_pruned(new_york, tmp_path):
+    hour = 1700000000 - 1700000000 % 3600
+    template = generate_swaps(1)[0]
+    swaps = [dict(template, id=f"0x{i}", timeStamp=str(hour + 3600 * i)) for i in range(3)]
+    store = RollupStore(str(tmp_path / "rollup.db"))
+    table = "ns.swaps_hourly"
+    # A partition that has not fetched anything yet holds back every hour after its start
+    store.start("ns.swaps#backfill/a", (hour, ""))
+    for page in pages_of(swaps):
+        store.apply("ns.swaps#backfill/b", table, SWAP.rollup, [page])
+    count = "SELECT count(*) FROM rollup_members"
+    assert store._conn.execute(count).fetchone()[0] == 3
+
+    store.forget("ns.swaps#backfill/a")
+    store.apply("ns.swaps#backfill/b", table, SWAP.rollup,
+                pages_of([dict(template, id="0x3", timeStamp=str(hour + 3600 * 2 + 60))]))
+    assert store._conn.execute(count).fetchone()[0] == 1
+    store.close()
@@ -0,0 +1,69 @@
+#Testing the durable spill queue
+#Chunks that were not acknowledged must come back, in order, when the queue is opened again after a crash
+
+import os
+
+from spill_queue import SpillQueue
+
+
+def put(queue, name, rows=1):
+    return queue.put([name.encode("utf-8"), b"\n"], {"namespace": "ns", "table_name": "swaps", "stream": "ns.swaps",
+                                                     "name": name, "rows": rows})
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_put_get_ack_nack(tmp_path):
+    queue = SpillQueue(str(tmp_path / "spool"))
+    first, second = put(queue, "a", 2), put(queue, "b", 3)
+    assert queue.stats()["pending"] == 2 and queue.bytes == 4
+
+    meta, path = queue.get(timeout=0)
+    assert (meta["seq"], meta["name"], read(path)) == (first, "a", b"a\n")
+    # A claimed chunk is not handed out twice
+    assert queue.get(timeout=0)[0]["seq"] == second
+    assert queue.get(timeout=0) is None
+
+    queue.nack(first, delay=60)
+    assert queue.get(timeout=0) is None  # Waiting for its retry
+    queue.nack(second)
+    assert queue.attempts(second) == 1
+    meta, path = queue.get(timeout=0)
+    assert meta["seq"] == second
+    # The first chunk failed once and waits; the second is claimed again, so it is not parked
+    assert queue.stats(max_attempts=1)["parked"] == 1
+
+    queue.ack(second)
+    assert not os.path.exists(path)
+    assert queue.stats() == {"pending": 1, "claimed": 0, "parked": 0, "bytes": 2}
+    assert queue.uploaded("ns.swaps", "swaps") == 3
+    assert queue.pending("ns", "swaps") == 1
+
+
+def test_unacknowledged_chunks_come_back_in_order_after_reopening(tmp_path):
+    path = str(tmp_path / "spool")
+    queue = SpillQueue(path)
+    seqs = [put(queue, name) for name in "abcd"]
+    queue.get(timeout=0)
+    queue.ack(seqs[0])
+    claimed, _ = queue.get(timeout=0)  # Claimed by a worker when the process died
+    # A chunk whose metadata was never written is not visible, and its leftovers are removed
+    with open(os.path.join(path, "000000000099.json.tmp"), "w") as f:
+        f.write("{")
+
+    queue = SpillQueue(path)
+    assert queue.stats()["pending"] == 3
+    names = []
+    while True:
+        item = queue.get(timeout=0)
+        if item is None:
+            break
+        names.append((item[0]["seq"], item[0]["name"], read(item[1])))
+    assert names == [(seqs[1], "b", b"b\n"), (seqs[2], "c", b"c\n"), (seqs[3], "d", b"d\n")]
+    assert claimed["seq"] == seqs[1]
+    assert not any(name.endswith(".tmp") for name in os.listdir(path))
+    # New chunks are numbered after the recovered ones
+    assert put(queue, "e") > seqs[3]
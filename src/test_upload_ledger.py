@@ -0,0 +1,89 @@
+#Testing the exactly-once upload path: the upload ledger, in flight marks and the Dune lookup of unresolved chunks
+#Dune is stubbed: run_sql answers the lookup query and _upload_chunk stands in for the insert request
+
+from data_transformer import DataTransformer
+from dune_client import DuneClient
+from synthetic_data import generate_swaps
+from upload_ledger import UploadLedger, chunk_key
+
+STREAM = "ns.swaps"
+
+
+def make_client(tmp_path, found=0, answer=True):
+    """DuneClient whose lookup query finds `found` rows (None: the query fails) and whose inserts return `answer`"""
+    client = DuneClient(ledger=UploadLedger(str(tmp_path / "ledger.db")))
+    client.sent = []
+    client.queries = []
+
+    def run_sql(query, description="query"):
+        client.queries.append(query)
+        return None if found is None else [{"found": found}]
+
+    def upload_chunk(endpoint, headers, body, fallback_body, label, max_retries=5, rows=None):
+        client.sent.append(label)
+        return {"table_name": "swaps", "rows_written": rows} if answer else None
+
+    client.run_sql = run_sql
+    client._upload_chunk = upload_chunk
+    return client
+
+
+def upload(client, tmp_path, key):
+    path = tmp_path / "chunk.csv"
+    path.write_bytes(b"id\n")
+    return client.upload_payload("ns", "swaps", str(path), "csv", label="chunk", rows=3, key=key, id_column="id")
+
+
+def key_of(swaps):
+    batch = DataTransformer().transform_swaps_batch(swaps)
+    return chunk_key(batch, 0, len(batch))
+
+
+def test_chunk_found_in_dune_is_not_sent_again(tmp_path):
+    key = key_of(generate_swaps(3))
+    client = make_client(tmp_path, found=1, answer=False)
+    # The insert gets no answer: the chunk stays in flight
+    assert upload(client, tmp_path, key) is None
+    assert client.ledger.in_flight(STREAM, key)
+
+    assert upload(client, tmp_path, key) == {"duplicate": True}
+    assert client.sent == ["chunk"]
+    assert "'" + key[1] + "'" in client.queries[0] and "'" + key[2] + "'" in client.queries[0]
+    assert client.ledger.contains(STREAM, key) and not client.ledger.in_flight(STREAM, key)
+
+    # Once recorded, it is skipped without asking Dune
+    assert upload(client, tmp_path, key) == {"duplicate": True}
+    assert len(client.queries) == 1
+
+
+def test_chunk_not_found_in_dune_is_sent_again(tmp_path):
+    key = key_of(generate_swaps(3))
+    client = make_client(tmp_path, found=0)
+    client.ledger.begin(STREAM, key, 3)
+
+    assert upload(client, tmp_path, key)["rows_written"] == 3
+    assert client.sent == ["chunk"]
+    assert client.ledger.contains(STREAM, key) and not client.ledger.in_flight(STREAM, key)
+
+
+def test_chunk_is_kept_in_flight_when_dune_cannot_be_asked(tmp_path):
+    key = key_of(generate_swaps(3))
+    client = make_client(tmp_path, found=None)
+    client.ledger.begin(STREAM, key, 3)
+
+    assert upload(client, tmp_path, key) is None
+    assert client.sent == []
+    assert client.ledger.in_flight(STREAM, key)
+
+
+def test_same_rows_give_the_same_key():
+    swaps = generate_swaps(10)
+    whole = DataTransformer().transform_swaps_batch(swaps)
+    part = DataTransformer().transform_swaps_batch(swaps[2:5])
+    key = chunk_key(whole, 2, 5)
+    assert key == chunk_key(part, 0, 3)
+    assert key[1:] == (swaps[2]["id"], swaps[4]["id"])
+
+    changed = [dict(swap) for swap in swaps[2:5]]
+    changed[1]["_amountIn"] = "1"
+    assert chunk_key(DataTransformer().transform_swaps_batch(changed), 0, 3) != key
@@ -0,0 +1,269 @@
+import importlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import log
+import metrics
+
+# ERC-20 function selectors
+_SYMBOL_SELECTOR = "0x95d89b41"
+_DECIMALS_SELECTOR = "0x313ce567"
+_SQL_VARIABLES = 500  # Addresses per SELECT, below SQLite's bound parameter limit
+_ERROR_RETRY_SECONDS = 60  # Addresses of a failed resolver call are asked again after this
+
+
+def _decode_symbol(result):
+    """
+    Decode the return value of symbol(): an ABI string, or a bytes32 for older tokens such as MKR
+    :return: Symbol, or None if the call returned nothing usable
+    """
+    data = bytes.fromhex((result or "0x")[2:])
+    if len(data) >= 64:
+        offset = int.from_bytes(data[:32], "big")
+        length = int.from_bytes(data[offset:offset + 32], "big") if offset + 32 <= len(data) else len(data)
+        raw = data[offset + 32:offset + 32 + length]
+    else:
+        raw = data[:32].rstrip(b"\x00")
+    symbol = raw.decode("utf-8", errors="replace").strip("\x00").strip()
+    return symbol or None
+
+
+def _decode_decimals(result):
+    """:return: decimals() as int, or None if the call returned nothing usable"""
+    data = (result or "0x")[2:]
+    if not data:
+        return None
+    decimals = int(data, 16)
+    return decimals if decimals <= 255 else None
+
+
+class JsonRpcResolver:
+    """
+    Resolves token metadata by calling symbol() and decimals() on the token contracts
+    through an Ethereum JSON-RPC endpoint, batching the calls of many addresses in one request
+    """
+    batch_addresses = 100
+
+    def __init__(self, rpc_url=None, timeout=30):
+        """
+        :param rpc_url: JSON-RPC endpoint. If not provided, uses TOKEN_RPC_URL from .env
+        :param timeout: Seconds a batch request may take
+        """
+        self.rpc_url = rpc_url or os.getenv('TOKEN_RPC_URL')
+        if not self.rpc_url:
+            raise ValueError("TOKEN_RPC_URL not set in environment variables")
+        self.timeout = timeout
+        self._session = None
+
+    def __call__(self, addresses):
+        """
+        :param addresses: Lowercase token addresses
+        :return: Dictionary of address -> (symbol, decimals) for the contracts that answered;
+                 raises if the endpoint cannot be reached, so nothing is cached as unknown
+        """
+        import requests
+        if self._session is None:
+            self._session = requests.Session()
+        resolved = {}
+        for first in range(0, len(addresses), self.batch_addresses):
+            part = addresses[first:first + self.batch_addresses]
+            calls = [
+                {"jsonrpc": "2.0", "id": index * 2 + offset, "method": "eth_call",
+                 "params": [{"to": address, "data": selector}, "latest"]}
+                for index, address in enumerate(part)
+                for offset, selector in enumerate((_SYMBOL_SELECTOR, _DECIMALS_SELECTOR))
+            ]
+            response = self._session.post(self.rpc_url, json=calls, timeout=self.timeout)
+            response.raise_for_status()
+            results = {reply["id"]: reply.get("result") for reply in response.json()}
+            for index, address in enumerate(part):
+                try:
+                    symbol = _decode_symbol(results.get(index * 2))
+                    decimals = _decode_decimals(results.get(index * 2 + 1))
+                except ValueError:
+                    continue  # Not hex, or not an ERC-20 answer
+                if decimals is not None:
+                    resolved[address] = (symbol, decimals)
+        return resolved
+
+
+def load_resolver(spec=None):
+    """
+    Build the resolver of token addresses the cache does not hold
+    :param spec: "module:callable" of a function taking a list of addresses and returning a dictionary
+                 of address -> (symbol, decimals). If not provided, uses TOKEN_RESOLVER from .env
+    :return: The callable, a JsonRpcResolver if TOKEN_RPC_URL is set, or None
+    """
+    spec = spec or os.getenv('TOKEN_RESOLVER')
+    if spec:
+        module, _, name = spec.partition(":")
+        if not name:
+            raise ValueError(f"TOKEN_RESOLVER must be module:callable, got {spec}")
+        return getattr(importlib.import_module(module), name)
+    if os.getenv('TOKEN_RPC_URL'):
+        return JsonRpcResolver()
+    return None
+
+
+def read_token_file(path):
+    """
+    Read token metadata from a JSON file: either a token list ({"tokens": [{"address", "symbol",
+    "decimals"}, ...]}, the format of Uniswap token lists) or an object of address -> {"symbol", "decimals"}
+    :return: Dictionary of lowercase address -> (symbol, decimals)
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if "tokens" in data:
+        entries = ((token["address"], token) for token in data["tokens"])
+    else:
+        entries = data.items()
+    return {address.lower(): (token.get("symbol"), token.get("decimals")) for address, token in entries}
+
+
+class TokenCache:
+    """
+    Token symbol and decimals by address, for the enrichment of token columns. Lookups go
+    through an in-memory LRU, then a SQLite file, and only the addresses neither holds are
+    sent to the resolver, in one call per page; every answer is kept on disk, so a token is
+    resolved once per cache file and the network is never used per row. Tokens the resolver
+    does not know are remembered as unknown and asked again after retry_seconds.
+    """
+
+    def __init__(self, path=None, tokens_path=None, resolver=None, size=None, retry_seconds=None):
+        """
+        :param path: SQLite file to use. If not provided, uses TOKEN_CACHE_PATH from .env
+        :param tokens_path: JSON file of known tokens stored at start, see read_token_file.
+                            If not provided, uses TOKENS_PATH from .env
+        :param resolver: Callable taking a list of addresses and returning a dictionary of
+                         address -> (symbol, decimals). If not provided, see load_resolver
+        :param size: Addresses kept in memory. If not provided, uses TOKEN_CACHE_SIZE from .env
+        :param retry_seconds: Seconds before an unknown token is resolved again. If not provided,
+                              uses TOKEN_RETRY_SECONDS from .env
+        """
+        self.path = path or os.getenv('TOKEN_CACHE_PATH', 'tokens.db')
+        self.resolver = resolver if resolver is not None else load_resolver()
+        self.size = int(size or os.getenv('TOKEN_CACHE_SIZE', 100000))
+        self.retry_seconds = float(retry_seconds if retry_seconds is not None
+                                   else os.getenv('TOKEN_RETRY_SECONDS', 24 * 3600))
+        self._memory = OrderedDict()  # address -> (symbol, decimals, retry_at), most recently used last
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS tokens (
+                    address TEXT PRIMARY KEY,
+                    symbol TEXT,
+                    decimals INTEGER,
+                    resolved_at REAL NOT NULL
+                )
+            """)
+        tokens_path = tokens_path or os.getenv('TOKENS_PATH')
+        if tokens_path:
+            tokens = read_token_file(tokens_path)
+            self._store(tokens, [])
+            log.info("Loaded %d tokens from %s", len(tokens), tokens_path)
+
+    def lookup(self, addresses):
+        """
+        :param addresses: Distinct token addresses, in any case
+        :return: Dictionary of address, as given -> (symbol, decimals), (None, None) for unknown tokens
+        """
+        now = time.time()
+        keys = {address: address.lower() for address in addresses}
+        found = {}
+        with self._lock:
+            for key in set(keys.values()):
+                entry = self._memory.get(key)
+                if entry is not None and entry[2] > now:
+                    self._memory.move_to_end(key)
+                    found[key] = entry[:2]
+        metrics.TOKEN_LOOKUPS.labels("memory").inc(len(found))
+        missing = [key for key in set(keys.values()) if key not in found]
+        if missing:
+            loaded = self._load(missing, now)
+            metrics.TOKEN_LOOKUPS.labels("disk").inc(len(loaded))
+            found.update(loaded)
+            missing = [key for key in missing if key not in loaded]
+        if missing:
+            found.update(self._resolve(missing, now))
+        return {address: found[key] for address, key in keys.items()}
+
+    def _remember(self, key, metadata, retry_at):
+        """Keep an entry in memory, evicting the least recently used ones beyond size. Call with the lock held"""
+        self._memory[key] = (*metadata, retry_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def _load(self, keys, now):
+        """Entries of the SQLite file that are still valid, moved into memory"""
+        loaded = {}
+        with self._lock:
+            for first in range(0, len(keys), _SQL_VARIABLES):
+                part = keys[first:first + _SQL_VARIABLES]
+                rows = self._conn.execute(
+                    f"SELECT address, symbol, decimals, resolved_at FROM tokens "
+                    f"WHERE address IN ({', '.join('?' * len(part))})", part
+                ).fetchall()
+                for address, symbol, decimals, resolved_at in rows:
+                    known = symbol is not None or decimals is not None
+                    retry_at = float("inf") if known else resolved_at + self.retry_seconds
+                    if retry_at > now:
+                        loaded[address] = (symbol, decimals)
+                        self._remember(address, (symbol, decimals), retry_at)
+        return loaded
+
+    def _resolve(self, keys, now):
+        """Ask the resolver about addresses neither memory nor disk holds, and store its answers"""
+        unknown = (None, None)
+        if self.resolver is None:
+            # Only remembered in memory: a resolver configured later still gets to answer
+            with self._lock:
+                for key in keys:
+                    self._remember(key, unknown, now + self.retry_seconds)
+            metrics.TOKEN_LOOKUPS.labels("unknown").inc(len(keys))
+            return dict.fromkeys(keys, unknown)
+        try:
+            resolved = {address.lower(): tuple(metadata) for address, metadata in self.resolver(keys).items()}
+        except Exception as e:
+            log.error("Error resolving %d token addresses: %s", len(keys), e)
+            metrics.TOKEN_LOOKUPS.labels("error").inc(len(keys))
+            with self._lock:
+                for key in keys:
+                    self._remember(key, unknown, now + _ERROR_RETRY_SECONDS)
+            return dict.fromkeys(keys, unknown)
+        resolved = {key: resolved[key] for key in keys if key in resolved and resolved[key] != unknown}
+        missing = [key for key in keys if key not in resolved]
+        self._store(resolved, missing, now)
+        metrics.TOKEN_LOOKUPS.labels("resolved").inc(len(resolved))
+        metrics.TOKEN_LOOKUPS.labels("unknown").inc(len(missing))
+        log.debug("Resolved %d of %d token addresses", len(resolved), len(keys))
+        return {**resolved, **dict.fromkeys(missing, unknown)}
+
+    def _store(self, tokens, unknown, now=None):
+        """
+        Write entries to the SQLite file and to memory
+        :param tokens: Dictionary of lowercase address -> (symbol, decimals)
+        :param unknown: Lowercase addresses the resolver does not know
+        """
+        now = time.time() if now is None else now
+        rows = [(address, symbol, None if decimals is None else int(decimals), now)
+                for address, (symbol, decimals) in tokens.items()]
+        rows += [(address, None, None, now) for address in unknown]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO tokens (address, symbol, decimals, resolved_at) VALUES (?, ?, ?, ?)", rows
+            )
+            for address, symbol, decimals, _ in rows:
+                if address in self._memory or len(self._memory) < self.size:
+                    known = symbol is not None or decimals is not None
+                    self._remember(address, (symbol, decimals), float("inf") if known else now + self.retry_seconds)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+def chunk_key(batch, start, stop, id_column="id"):
+    """
+    Identify the rows [start, stop) of a RowBatch independently of how they are encoded:
+    the same rows give the same key whatever the payload format, compression or chunk
+    boundaries of the batch they were cut from
+    :param batch: RowBatch holding the chunk
+    :param start: First row index
+    :param stop: Row index to stop before
+    :param id_column: Column holding the unique id of a row
+    :return: (content hash, first id, last id) tuple
+    """
+    digest = hashlib.sha256()
+    for name, column in zip(batch.fieldnames, batch.columns):
+        part = column[start:stop]
+        digest.update(name.encode("utf-8") + b"\x00")
+        if part.dtype.kind == "S":
+            # Joined values rather than the raw buffer: the padding depends on the widest id of the batch
+            digest.update(b"\x00".join(part.tolist()))
+        elif part.dtype.kind == "O":
+            digest.update("\x00".join(map(str, part.tolist())).encode("utf-8"))
+        else:
+            digest.update(part.tobytes())
+        digest.update(b"\x01")
+    ids = batch.column(id_column)
+    first_id, last_id = (ids[index] for index in (start, stop - 1))
+    if isinstance(first_id, bytes):
+        first_id, last_id = first_id.decode("utf-8"), last_id.decode("utf-8")
+    return digest.hexdigest(), str(first_id), str(last_id)
+
+
+class UploadLedger:
+    """
+    Durable local record of every chunk Dune accepted, keyed by the hash of its rows and
+    the range of ids it spans. The Dune clients consult it before each insert and skip
+    the chunks it already holds, so a chunk that is sent again, e.g. because the process
+    died after Dune accepted it but before the spill queue deleted it, is not inserted
+    twice and nobody downstream needs DISTINCT over the table. A chunk is also marked as
+    in flight before its insert is sent, and that mark is only cleared once Dune accepted
+    it: an insert that timed out or lost its response may still have been applied, so a
+    chunk found in flight is looked up in Dune before it is sent again (see
+    DuneClient._upload_once) instead of being replayed blindly.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: SQLite file to use. If not provided, uses UPLOAD_LEDGER_PATH from .env,
+                     or the checkpoint file CHECKPOINT_PATH
+        """
+        self.path = path or os.getenv('UPLOAD_LEDGER_PATH') or os.getenv('CHECKPOINT_PATH', 'checkpoints.db')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS uploads (
+                    stream TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    first_id TEXT NOT NULL,
+                    last_id TEXT NOT NULL,
+                    rows INTEGER NOT NULL,
+                    uploaded_at REAL NOT NULL,
+                    PRIMARY KEY (stream, content_hash, first_id, last_id)
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS in_flight (
+                    stream TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    first_id TEXT NOT NULL,
+                    last_id TEXT NOT NULL,
+                    rows INTEGER NOT NULL,
+                    sent_at REAL NOT NULL,
+                    PRIMARY KEY (stream, content_hash, first_id, last_id)
+                )
+            """)
+
+    def contains(self, stream, key):
+        """
+        Check whether a chunk was already accepted
+        :param stream: Stream name, e.g. "namespace.swaps"
+        :param key: (content hash, first id, last id), see chunk_key
+        :return: True if the ledger records the chunk
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM uploads WHERE stream = ? AND content_hash = ? AND first_id = ? AND last_id = ?",
+                (stream, *key)
+            ).fetchone()
+        return row is not None
+
+    def in_flight(self, stream, key):
+        """
+        Check whether an insert of a chunk was sent without Dune acknowledging it
+        :param stream: Stream name
+        :param key: (content hash, first id, last id), see chunk_key
+        :return: True if the chunk may have been applied by an earlier insert
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM in_flight WHERE stream = ? AND content_hash = ? AND first_id = ? AND last_id = ?",
+                (stream, *key)
+            ).fetchone()
+        return row is not None
+
+    def begin(self, stream, key, rows):
+        """
+        Mark a chunk as in flight, before its insert is sent
+        :param stream: Stream name
+        :param key: (content hash, first id, last id), see chunk_key
+        :param rows: Number of rows in the chunk
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO in_flight (stream, content_hash, first_id, last_id, rows, sent_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (stream, *key, rows, time.time())
+            )
+
+    def record(self, stream, key, rows):
+        """
+        Record a chunk Dune has accepted, clearing its in flight mark
+        :param stream: Stream name
+        :param key: (content hash, first id, last id), see chunk_key
+        :param rows: Number of rows in the chunk
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO uploads (stream, content_hash, first_id, last_id, rows, uploaded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (stream, *key, rows, time.time())
+            )
+            self._conn.execute(
+                "DELETE FROM in_flight WHERE stream = ? AND content_hash = ? AND first_id = ? AND last_id = ?",
+                (stream, *key)
+            )
+
+    def stats(self, stream):
+        """
+        :param stream: Stream name
+        :return: Dictionary with the chunks and rows recorded for the stream, and the chunks in flight
+        """
+        with self._lock:
+            chunks, rows = self._conn.execute(
+                "SELECT count(*), coalesce(sum(rows), 0) FROM uploads WHERE stream = ?", (stream,)
+            ).fetchone()
+            in_flight = self._conn.execute("SELECT count(*) FROM in_flight WHERE stream = ?", (stream,)).fetchone()[0]
+        return {"chunks": chunks, "rows": rows, "in_flight": in_flight}
+
+    def reset(self, stream):
+        """
+        Forget the chunks of a stream, e.g. after its Dune table was deleted
+        :param stream: Stream name
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM uploads WHERE stream = ?", (stream,))
+            self._conn.execute("DELETE FROM in_flight WHERE stream = ?", (stream,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()